@@ -6,9 +6,16 @@ import os
 import xml.sax
 import xml.sax.saxutils
 import re
+import glob
 import gzip
+import io
+import time
+import multiprocessing
+import concurrent.futures
 
 import pykarta.geometry
+from gpx_data_gzip import ParallelGzipFile
+from gpx_data_catalog import TrackCatalog
 
 class GpxTrk(object):
 	def __init__(self):
@@ -31,22 +38,44 @@ class GpxTrk(object):
 		writer.characters(" ")
 		writer.endElementNL('trk')
 	def get_bbox(self):
-		bbox = pykarta.geometry.BoundingBox()
-		for trkseg in self.segments:
-			for trkpt in trkseg:
-				bbox.add_point(pykarta.geometry.Point(trkpt.lat, trkpt.lon))
-		return bbox
+		bboxes = [trkseg.bbox for trkseg in self.segments if trkseg.bbox is not None]
+		return pykarta.geometry.BoundingBox((
+			min(bbox[0] for bbox in bboxes),
+			min(bbox[1] for bbox in bboxes),
+			max(bbox[2] for bbox in bboxes),
+			max(bbox[3] for bbox in bboxes),
+			))
 
+# The bounding box, [min_lon, min_lat, max_lon, max_lat], is kept up to
+# date as points are appended.
 class GpxTrkseg(object):
 	def __init__(self):
 		self.points = []
+		self.bbox = None
 	def append(self, point):
 		self.points.append(point)
+		bbox = self.bbox
+		if bbox is None:
+			self.bbox = [point.lon, point.lat, point.lon, point.lat]
+		else:
+			if point.lon < bbox[0]:
+				bbox[0] = point.lon
+			elif point.lon > bbox[2]:
+				bbox[2] = point.lon
+			if point.lat < bbox[1]:
+				bbox[1] = point.lat
+			elif point.lat > bbox[3]:
+				bbox[3] = point.lat
 	def __iter__(self):
 		for i in self.points:
 			yield i
 	def __getitem__(self, i):
 		return self.points[i]
+	# Return the (bbox, date, points) which TrackCatalog.add_file() wants
+	def get_catalog_entry(self):
+		bbox = tuple(self.bbox) if self.bbox is not None else None
+		date = self.points[0].time if self.points else None
+		return (bbox, date, len(self.points))
 	def write(self, writer):
 		writer.characters(" ")
 		writer.startElementNL('trkseg', {})
@@ -73,11 +102,15 @@ class GpxTrkpt(object):
 		writer.characters("  ")
 		writer.endElementNL('trkpt')
 
+# Streaming reader. Each <trk> is passed to on_trk(trk_index, trk) as soon
+# as its end tag is seen and is then forgotten, so that however big the
+# file is we hold only one track at a time.
 class GpxReader(xml.sax.handler.ContentHandler):
-	def __init__(self, fh):
+	def __init__(self, fh, on_trk):
 		self.fh = fh
+		self.on_trk = on_trk
 
-		self.trks = []
+		self.trk_count = 0
 		self.trk = None
 		self.trkseg = None
 		self.trkpt = None
@@ -91,7 +124,6 @@ class GpxReader(xml.sax.handler.ContentHandler):
 	def startElement(self, name, attrs):
 		if name == 'trk':
 			self.trk = GpxTrk()
-			self.trks.append(self.trk)
 		elif name == 'trkseg':
 			assert self.trk != None
 			self.trkseg = GpxTrkseg()
@@ -106,6 +138,8 @@ class GpxReader(xml.sax.handler.ContentHandler):
 
 	def endElement(self, name):
 		if name == 'trk':
+			self.on_trk(self.trk_count, self.trk)
+			self.trk_count += 1
 			self.trk = None
 		elif name == 'trkseg':
 			self.trkseg = None
@@ -124,6 +158,7 @@ class GpxWriter(xml.sax.saxutils.XMLGenerator):
 	def __init__(self, fh):
 		fh.write("<?xml version='1.0' encoding='UTF-8'?>\n")
 		xml.sax.saxutils.XMLGenerator.__init__(self, fh)
+		self.abandoned = False			# set if the file is being thrown away
 		self.startElementNL("gpx", {
 			'version': "1.1",
 			'creator': "GPX Splitter",
@@ -131,7 +166,8 @@ class GpxWriter(xml.sax.saxutils.XMLGenerator):
 			})
 
 	def __del__(self):
-		self.endElementNL("gpx")
+		if not self.abandoned:
+			self.endElementNL("gpx")
 
 	def startElementNL(self, type, attrs={}):
 		self.startElement(type, attrs)
@@ -146,38 +182,42 @@ class GpxWriter(xml.sax.saxutils.XMLGenerator):
 		self.characters(text)
 		self.endElementNL(type)
 
-for filename in sys.argv[1:]:
-	print(filename)
-	#fh = open(filename, "r")
-	fh = gzip.open(filename, "r")
-
-	gpx = GpxReader(fh)
+output_dir = "Processed_Tracks"
+large_input_size = 0x4000000		# with -j, share out the tracks of files bigger than this
 
-	for trk in gpx.trks:
+# Work out the name of the file for a track and write it under a
+# temporary name made by adding temp_suffix. It is renamed once all
+# of the work is done so that the results do not depend on the order
+# in which the workers finish. Returns (filename, temp_filename,
+# datetime_code, catalog_entries, points) where catalog_entries is None
+# for noise.
+def write_trk(trk, temp_suffix):
+	datetime = trk[0][0].time
+	m = re.match('(\d\d\d\d)-(\d\d)-(\d\d)T', datetime)
+	assert m, "bad time: %s" % datetime
+	datetime_code = m.group(1) + m.group(2) + m.group(3)
+	trk.name = datetime_code
 
-		datetime = trk[0][0].time
-		print(datetime)
-		m = re.match('(\d\d\d\d)-(\d\d)-(\d\d)T', datetime)
-		assert m
-		datetime_code = m.group(1) + m.group(2) + m.group(3)
-		trk.name = datetime_code
+	bbox = trk.get_bbox()
+	bbox_width = (bbox.max_lon - bbox.min_lon)
+	bbox_height = (bbox.max_lat - bbox.min_lat)
 
-		bbox = trk.get_bbox()
-		bbox_width = (bbox.max_lon - bbox.min_lon)
-		bbox_height = (bbox.max_lat - bbox.min_lat)
+	if bbox_height > 0.0005 or bbox_width > 0.0005:
+		prefix = "track"
+	else:
+		prefix = "noise"
 
-		if bbox_height > 0.0005 or bbox_width > 0.0005:
-			prefix = "track"
-		else:
-			prefix = "noise"
-
-		filename = "Processed_Tracks/%s_%s_%f,%f,%f,%f.gpx.gz" % (
-			prefix,
-			datetime_code,
-			bbox.min_lon, bbox.min_lat, bbox.max_lon, bbox.max_lat,
-			)
-		print("Writing to %s..." % filename)
-		ofh = gzip.open(filename, "w")
+	filename = "%s/%s_%s_%f,%f,%f,%f.gpx.gz" % (
+		output_dir,
+		prefix,
+		datetime_code,
+		bbox.min_lon, bbox.min_lat, bbox.max_lon, bbox.max_lat,
+		)
+	temp_filename = filename + temp_suffix
+	ofh = None
+	writer = None
+	try:
+		ofh = io.TextIOWrapper(ParallelGzipFile(temp_filename, threads=gzip_threads), encoding="utf-8")
 		writer = GpxWriter(ofh)
 		writer.startElementNL('metadata', {})
 		writer.startElement('bounds', {
@@ -189,3 +229,266 @@ for filename in sys.argv[1:]:
 		writer.endElement('bounds')
 		writer.endElementNL('metadata')
 		trk.write(writer)
+		writer = None			# writes </gpx>
+		ofh.close()
+	except:
+		# Do not leave a partial file behind
+		try:
+			if writer is not None:
+				writer.abandoned = True
+				writer = None
+			if ofh is not None:
+				ofh.close()
+		except Exception:
+			pass
+		if os.path.exists(temp_filename):
+			os.unlink(temp_filename)
+		raise
+
+	catalog_entries = [trkseg.get_catalog_entry() for trkseg in trk] if prefix == "track" else None
+	points = sum(len(trkseg.points) for trkseg in trk)
+	return (filename, temp_filename, datetime_code, catalog_entries, points)
+
+def temp_suffix(input_index, trk_index):
+	return ".part-%d-%d" % (input_index, trk_index)
+
+# The jobs which are run in the worker processes (or in this one if
+# there is only one job at a time):
+#  ('file', input_index, filename) reads a file and writes its tracks
+#  ('track', input_index, (trk_index, trk)) writes one track of a big
+#      file which is being read in the main process
+# Returns (kind, input_index, trk_index, result, error). Errors are
+# caught and returned as messages so that one bad file does not stop
+# the others.
+def run_job(job):
+	kind, input_index, arg = job
+	trk_index = None
+	try:
+		if kind == 'file':
+			outputs = []
+			def on_trk(trk_index, trk):
+				outputs.append(write_trk(trk, temp_suffix(input_index, trk_index)))
+			try:
+				GpxReader(gzip.open(arg, "r"), on_trk)
+			except:
+				for output in outputs:
+					os.unlink(output[1])
+				raise
+			return (kind, input_index, None, outputs, None)
+		else:
+			trk_index, trk = arg
+			return (kind, input_index, trk_index, write_trk(trk, temp_suffix(input_index, trk_index)), None)
+	except Exception as e:
+		message = "%s: %s" % (e.__class__.__name__, str(e))
+		if trk_index is not None:
+			message = "track %d: %s" % (trk_index, message)
+		return (kind, input_index, trk_index, None, message)
+
+#=============================================================================
+# Run the jobs for a list of input files. Returns, for each, the outputs
+# of its tracks in order (None for a track which could not be written),
+# the error messages, and whether it could not be read at all.
+#=============================================================================
+
+def process_files(input_filenames):
+	file_outputs = [[] for filename in input_filenames]
+	file_errors = [[] for filename in input_filenames]
+	file_failed = [False for filename in input_filenames]
+
+	def job_done(kind, input_index, trk_index, result, error):
+		if error is not None:
+			file_errors[input_index].append(error)
+		elif kind == 'file':
+			file_outputs[input_index] = result
+		else:
+			file_outputs[input_index][trk_index] = result
+		if kind == 'file':
+			print(input_filenames[input_index])
+
+	def collect_jobs(pending, return_when):
+		done, pending = concurrent.futures.wait(pending, return_when=return_when)
+		for future in done:
+			job_done(*future.result())
+		return pending
+
+	if jobs < 2:
+		for input_index, filename in enumerate(input_filenames):
+			job_done(*run_job(('file', input_index, filename)))
+	else:
+		# Workers are started by forking so that they need not import this
+		# script, whose name is not a valid module name.
+		with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("fork")) as pool:
+			pending = set()
+			big_files = []
+			for input_index, filename in enumerate(input_filenames):
+				if os.path.getsize(filename) > large_input_size:
+					big_files.append((input_index, filename))
+				else:
+					pending.add(pool.submit(run_job, ('file', input_index, filename)))
+
+			# Big files are read here and their tracks handed to the workers
+			# as they are completed. So that the tracks do not pile up in
+			# memory, we wait whenever there are more than two jobs per
+			# worker outstanding.
+			def submit_trk(input_index, trk_index, trk):
+				nonlocal pending
+				file_outputs[input_index].append(None)
+				pending.add(pool.submit(run_job, ('track', input_index, (trk_index, trk))))
+				while len(pending) > jobs * 2:
+					pending = collect_jobs(pending, concurrent.futures.FIRST_COMPLETED)
+			for input_index, filename in big_files:
+				print(filename)
+				try:
+					GpxReader(gzip.open(filename, "r"), lambda trk_index, trk: submit_trk(input_index, trk_index, trk))
+				except Exception as e:
+					file_errors[input_index].append("%s: %s" % (e.__class__.__name__, str(e)))
+					file_failed[input_index] = True
+
+			collect_jobs(pending, concurrent.futures.ALL_COMPLETED)
+
+	return (file_outputs, file_errors, file_failed)
+
+# Delete output files (by name within output_dir) and drop them from the catalog
+def remove_outputs(catalog, output_filenames):
+	for output_filename in output_filenames:
+		print("Deleting %s..." % output_filename)
+		path = os.path.join(output_dir, output_filename)
+		if os.path.exists(path):
+			os.unlink(path)
+		catalog.remove_file(output_filename)
+
+# Input files may be named on the command line or found in directories
+# named on it.
+def find_inputs(args):
+	input_filenames = []
+	for arg in args:
+		if os.path.isdir(arg):
+			input_filenames.extend(sorted(glob.glob(os.path.join(arg, "*.gpx.gz"))))
+		else:
+			input_filenames.append(arg)
+	return input_filenames
+
+#=============================================================================
+# Make one pass over the input files. Those which are in the manifest
+# and have not changed are skipped (unless force is set). The outputs of
+# those which have been removed are deleted. Returns a list of errors.
+#=============================================================================
+
+def preprocess(args):
+	catalog = TrackCatalog(output_dir)
+	start_time = time.time()
+
+	input_filenames = []
+	identities = []
+	skipped = 0
+	for filename in find_inputs(args):
+		try:
+			identity, unchanged = catalog.check_input(filename)
+		except OSError as e:
+			print("%s: %s" % (filename, str(e)))
+			continue
+		if unchanged and not force:
+			skipped += 1
+		else:
+			input_filenames.append(filename)
+			identities.append(identity)
+
+	removed = 0
+	for filename in catalog.input_filenames():
+		if not os.path.exists(filename):
+			print("Removed: %s" % filename)
+			remove_outputs(catalog, catalog.remove_input(filename))
+			removed += 1
+	catalog.commit()
+
+	file_outputs, file_errors, file_failed = process_files(input_filenames)
+
+	# Put the output files in place and record them in the catalog in the
+	# order of the input files and the tracks in them. Inputs with errors
+	# are left out of the manifest so that they will be tried again.
+	total_tracks = 0
+	total_points = 0
+	errors = []
+	for input_index, filename in enumerate(input_filenames):
+		output_filenames = []
+		for output in file_outputs[input_index]:
+			if output is None:
+				continue
+			output_filename, temp_filename, datetime_code, catalog_entries, points = output
+			if file_failed[input_index]:
+				os.unlink(temp_filename)
+				continue
+			print("Writing to %s..." % output_filename)
+			os.replace(temp_filename, output_filename)
+			if catalog_entries is not None:
+				catalog.add_file(output_filename, datetime_code, catalog_entries)
+			output_filenames.append(output_filename)
+			total_tracks += 1
+			total_points += points
+		for error in file_errors[input_index]:
+			errors.append("%s: %s" % (filename, error))
+		if len(file_errors[input_index]) == 0:
+			remove_outputs(catalog, catalog.record_input(filename, identities[input_index], output_filenames))
+		catalog.commit()
+
+	catalog.close()
+
+	elapsed = time.time() - start_time
+	print("%d files (%d unchanged, %d removed), %d tracks, %d points in %.1f seconds (%d points per second)" % (
+		len(input_filenames),
+		skipped,
+		removed,
+		total_tracks,
+		total_points,
+		elapsed,
+		total_points / elapsed if elapsed > 0 else 0,
+		))
+
+	if len(errors) > 0:
+		sys.stderr.write("%d errors:\n" % len(errors))
+		for error in errors:
+			sys.stderr.write(" %s\n" % error)
+
+	return errors
+
+#=============================================================================
+# Parse command line
+#=============================================================================
+
+jobs = 1
+force = False		# process even unchanged inputs
+watch = None		# seconds between rescans
+args = sys.argv[1:]
+while len(args) >= 1 and args[0].startswith("-"):
+	opt = args.pop(0)
+	if opt == "-j" and len(args) >= 1:
+		jobs = int(args.pop(0))
+	elif opt.startswith("-j"):
+		jobs = int(opt[2:])
+	elif opt.startswith("--jobs="):
+		jobs = int(opt.split("=",1)[1])
+	elif opt == "--force":
+		force = True
+	elif opt == "--watch":
+		watch = 60
+	elif opt.startswith("--watch="):
+		watch = float(opt.split("=",1)[1])
+	else:
+		sys.stderr.write("Invalid option: %s\n" % opt)
+		sys.exit(1)
+
+# When the workers run in parallel each compresses with one thread.
+gzip_threads = None if jobs < 2 else 1
+
+if watch is None:
+	if len(preprocess(args)) > 0:
+		sys.exit(1)
+else:
+	# Rescan until interrupted. Only new and changed files are processed.
+	try:
+		while True:
+			preprocess(args)
+			force = False
+			time.sleep(watch)
+	except KeyboardInterrupt:
+		pass
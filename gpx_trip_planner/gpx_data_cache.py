@@ -0,0 +1,413 @@
+#=============================================================================
+# gpx_data_cache.py
+# Cache of parsed GPX files so that they can be reopened without parsing
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+import os
+import sys
+import time
+import struct
+import marshal
+import mmap
+import hashlib
+from array import array
+
+from gpx_data_gpx import GpxObjectList, GpxWaypoint, GpxRoute, GpxRoutePoint, GpxRouteShapePoint, \
+	GpxTrack, GpxTrackSegment, GpxMetadata, GpxPerson, GpxCopyright, GpxLink, GpxEmail
+
+#=============================================================================
+# When a GPX file is loaded thru the cache, the objects parsed from it
+# are written to a cache file. The next time the same file is loaded,
+# the objects are read back from the cache file without parsing the XML.
+#
+# The loading itself is done by the functions in gpx_data_loader.py.
+#
+# The cache files are named for the SHA-1 hash of the GPX file, so a
+# file which is copied or renamed can use the same cache file. The index
+# file records the path, size, and modification time of each GPX file
+# which we have seen together with its hash so that we do not have to
+# read a file which has not changed in order to find its cache file.
+# The index also records when each cache file was last used. When the
+# cache files take up more than max_size bytes, those which have gone
+# unused the longest are removed.
+#
+# A cache file starts with a header followed by the structure (the
+# waypoints, routes, tracks, and metadata as marshalled lists and tuples)
+# and then the point arrays of the track segments. The strings in the
+# structure are replaced by indexes into a table of strings so that
+# each distinct value (a symbol name, say) is stored only once. The
+# point arrays are stored just as they are in memory, so loading them
+# is a matter of copying them out of the memory-mapped file.
+#=============================================================================
+
+CACHE_MAGIC = b"GPXC"
+CACHE_VERSION = 1
+
+# magic, version, byte order, structure offset, structure length, arrays offset
+header_format = "<4sBBHIIQ"
+header_size = 24
+
+# Type codes of the four arrays in a GpxTrackSegment, in the order written
+segment_arrays = (('lats', 'd'), ('lons', 'd'), ('eles', 'f'), ('times', 'q'))
+
+# Return the size and modification time of a file
+def file_stat(filename):
+	st = os.stat(filename)
+	return (st.st_size, st.st_mtime_ns)
+
+# Return the size, modification time, and SHA-1 hash of a file.
+# This is what the cache index records.
+def file_identity(filename):
+	sha1 = hashlib.sha1()
+	with open(filename, "rb") as fh:
+		while True:
+			block = fh.read(0x100000)
+			if not block:
+				break
+			sha1.update(block)
+	return file_stat(filename) + (sha1.hexdigest(),)
+
+class GpxCache(object):
+	def __init__(self, directory, max_size):
+		self.directory = directory
+		self.max_size = max_size
+		self.index_filename = os.path.join(directory, "index")
+		self.debug = False
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		try:
+			with open(self.index_filename, "rb") as fh:
+				self.index = marshal.load(fh)
+			if self.index.get('version') != CACHE_VERSION:
+				raise ValueError("wrong version")
+		except Exception as e:
+			if os.path.exists(self.index_filename):
+				print("GPX cache index unusable:", str(e))
+			self.index = {'version':CACHE_VERSION, 'files':{}, 'used':{}}
+
+	# Return the objects from the cache for the GPX file or None if we
+	# do not have them. The GPX file is not read. It is found in the
+	# index and then only if it has not changed since it was recorded.
+	def lookup(self, filename):
+		entry = self.index['files'].get(os.path.abspath(filename))
+		if entry is not None and entry[:2] == file_stat(filename):
+			return self.fetch(entry[2])
+		return None
+
+	# Return the objects from the cache file for a GPX file with the
+	# indicated hash or None if there is no usable cache file.
+	def fetch(self, digest):
+		cache_filename = self.cache_filename(digest)
+		if os.path.exists(cache_filename):
+			try:
+				objects = self.read(cache_filename)
+				self.index['used'][digest] = time.time()
+				return objects
+			except Exception as e:
+				print("Cache file %s unusable: %s" % (cache_filename, str(e)))
+		return None
+
+	# Record the identity of a GPX file (as returned by file_identity())
+	# in the index. If objects is not None, they are what was parsed from
+	# it and we write them to a cache file. Instead of a GpxObjectList,
+	# objects can be a GpxCacheEncoder to which they have already been added.
+	def store(self, filename, identity, objects):
+		self.index['files'][os.path.abspath(filename)] = identity
+		digest = identity[2]
+		if objects is not None:
+			cache_filename = self.cache_filename(digest)
+			try:
+				if isinstance(objects, GpxCacheEncoder):
+					encoder = objects
+				else:
+					encoder = GpxCacheEncoder()
+					encoder.add(objects)
+					encoder.add_metadata(objects.metadata)
+				self.write(cache_filename, encoder)
+			except Exception as e:		# not all objects can be cached
+				print("Not caching %s: %s" % (filename, str(e)))
+				if os.path.exists(cache_filename + ".tmp"):
+					os.unlink(cache_filename + ".tmp")
+				return
+		self.index['used'][digest] = time.time()
+
+	# Remove expired cache files and write the index to disk
+	def sync(self):
+		self.expire()
+		self.save_index()
+
+	def cache_filename(self, digest):
+		return os.path.join(self.directory, digest + ".gpxc")
+
+	def save_index(self):
+		temp_filename = self.index_filename + ".tmp"
+		with open(temp_filename, "wb") as fh:
+			marshal.dump(self.index, fh)
+		os.replace(temp_filename, self.index_filename)
+
+	# Remove the least recently used cache files until the total size
+	# is no more than max_size.
+	def expire(self):
+		used = self.index['used']
+		sizes = {}
+		for digest in list(used.keys()):
+			try:
+				sizes[digest] = os.path.getsize(self.cache_filename(digest))
+			except OSError:
+				del used[digest]
+		total = sum(sizes.values())
+		for digest in sorted(sizes.keys(), key=lambda digest: used[digest]):
+			if total <= self.max_size:
+				break
+			if self.debug:
+				print("Expiring cache file %s" % digest)
+			os.unlink(self.cache_filename(digest))
+			total -= sizes[digest]
+			del used[digest]
+		files = self.index['files']
+		for filename in list(files.keys()):
+			if not files[filename][2] in used:
+				del files[filename]
+
+	# Remove all of the cache files
+	def clear(self):
+		for digest in list(self.index['used'].keys()):
+			try:
+				os.unlink(self.cache_filename(digest))
+			except OSError:
+				pass
+		self.index = {'version':CACHE_VERSION, 'files':{}, 'used':{}}
+		self.save_index()
+
+	#-------------------------------------------------------------
+	# Write a cache file
+	#-------------------------------------------------------------
+
+	# The encoder is a GpxCacheEncoder to which the objects have been added
+	def write(self, cache_filename, encoder):
+		structure = marshal.dumps((encoder.strings, (encoder.waypoints, encoder.routes, encoder.tracks, encoder.metadata)))
+
+		arrays_offset = (header_size + len(structure) + 7) & ~7
+		temp_filename = cache_filename + ".tmp"
+		with open(temp_filename, "wb") as fh:
+			fh.write(struct.pack(header_format, CACHE_MAGIC, CACHE_VERSION, ord(sys.byteorder[0]), 0,
+				header_size, len(structure), arrays_offset))
+			fh.write(structure)
+			fh.write(b"\0" * (arrays_offset - header_size - len(structure)))
+			for values in encoder.arrays:
+				fh.write(values)
+		os.replace(temp_filename, cache_filename)
+
+	#-------------------------------------------------------------
+	# Read a cache file and return a GpxObjectList
+	#-------------------------------------------------------------
+
+	def read(self, cache_filename):
+		with open(cache_filename, "rb") as fh:
+			mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			magic, version, byteorder, reserved, structure_offset, structure_length, arrays_offset \
+				= struct.unpack(header_format, mm[:header_size])
+			if magic != CACHE_MAGIC or version != CACHE_VERSION:
+				raise ValueError("not a cache file of this version")
+			if byteorder != ord(sys.byteorder[0]):
+				raise ValueError("wrong byte order")
+			strings, structure = marshal.loads(mm[structure_offset:structure_offset+structure_length])
+			with memoryview(mm) as view:
+				decoder = GpxCacheDecoder(strings, view, arrays_offset)
+				waypoints, routes, tracks, metadata = structure
+				objects = GpxObjectList()
+				objects.waypoints = [decoder.waypoint(item) for item in waypoints]
+				objects.routes = [decoder.route(item) for item in routes]
+				objects.tracks = [decoder.track(item) for item in tracks]
+				objects.metadata = decoder.metadata(metadata)
+		finally:
+			mm.close()
+		return objects
+
+#=============================================================================
+# Convert the objects to marshallable tuples
+#
+# Strings become indexes into self.strings. The compound objects
+# (links and so forth) become tuples which start with a letter
+# indicating their type. Values of any other type raise TypeError.
+#
+# If copy_arrays is True, the encoder keeps copies of the point arrays
+# rather than the arrays themselves. That is for when the objects
+# will be in use (and perhaps changed) before the cache file is written.
+#=============================================================================
+class GpxCacheEncoder(object):
+	def __init__(self, copy_arrays=False):
+		self.copy_arrays = copy_arrays
+		self.strings = []
+		self.string_index = {}
+		self.waypoints = []
+		self.routes = []
+		self.tracks = []
+		self.metadata = None
+		self.arrays = []
+		self.arrays_length = 0
+
+	# Encode the objects in a GpxObjectList. This can be called more
+	# than once to encode objects from the same file as they are parsed.
+	# If it raises TypeError, the encoder should be discarded.
+	def add(self, objects):
+		self.waypoints.extend([self.waypoint(point) for point in objects.waypoints])
+		self.routes.extend([self.route(route, points) for route, points in objects.routes])
+		self.tracks.extend([self.track(track) for track in objects.tracks])
+
+	def add_metadata(self, metadata):
+		if metadata is not None:
+			self.metadata = self.attributes(metadata, ('changes',))
+
+	def string(self, text):
+		index = self.string_index.get(text)
+		if index is None:
+			index = self.string_index[text] = len(self.strings)
+			self.strings.append(text)
+		return index
+
+	def value(self, value):
+		value_type = type(value)
+		if value_type is str:
+			return self.string(value)
+		if value is None or value_type is bool or value_type is float:
+			return value
+		if value_type is GpxLink:
+			return ('L', self.value(value.href), self.value(value.text), self.value(value.type))
+		if value_type is GpxPerson:
+			return ('P', self.value(value.name), self.value(value.email), self.value(value.link))
+		if value_type is GpxEmail:
+			return ('E', self.value(value.id), self.value(value.domain))
+		if value_type is GpxCopyright:
+			return ('C', self.value(value.author), self.value(value.year), self.value(value.license))
+		raise TypeError("can't cache %s" % value_type.__name__)
+
+	# Encode the attributes in an object's __dict__ other than those named.
+	def attributes(self, obj, skip):
+		return [(self.string(name), self.value(value)) for name, value in obj.__dict__.items() if not name in skip]
+
+	def point_children(self, point):
+		return [self.value(getattr(point, child_name)) for child_name in point.children]
+
+	def waypoint(self, point):
+		return (point.lat, point.lon, self.point_children(point), self.attributes(point, point.children))
+
+	def route(self, route, points):
+		return (
+			self.attributes(route, ('datastore', 'iter', 'points', 'store_busy', 'bbox')),
+			[(point.lat, point.lon, self.point_children(point), [(shape_point.lat, shape_point.lon) for shape_point in point.route_shape]) for point in points]
+			)
+
+	def track(self, track):
+		return (
+			self.attributes(track, ('datastore', 'segments', 'bbox')),
+			[self.segment(segment) for segment in track.segments]
+			)
+
+	def segment(self, segment):
+		if segment.lazy is not None:
+			raise TypeError("can't cache lazily-loaded track segments")
+		offset = self.arrays_length
+		for name, typecode in segment_arrays:
+			values = getattr(segment, name)
+			self.arrays.append(values.tobytes() if self.copy_arrays else values)
+			self.arrays_length += len(values) * values.itemsize
+		extras = []
+		for index, children in segment.extras.items():
+			extras.append((index, [(self.string(name), self.value(value)) for name, value in children.items()]))
+		return (len(segment), offset, self.value(segment.ele_format), segment.time_digits, extras)
+
+#=============================================================================
+# Convert the tuples back to objects
+#=============================================================================
+class GpxCacheDecoder(object):
+	def __init__(self, strings, view, arrays_offset):
+		self.strings = strings
+		self.view = view
+		self.arrays_offset = arrays_offset
+
+	def value(self, value):
+		value_type = type(value)
+		if value_type is int:
+			return self.strings[value]
+		if value_type is tuple:
+			kind = value[0]
+			if kind == 'L':
+				obj = GpxLink(self.value(value[1]))
+				obj.text = self.value(value[2])
+				obj.type = self.value(value[3])
+			elif kind == 'P':
+				obj = GpxPerson()
+				obj.name = self.value(value[1])
+				obj.email = self.value(value[2])
+				obj.link = self.value(value[3])
+			elif kind == 'E':
+				obj = GpxEmail(self.value(value[1]), self.value(value[2]))
+			elif kind == 'C':
+				obj = GpxCopyright(self.value(value[1]))
+				obj.year = self.value(value[2])
+				obj.license = self.value(value[3])
+			else:
+				raise ValueError("unknown object type %s" % kind)
+			return obj
+		return value
+
+	def attributes(self, obj, attributes):
+		for name, value in attributes:
+			setattr(obj, self.strings[name], self.value(value))
+
+	def point_children(self, point, children):
+		for child_name, value in zip(point.children, children):
+			setattr(point, child_name, self.value(value))
+
+	def waypoint(self, item):
+		lat, lon, children, attributes = item
+		point = GpxWaypoint(lat, lon)
+		self.point_children(point, children)
+		self.attributes(point, attributes)
+		return point
+
+	def route(self, item):
+		attributes, point_items = item
+		route = GpxRoute()
+		self.attributes(route, attributes)
+		points = []
+		for lat, lon, children, route_shape in point_items:
+			point = GpxRoutePoint(lat, lon)
+			self.point_children(point, children)
+			if len(route_shape) > 0:
+				point.route_shape = [GpxRouteShapePoint(shape_lat, shape_lon) for shape_lat, shape_lon in route_shape]
+			points.append(point)
+		return (route, points)
+
+	def track(self, item):
+		attributes, segment_items = item
+		track = GpxTrack()
+		self.attributes(track, attributes)
+		for segment_item in segment_items:
+			track.append(self.segment(segment_item))
+		return track
+
+	def segment(self, item):
+		length, offset, ele_format, time_digits, extras = item
+		segment = GpxTrackSegment()
+		offset += self.arrays_offset
+		for name, typecode in segment_arrays:
+			values = getattr(segment, name)
+			nbytes = length * values.itemsize
+			values.frombytes(self.view[offset:offset+nbytes])
+			offset += nbytes
+		segment.ele_format = self.value(ele_format)
+		segment.time_digits = time_digits
+		for index, children in extras:
+			segment.extras[index] = dict((self.strings[name], self.value(value)) for name, value in children)
+		return segment
+
+	def metadata(self, attributes):
+		if attributes is None:
+			return None
+		metadata = GpxMetadata()
+		self.attributes(metadata, attributes)
+		return metadata
@@ -0,0 +1,270 @@
+#=============================================================================
+# gpx_data_catalog.py
+# Catalog of the files written by gpx-track-preprocessor.py
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+import os
+import re
+import glob
+import gzip
+import hashlib
+import sqlite3
+
+#=============================================================================
+# The catalog is an Sqlite database kept in the directory with the
+# preprocessed track files. It records the date and number of points of
+# each file and the bounding box of each of its track segments. The
+# bounding boxes are kept in an R*Tree so that File->Import Preprocessed
+# Tracks can find the files which cross the map view without opening
+# the others. (If Sqlite was built without the R*Tree module, they go
+# into an ordinary table which answers the same queries, only slower.)
+#
+# File names are recorded relative to the directory so that it can be
+# moved. gpx-track-preprocessor.py adds the files as it writes them.
+# Files written by older versions (which recorded the bounding box only
+# in the file name) are added by sync() the first time it sees them.
+#
+# The catalog also serves gpx-track-preprocessor.py as a manifest of the
+# input files it has processed. For each (by absolute path) it records
+# the size, modification time, and SHA-1 hash and the names of the
+# output files it produced so that unchanged inputs can be skipped and
+# the outputs of changed or removed inputs can be deleted.
+#=============================================================================
+
+CATALOG_FILENAME = "catalog.sqlite"
+
+class TrackCatalog(object):
+	def __init__(self, directory):
+		self.directory = directory
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		self.conn = sqlite3.connect(os.path.join(directory, CATALOG_FILENAME))
+		cursor = self.conn.cursor()
+		cursor.execute("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, filename TEXT UNIQUE, date TEXT, points INTEGER)")
+		cursor.execute("CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, file_id INTEGER, date TEXT, points INTEGER)")
+		cursor.execute("CREATE INDEX IF NOT EXISTS segments_file_id on segments (file_id)")
+		cursor.execute("CREATE TABLE IF NOT EXISTS inputs (id INTEGER PRIMARY KEY, filename TEXT UNIQUE, size INTEGER, mtime_ns INTEGER, sha1 TEXT)")
+		cursor.execute("CREATE INDEX IF NOT EXISTS inputs_sha1 on inputs (sha1)")
+		cursor.execute("CREATE TABLE IF NOT EXISTS outputs (input_id INTEGER, filename TEXT)")
+		cursor.execute("CREATE INDEX IF NOT EXISTS outputs_input_id on outputs (input_id)")
+		cursor.execute("CREATE INDEX IF NOT EXISTS outputs_filename on outputs (filename)")
+		try:
+			cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS segment_bboxes USING rtree(id, min_lon, max_lon, min_lat, max_lat)")
+		except sqlite3.OperationalError:
+			cursor.execute("CREATE TABLE IF NOT EXISTS segment_bboxes (id INTEGER PRIMARY KEY, min_lon FLOAT, max_lon FLOAT, min_lat FLOAT, max_lat FLOAT)")
+		self.conn.commit()
+
+	def close(self):
+		self.conn.commit()
+		self.conn.close()
+		self.conn = None
+
+	def commit(self):
+		self.conn.commit()
+
+	# Record a file (replacing any previous record of it). Segments is
+	# a list of (bbox, date, points) where bbox is (min_lon, min_lat,
+	# max_lon, max_lat) and date is that of the first point.
+	def add_file(self, filename, date, segments):
+		self.remove_file(filename)
+		cursor = self.conn.cursor()
+		cursor.execute(
+			"INSERT INTO files (filename, date, points) values (?, ?, ?)",
+			(os.path.basename(filename), date, sum(segment[2] for segment in segments))
+			)
+		file_id = cursor.lastrowid
+		for (min_lon, min_lat, max_lon, max_lat), segment_date, points in segments:
+			if points == 0:
+				continue
+			cursor.execute("INSERT INTO segments (file_id, date, points) values (?, ?, ?)", (file_id, segment_date, points))
+			cursor.execute(
+				"INSERT INTO segment_bboxes (id, min_lon, max_lon, min_lat, max_lat) values (?, ?, ?, ?, ?)",
+				(cursor.lastrowid, min_lon, max_lon, min_lat, max_lat)
+				)
+
+	def remove_file(self, filename):
+		cursor = self.conn.cursor()
+		cursor.execute("SELECT id FROM files WHERE filename = ?", (os.path.basename(filename),))
+		row = cursor.fetchone()
+		if row is not None:
+			file_id = row[0]
+			cursor.execute("DELETE FROM segment_bboxes WHERE id IN (SELECT id FROM segments WHERE file_id = ?)", (file_id,))
+			cursor.execute("DELETE FROM segments WHERE file_id = ?", (file_id,))
+			cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+	# Return the names of the cataloged files
+	def filenames(self):
+		cursor = self.conn.cursor()
+		cursor.execute("SELECT filename FROM files")
+		return [row[0] for row in cursor]
+
+	# Return the full paths of the files with at least one segment
+	# whose bounding box overlaps bbox (a pykarta BoundingBox), in the
+	# order of their dates.
+	def find(self, bbox):
+		cursor = self.conn.cursor()
+		cursor.execute(
+			"SELECT DISTINCT files.filename, files.date FROM segment_bboxes "
+			"JOIN segments ON segments.id = segment_bboxes.id "
+			"JOIN files ON files.id = segments.file_id "
+			"WHERE segment_bboxes.max_lon >= ? AND segment_bboxes.min_lon <= ? "
+			"AND segment_bboxes.max_lat >= ? AND segment_bboxes.min_lat <= ? "
+			"ORDER BY files.date, files.filename",
+			(bbox.min_lon, bbox.max_lon, bbox.min_lat, bbox.max_lat)
+			)
+		return [os.path.join(self.directory, row[0]) for row in cursor]
+
+	# Bring the catalog up to date with the track files in the
+	# directory: forget those which have been deleted and scan those
+	# which are not yet in it. Progress, if supplied, is called with
+	# (count, total) as the files are scanned.
+	def sync(self, progress=None):
+		on_disk = set(os.path.basename(filename) for filename in glob.glob(os.path.join(self.directory, "track_*.gpx.gz")))
+		cataloged = set(self.filenames())
+		for filename in cataloged - on_disk:
+			self.remove_file(filename)
+		missing = sorted(on_disk - cataloged)
+		count = 0
+		for filename in missing:
+			if progress is not None:
+				progress(count, len(missing))
+			print("Cataloging %s..." % filename)
+			m = filename_date_pattern.match(filename)
+			self.add_file(filename, m.group(1) if m else None, scan_track_file(os.path.join(self.directory, filename)))
+			count += 1
+		self.conn.commit()
+
+	#-------------------------------------------------------------------
+	# The manifest of input files
+	#-------------------------------------------------------------------
+
+	# Return the names of the input files in the manifest
+	def input_filenames(self):
+		cursor = self.conn.cursor()
+		cursor.execute("SELECT filename FROM inputs ORDER BY filename")
+		return [row[0] for row in cursor]
+
+	# Return (identity, unchanged) for an input file where identity is
+	# (size, mtime_ns, sha1) and unchanged is True if it has already been
+	# processed. The file is hashed only if its size or modification time
+	# differ from those in the manifest. If it has been touched but not
+	# changed, or renamed, the manifest is brought up to date.
+	def check_input(self, filename):
+		filename = os.path.abspath(filename)
+		st = os.stat(filename)
+		cursor = self.conn.cursor()
+		cursor.execute("SELECT size, mtime_ns, sha1 FROM inputs WHERE filename = ?", (filename,))
+		row = cursor.fetchone()
+		if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+			return (row, True)
+		identity = (st.st_size, st.st_mtime_ns, file_sha1(filename))
+		if row is not None and row[2] == identity[2]:
+			cursor.execute("UPDATE inputs SET size = ?, mtime_ns = ? WHERE filename = ?", identity[:2] + (filename,))
+			return (identity, True)
+		if row is None:
+			cursor.execute("SELECT id, filename FROM inputs WHERE sha1 = ?", (identity[2],))
+			for input_id, old_filename in cursor.fetchall():
+				if not os.path.exists(old_filename):
+					cursor.execute("UPDATE inputs SET filename = ?, size = ?, mtime_ns = ? WHERE id = ?", (filename,) + identity[:2] + (input_id,))
+					return (identity, True)
+		return (identity, False)
+
+	# Record the outputs produced from an input file. Returns those which
+	# it produced last time, but not this time, and which no other input
+	# produced. The caller should delete them.
+	def record_input(self, filename, identity, outputs):
+		old_outputs = self._remove_input(filename)
+		cursor = self.conn.cursor()
+		cursor.execute(
+			"INSERT INTO inputs (filename, size, mtime_ns, sha1) values (?, ?, ?, ?)",
+			(os.path.abspath(filename),) + tuple(identity)
+			)
+		input_id = cursor.lastrowid
+		outputs = [os.path.basename(output) for output in outputs]
+		for output in outputs:
+			cursor.execute("INSERT INTO outputs (input_id, filename) values (?, ?)", (input_id, output))
+		return self._unreferenced([output for output in old_outputs if not output in outputs])
+
+	# Forget an input file which has been removed. Returns its outputs
+	# which no other input produced. The caller should delete them.
+	def remove_input(self, filename):
+		return self._unreferenced(self._remove_input(filename))
+
+	def _remove_input(self, filename):
+		cursor = self.conn.cursor()
+		cursor.execute("SELECT id FROM inputs WHERE filename = ?", (os.path.abspath(filename),))
+		row = cursor.fetchone()
+		if row is None:
+			return []
+		cursor.execute("SELECT filename FROM outputs WHERE input_id = ?", (row[0],))
+		outputs = [output_row[0] for output_row in cursor.fetchall()]
+		cursor.execute("DELETE FROM outputs WHERE input_id = ?", (row[0],))
+		cursor.execute("DELETE FROM inputs WHERE id = ?", (row[0],))
+		return outputs
+
+	def _unreferenced(self, outputs):
+		cursor = self.conn.cursor()
+		unreferenced = []
+		for output in outputs:
+			cursor.execute("SELECT 1 FROM outputs WHERE filename = ? LIMIT 1", (output,))
+			if cursor.fetchone() is None:
+				unreferenced.append(output)
+		return unreferenced
+
+def file_sha1(filename):
+	sha1 = hashlib.sha1()
+	with open(filename, "rb") as fh:
+		while True:
+			block = fh.read(0x100000)
+			if not block:
+				break
+			sha1.update(block)
+	return sha1.hexdigest()
+
+#=============================================================================
+# Read a file written by gpx-track-preprocessor.py and return its
+# segments as TrackCatalog.add_file() wants them. As in the old
+# import code, we cheat and search the lines with regular expressions
+# rather than parsing the XML since we know how the file was written.
+#=============================================================================
+
+# track_20080805_44.766400,-68.710580,44.319430,-68.177950.gpx.gz
+filename_date_pattern = re.compile('track_(\\d\\d\\d\\d\\d\\d\\d\\d)_')
+trkseg_pattern = re.compile('<trkseg>')
+point_pattern = re.compile('<trkpt lat="([0-9\\.eE-]+)" lon="([0-9\\.eE-]+)">')
+time_pattern = re.compile('<time>([^<]*)</time>')
+
+def scan_track_file(filename):
+	segments = []
+	bbox = None
+	segment_date = None
+	points = 0
+	with gzip.open(filename, "rt", encoding="utf-8") as fh:
+		for line in fh:
+			m = point_pattern.search(line)
+			if m:
+				lat = float(m.group(1))
+				lon = float(m.group(2))
+				if bbox is None:
+					bbox = [lon, lat, lon, lat]
+				else:
+					bbox[0] = min(bbox[0], lon)
+					bbox[1] = min(bbox[1], lat)
+					bbox[2] = max(bbox[2], lon)
+					bbox[3] = max(bbox[3], lat)
+				points += 1
+				continue
+			if segment_date is None:
+				m = time_pattern.search(line)
+				if m:
+					segment_date = m.group(1)
+					continue
+			if trkseg_pattern.search(line) and points > 0:
+				segments.append((tuple(bbox), segment_date, points))
+				bbox = None
+				segment_date = None
+				points = 0
+	if points > 0:
+		segments.append((tuple(bbox), segment_date, points))
+	return segments
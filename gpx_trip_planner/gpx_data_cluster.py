@@ -0,0 +1,85 @@
+#=============================================================================
+# gpx_data_cluster.py
+# Group nearby points for display at low zoom levels
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+import math
+
+from gpx_projection import project_to_tilespace_arrays
+
+#=============================================================================
+# ClusterIndex divides the world at each zoom level from 0 thru max_zoom
+# into square cells of cell_size pixels and counts the points in each.
+# The points in a cell are drawn as a single cluster (unless there is
+# only one). A cell at zoom z is made of four cells at zoom z+1, so the
+# levels are built from the most detailed one up by halving the cell
+# numbers. The index must be rebuilt when the points change.
+#
+# Each cell is [count, sum of x, sum of y, member] where x and y are in
+# tilespace at zoom 0 and member is the position of the point in the
+# list given to the constructor if count is 1, otherwise None.
+#=============================================================================
+
+class ClusterIndex(object):
+	cell_size = 64
+
+	def __init__(self, points, max_zoom):
+		self.max_zoom = max_zoom
+		self.levels = [None] * (max_zoom + 1)
+		xs, ys = project_to_tilespace_arrays([point.lat for point in points], [point.lon for point in points])
+		scale = self.scale(max_zoom)
+		floor = math.floor
+		level = {}
+		for i in range(len(xs)):
+			x = xs[i]
+			y = ys[i]
+			key = (int(floor(x * scale)), int(floor(y * scale)))
+			cell = level.get(key)
+			if cell is None:
+				level[key] = [1, x, y, i]
+			else:
+				cell[0] += 1
+				cell[1] += x
+				cell[2] += y
+				cell[3] = None
+		self.levels[max_zoom] = level
+		for zoom in range(max_zoom - 1, -1, -1):
+			parent_level = {}
+			for (col, row), (count, sum_x, sum_y, member) in level.items():
+				key = (col >> 1, row >> 1)
+				cell = parent_level.get(key)
+				if cell is None:
+					parent_level[key] = [count, sum_x, sum_y, member]
+				else:
+					cell[0] += count
+					cell[1] += sum_x
+					cell[2] += sum_y
+					cell[3] = None
+			self.levels[zoom] = parent_level
+			level = parent_level
+
+	# Cells per unit of tilespace at zoom 0
+	def scale(self, zoom):
+		return 256.0 * 2 ** zoom / self.cell_size
+
+	# Return a list of (count, x, y, member) for the cells at zoom which
+	# overlap the indicated area of tilespace. X and y are the centroid
+	# of the points in the cell.
+	def find(self, zoom, x_min, y_min, x_max, y_max):
+		level = self.levels[max(0, min(zoom, self.max_zoom))]
+		scale = self.scale(max(0, min(zoom, self.max_zoom)))
+		col_min = int(math.floor(x_min * scale))
+		col_max = int(math.floor(x_max * scale))
+		row_min = int(math.floor(y_min * scale))
+		row_max = int(math.floor(y_max * scale))
+		if (col_max - col_min + 1) * (row_max - row_min + 1) > len(level):
+			cells = [cell for key, cell in level.items() if col_min <= key[0] <= col_max and row_min <= key[1] <= row_max]
+		else:
+			cells = []
+			for col in range(col_min, col_max + 1):
+				for row in range(row_min, row_max + 1):
+					cell = level.get((col, row))
+					if cell is not None:
+						cells.append(cell)
+		return [(count, sum_x / count, sum_y / count, member) for count, sum_x, sum_y, member in cells]
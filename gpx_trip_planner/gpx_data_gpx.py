@@ -2,14 +2,24 @@
 
 from gi.repository import Gtk
 from gi.repository import GObject
-import xml.sax
+import sys
+import xml.parsers.expat
 import xml.sax.saxutils
-import math
+import contextlib
+import operator
+import itertools
+import bisect
+import io
+import time
+import calendar
+import datetime
+from array import array
 
 import pykarta.geometry
-import pykarta.geometry.simplify
 from pykarta.geometry.projection import project_to_tilespace
 
+from gpx_data_treemodel import GpxTrackTreeModel
+
 #=============================================================================
 # GPX format support
 #
@@ -27,36 +37,60 @@ from pykarta.geometry.projection import project_to_tilespace
 #
 # Be careful! This code is somewhat fragile due to the way it stores
 # Python objects in Gtk.ListStores and Gtk.TreeStores. Watch out for
-# the tree iters.
+# the tree iters. (Tracks are the exception. See gpx_data_treemodel.py.)
 #=============================================================================
 
 #=============================================================================
 # Base types for types in a GPX file
 #=============================================================================
 
+# Children which tend to have the same few values over and over. GpxLoader
+# interns them so that each distinct value is stored only once.
+interned_children = frozenset(['sym', 'type', 'src', 'gpxx:DisplayColor'])
+
 # A GPX way, route, or track point
+#
+# The children which most points have get slots. The rest have class-level
+# defaults. If one of them is set, it goes into the instance's __dict__
+# which Python does not create until then. So a typical point costs no
+# more than its slots.
 class GpxPoint(object):
 	children =                ['ele', 'time', 'name', 'cmt', 'desc', 'src', 'link', 'sym', 'type']
-	__slots__ = ['lat', 'lon', 'ele', 'time', 'name', 'cmt', 'desc', 'src', 'link', 'sym', 'type']
-	def __init__(self, *args):
-		for child_name in self.children:
-			setattr(self, child_name, "")
-		self.link = None
-
-		if len(args) == 2:				# GpxPoint(lat, lon)
-			self.lat, self.lon = args
-		elif len(args) == 1:			# GpxPoint(template_point)
-			source = args[0]
-			self.lat = source.lat
-			self.lon = source.lon
-			for child_name in self.children:
-				setattr(self, child_name, getattr(source, child_name))
-
-			# for GpxRoutePoint
-			if hasattr(source, "route_shape"):
-				self.route_shape = source.route_shape
+	__slots__ = ['lat', 'lon', 'ele', 'time', 'name', 'sym', 'type', '__dict__']
+	cmt = ""
+	desc = ""
+	src = ""
+	link = None
+
+	# GpxPoint(lat, lon, ...) or GpxPoint(template_point)
+	def __init__(self, lat, lon=None, ele="", time="", name="", sym="", type=""):
+		if lon is None:
+			self.copy_from(lat)
 		else:
-			raise TypeError
+			self.lat = lat
+			self.lon = lon
+			self.ele = ele
+			self.time = time
+			self.name = name
+			self.sym = sym
+			self.type = type
+
+	def copy_from(self, source):
+		self.lat = source.lat
+		self.lon = source.lon
+		self.ele = source.ele
+		self.time = source.time
+		self.name = source.name
+		self.sym = source.sym
+		self.type = source.type
+		for child_name in ('cmt', 'desc', 'src', 'link'):
+			value = getattr(source, child_name)
+			if value != getattr(type(self), child_name):
+				setattr(self, child_name, value)
+
+		# for GpxRoutePoint
+		if hasattr(source, "route_shape") and len(source.route_shape) > 0:
+			self.route_shape = source.route_shape
 
 	# This is what allows old functions to consume these objects.
 	def __getitem__(self, index):
@@ -68,20 +102,7 @@ class GpxPoint(object):
 			raise IndexError
 
 	def write(self, writer, point_type="wpt"):
-		writer.startElementNL(point_type, {'lat': repr(self.lat), 'lon': repr(self.lon)})
-
-		for i in self.children:
-			value = getattr(self, i)
-			if i == "link":				# FIXME: should be true if i is an object
-				if value is not None:
-					value.write(writer)
-			elif value != "":
-				writer.characters(" ")
-				writer.simpleTextElement(i, value)
-
-		self.write_extensions(writer)
-
-		writer.endElementNL(point_type)
+		writer.write_point(self, point_type)
 
 	def write_extensions(self, writer):
 		pass
@@ -197,18 +218,37 @@ class GpxToplevelList(object):
 
 		self._selected = None		# path of selected row
 		self.changes = False		# are their unsaved changes?
+		self.version = 0			# incremented on every change to the rows
+
+		self._bulk = 0				# nesting depth of begin_bulk()
+		self._bulk_changes = False	# rows changed or inserted during bulk update
+		self._bulk_deletes = False	# rows deleted during bulk update
+
+		self._rtree = None			# spatial index, see find_in_bbox()
+		self._rtree_order = None	# object -> index
+		self._rtree_dirty = set()	# objects whose bounding boxes may have changed
 
 		self.datastore.connect("row-changed", self.row_changed_cb)
 		self.datastore.connect("row-deleted", self.row_deleted_cb)
+		self.datastore.connect("row-inserted", self.row_inserted_cb)
 
 	# Called on changes to the Gtk.ListStore or Gtk.TreeStore
 	def row_changed_cb(self, treemodel, path, iter):
+		self.version += 1
 
 		# Container objects have a iter property which must be set.
 		obj = self.datastore.get_value(iter, 0)
 		if hasattr(obj, 'iter'):
 			obj.iter = treemodel.get_iter(path)		# supplied iter is temporary
 
+		# Let end_bulk() tell the clients.
+		if self._bulk:
+			self._bulk_changes = True
+			self._rtree = None
+			return
+
+		self._rtree_changed(path)
+
 		# Map layer may want to move point.
 		try:
 			self._clients['map_layer'].set_stale()
@@ -220,6 +260,15 @@ class GpxToplevelList(object):
 
 	# The case of a deleted row is simpler.
 	def row_deleted_cb(self, treemodel, path):
+		self.version += 1
+		if self._bulk:
+			self._bulk_deletes = True
+			self._rtree = None
+			return
+		if len(path.get_indices()) == 1:		# indexes of later objects change
+			self._rtree = None
+		else:
+			self._rtree_changed(path)
 		self.select(None, "del()")
 		try:
 			self._clients['map_layer'].set_stale()
@@ -227,6 +276,55 @@ class GpxToplevelList(object):
 			pass
 		self.changes = True
 
+	# Newer versions of PyGObject announce appended rows only thru
+	# row-inserted. Outside of a bulk update we leave it to the
+	# row-changed which the caller sends by calling touch().
+	def row_inserted_cb(self, treemodel, path, iter):
+		self.version += 1
+		if self._bulk:
+			self._bulk_changes = True
+			self._rtree = None
+		else:
+			self._rtree_changed(path)
+
+	# Call these around a large number of changes (such as loading a file).
+	# Clients which have an on_bulk_begin() method are told so that they
+	# can disconnect themselves from the datastore (as a Gtk.TreeView
+	# should). Notification of the changes is held back until the
+	# matching end_bulk() and then sent once. Calls may be nested.
+	def begin_bulk(self):
+		if self._bulk == 0:
+			self._bulk_changes = False
+			self._bulk_deletes = False
+			for client_obj in list(self._clients.values()):
+				if hasattr(client_obj, "on_bulk_begin"):
+					client_obj.on_bulk_begin()
+		self._bulk += 1
+
+	def end_bulk(self):
+		self._bulk -= 1
+		if self._bulk == 0:
+			for client_obj in list(self._clients.values()):
+				if hasattr(client_obj, "on_bulk_end"):
+					client_obj.on_bulk_end()
+			if self._bulk_deletes:
+				self.select(None, "del()")
+			if self._bulk_changes or self._bulk_deletes:
+				try:
+					self._clients['map_layer'].set_stale()
+				except KeyError:
+					pass
+				self.changes = True
+
+	# The same thing for use in a with statement
+	@contextlib.contextmanager
+	def bulk(self):
+		self.begin_bulk()
+		try:
+			yield self
+		finally:
+			self.end_bulk()
+
 	# Add a client which wants to be informed of changes to the selection.
 	def add_client(self, client_name, client_function):
 		self._clients[client_name] = client_function
@@ -235,7 +333,49 @@ class GpxToplevelList(object):
 	def clear(self):
 		self.select(None, "clear()")
 		self.datastore.clear()
+		self._rtree = None
 		self.changes = False
+		self.version += 1
+
+	# Return a list of (index, object) for the top-level objects whose
+	# bounding boxes overlap bbox in the order in which they appear in
+	# the list. This uses an R-tree which is built the first time it is
+	# needed and then kept up to date by the row callbacks above. When
+	# an object changes, it is noted in self._rtree_dirty and its entry
+	# is updated at the next call. (When a row is inserted its Python
+	# object may not yet be fully connected to the datastore.) Bulk
+	# updates and deletion of top-level objects discard the tree.
+	def find_in_bbox(self, bbox):
+		from gpx_data_rtree import RTree, bbox_to_box
+		if self._rtree is None:
+			objs = list(self)
+			self._rtree = RTree([(box, obj) for box, obj in [(bbox_to_box(obj.get_bbox()), obj) for obj in objs] if box is not None])
+			self._rtree_order = dict([(objs[i], i) for i in range(len(objs))])
+			self._rtree_dirty = set()
+		elif self._rtree_dirty:
+			for obj in self._rtree_dirty:
+				box = bbox_to_box(obj.get_bbox())
+				if box is not None:
+					self._rtree.insert(obj, box)
+				else:
+					self._rtree.remove(obj)
+			self._rtree_dirty = set()
+		box = bbox_to_box(bbox)
+		if box is None:
+			return []
+		order = self._rtree_order
+		return sorted([(order[obj], obj) for obj in self._rtree.search(box)], key=lambda item: item[0])
+
+	def _rtree_changed(self, path):
+		if self._rtree is not None:
+			indices = path.get_indices()
+			obj = self[indices[0]]
+			if len(indices) == 1 and not obj in self._rtree_order:		# new object
+				if indices[0] != len(self) - 1:		# not at end
+					self._rtree = None
+					return
+				self._rtree_order[obj] = indices[0]
+			self._rtree_dirty.add(obj)
 
 	# Select a member object in the GUI.
 	# Path should be None to cancel the selection.
@@ -275,7 +415,7 @@ class GpxToplevelList(object):
 class GpxToplevelListofLists(GpxToplevelList):
 	def append(self, child):
 		child.datastore = self.datastore
-		self.datastore.append(None, [child])
+		child.iter = self.datastore.append(None, [child])
 	def write(self, writer):
 		for child in self:
 			child.write(writer)
@@ -353,9 +493,10 @@ class GpxWaypoints(GpxToplevelList):
 			poi.write(writer, "wpt")
 
 class GpxWaypoint(GpxPoint):
-	def __init__(self, *args):
-		GpxPoint.__init__(self, *args)
-		self.gpxtp_show = True
+	__slots__ = ['bbox']
+	gpxtp_show = True
+	def __init__(self, *args, **kwargs):
+		GpxPoint.__init__(self, *args, **kwargs)
 		self.bbox = None
 	def write_extensions(self, writer):
 		if not self.gpxtp_show:
@@ -387,6 +528,43 @@ class GpxRoutes(GpxToplevelListofLists):
 	def append(self, child):
 		GpxToplevelListofLists.append(self, child)
 		self.picklist.append([child.name])
+		if len(child.points) > 0:		# points added before the route was
+			child._store_insert(0, child.points)
+
+	# GpxRoute keeps its own list of points. These keep it in step with
+	# changes made directly to the tree store, such as by drag-and-drop
+	# in the treeview or by deleting a point by path. Changes made by
+	# GpxRoute's own methods are skipped. When a row is dragged, the new
+	# row is inserted empty (row-inserted), filled in (row-changed), and
+	# then the old row is removed (row-deleted). When a whole route is
+	# dragged, its points are copied under the new row, so the number of
+	# rows tells us whether the list already has them.
+	def row_inserted_cb(self, treemodel, path, iter):
+		indices = path.get_indices()
+		if len(indices) == 2:
+			route = self[indices[0]]
+			if not route.store_busy and len(route.points) < treemodel.iter_n_children(route.iter):
+				route.points.insert(indices[1], treemodel.get_value(iter, 0))
+				route.bbox = None
+		GpxToplevelListofLists.row_inserted_cb(self, treemodel, path, iter)
+
+	def row_changed_cb(self, treemodel, path, iter):
+		indices = path.get_indices()
+		if len(indices) == 2:
+			route = self[indices[0]]
+			if not route.store_busy and indices[1] < len(route.points):
+				route.points[indices[1]] = treemodel.get_value(iter, 0)
+				route.bbox = None
+		GpxToplevelListofLists.row_changed_cb(self, treemodel, path, iter)
+
+	def row_deleted_cb(self, treemodel, path):
+		indices = path.get_indices()
+		if len(indices) == 2:
+			route = self[indices[0]]
+			if not route.store_busy and len(route.points) > treemodel.iter_n_children(route.iter):
+				del route.points[indices[1]]
+				route.bbox = None
+		GpxToplevelListofLists.row_deleted_cb(self, treemodel, path)
 
 	def touch(self, path):
 		GpxToplevelListofLists.touch(self, path)
@@ -407,6 +585,12 @@ class GpxRoutes(GpxToplevelListofLists):
 			del self.picklist[path[0]+1]
 
 # A single route (which contains of GpxRoutePoint objects)
+#
+# The points are kept in the list self.points, so indexing is quick.
+# The rows under self.iter in the Gtk.TreeStore are a view of the list
+# for the treeview. The methods below change both. (GpxRoutes copies
+# changes made directly to the tree store into the list.) Tools which
+# rework a whole route should build a new list and pass it to replace().
 class GpxRoute(object):
 	children = ['name', 'cmt', 'desc', 'src', 'link', 'number', 'type']
 	def __init__(self):
@@ -414,30 +598,71 @@ class GpxRoute(object):
 		self.iter = None			# set by parent
 		for child_name in self.children:
 			setattr(self, child_name, "")
+		self.points = []
+		self.store_busy = False		# True while we are changing the tree store
 		self.bbox = None
 		self.gpxtp_show = True
 		self.gpxx_DisplayColor = ""
 	def __iter__(self):
-		iter = self.datastore.iter_children(self.iter)
-		while iter is not None:
-			yield self.datastore.get_value(iter, 0)
-			iter = self.datastore.iter_next(iter)
+		return iter(self.points)
 	def __getitem__(self, index):
-		iter = self.datastore.iter_nth_child(self.iter, index)
-		return self.datastore.get_value(iter, 0)
+		return self.points[index]
 	def __len__(self):
-		return self.datastore.iter_n_children(self.iter)
+		return len(self.points)
 	def append(self, point):
-		self.datastore.append(self.iter, [point])
-		self.bbox = None
+		self.insert(len(self.points), point)
+	def extend(self, points):
+		points = list(points)
+		index = len(self.points)
+		self.points.extend(points)
+		self._store_insert(index, points)
+		if self.bbox is not None:
+			for point in points:
+				self.bbox.add_point(point)
 	def __delitem__(self, index):
-		iter = self.datastore.iter_nth_child(self.iter, index)
-		self.datastore.remove(iter)
-		self.bbox = None
+		if index < 0:
+			index += len(self.points)
+		point = self.points.pop(index)
+		if self.datastore is not None:
+			self.store_busy = True
+			try:
+				self.datastore.remove(self.datastore.iter_nth_child(self.iter, index))
+			finally:
+				self.store_busy = False
+		if self.bbox is not None and _on_bbox_edge(self.bbox, point.lat, point.lon):
+			self.bbox = None
 	def insert(self, index, item):
-		iter = self.datastore.iter_nth_child(self.iter, index)
-		self.datastore.insert_before(self.iter, iter, [item])
+		self.points.insert(index, item)
+		self._store_insert(index, [item])
+		if self.bbox is not None:
+			self.bbox.add_point(item)
+	# Replace all of the points
+	def replace(self, points):
+		self.points = list(points)
 		self.bbox = None
+		if self.datastore is not None:
+			self.store_busy = True
+			try:
+				while True:
+					iter = self.datastore.iter_children(self.iter)
+					if iter is None:
+						break
+					self.datastore.remove(iter)
+			finally:
+				self.store_busy = False
+			self._store_insert(0, self.points)
+	# Add rows for points to the tree store starting at index. Each is
+	# inserted after the last, since finding the end of the list of
+	# children in a Gtk.TreeStore takes time.
+	def _store_insert(self, index, points):
+		if self.datastore is not None:
+			self.store_busy = True
+			try:
+				sibling = self.datastore.iter_nth_child(self.iter, index - 1) if index > 0 else None
+				for point in points:
+					sibling = self.datastore.insert_after(self.iter, sibling, [point])
+			finally:
+				self.store_busy = False
 	def write(self, writer):
 		writer.startElementNL("rte")
 		for i in self.children:
@@ -464,10 +689,8 @@ class GpxRoute(object):
 		return self.bbox
 
 class GpxRoutePoint(GpxPoint):
-	__slots__ = ['route_shape']
-	def __init__(self, *args):
-		GpxPoint.__init__(self, *args)
-		self.route_shape = []
+	__slots__ = []
+	route_shape = ()		# replaced with a list if there is a shape
 	def write_extensions(self, writer):
 		if len(self.route_shape) > 0:
 			writer.startElementNL("extensions", {})
@@ -485,41 +708,45 @@ class GpxRouteShapePoint(object):
 		self.lat = lat
 		self.lon = lon
 
+# The tracks are not kept in a Gtk.TreeStore since it would need a row
+# for every track point. Instead the GpxTrackTreeModel holds the list
+# of tracks and presents them to the Gtk.TreeView.
 class GpxTracks(GpxToplevelListofLists):
 	def __init__(self):
-		self.datastore = Gtk.TreeStore(GObject.TYPE_PYOBJECT)
+		self.datastore = GpxTrackTreeModel()
 		GpxToplevelList.__init__(self)
 
-	# Split a track segment
-	# FIXME: bounding box should be invalidated
+	def append(self, child):
+		self.datastore.insert_track(len(self.datastore.tracks), child)
+
+	def touch(self, path):
+		if type(path) == int:
+			path = (path,)
+		self.datastore.touch(path)
+
+	def __len__(self):
+		return len(self.datastore.tracks)
+
+	def __iter__(self):
+		return iter(list(self.datastore.tracks))
+
+	def __getitem__(self, path):
+		if type(path) == int:
+			return self.datastore.tracks[path]
+		return self.datastore.get_object(tuple(path))
+
+	def __delitem__(self, path):
+		if type(path) == int:
+			path = (path,)
+		self.datastore.remove_path(tuple(path))
+
+	# Split a track segment at the selected point. The selected point
+	# becomes the first point of a new segment which follows the old one.
 	def split(self, path):
 		if len(path) == 3:		# point selected
-
-			# Save the data from the rows to be split off
-			points = []
-			remove_paths = []
-			iter = self.datastore.get_iter(path)
-			while iter is not None:
-				points.append(self.datastore.get_value(iter, 0))
-				remove_paths.insert(0, self.datastore.get_path(iter))
-				iter = self.datastore.iter_next(iter)
-			print("points:", points)
-
-			# Remove the rows to be split off
-			for remove_path in remove_paths:
-				iter = self.datastore.get_iter(remove_path)
-				self.datastore.remove(iter)
-
-			# Create a new track segment
-			iter_track = self.datastore.get_iter(path[0])
-			iter_segment = self.datastore.get_iter(path[:2])
-			new_seg = GpxTrackSegment()
-			new_seg.datastore = self.datastore
-			self.datastore.insert_after(iter_track, iter_segment, [new_seg])
-
-			# Put the removed points into the new track segment
-			for point in points:
-				new_seg.append(point)
+			track = self[path[0]]
+			new_seg = track[path[1]].split(path[2])
+			track.insert(path[1] + 1, new_seg)
 
 	# These are for recording live GPS tracks
 	def new_segment(self, track_name):
@@ -541,23 +768,40 @@ class GpxTrack(object):
 	children = ['name', 'cmt', 'desc', 'src', 'link', 'number', 'type']
 	def __init__(self):
 		self.datastore = None		# set by parent (GpsTracks)
-		self.iter = None			# set by parent
+		self.segments = []
+		self.bbox = None			# see get_bbox()
 		for child_name in self.children:
 			setattr(self, child_name, "")
 		self.gpxtp_show = True
 		self.gpxx_DisplayColor = ""
 	def __iter__(self):
-		iter = self.datastore.iter_children(self.iter)
-		while iter is not None:
-			trackseg = self.datastore.get_value(iter, 0)
-			yield trackseg
-			iter = self.datastore.iter_next(iter)
+		return iter(self.segments)
+	def __len__(self):
+		return len(self.segments)
 	def __getitem__(self, index):
-		iter = self.datastore.iter_nth_child(self.iter, index)
-		return self.datastore.get_value(iter, 0)
+		return self.segments[index]
 	def append(self, segment):
+		self.insert(len(self.segments), segment)
+	def insert(self, index, segment):
 		segment.datastore = self.datastore
-		self.datastore.append(self.iter, [segment])
+		segment.track = self
+		self.segments.insert(index, segment)
+		if self.bbox is not None:
+			_bbox_add_bbox(self.bbox, segment.get_bbox())
+		if self.datastore is not None:
+			self.datastore.child_inserted(self, index)
+	def __delitem__(self, index):
+		if index < 0:
+			index += len(self.segments)
+		segment = self.segments.pop(index)
+		# When a segment is dragged the tree model inserts it at the drop
+		# point (perhaps in this same track) before deleting the source
+		# row, so it may already belong elsewhere.
+		if segment.track is self and not segment in self.segments:
+			segment.track = None
+		self.bbox = None
+		if self.datastore is not None:
+			self.datastore.child_deleted(self, index)
 	def write(self, writer):
 		writer.startElementNL("trk")
 		for i in self.children:
@@ -576,61 +820,466 @@ class GpxTrack(object):
 		for trackseg in self:
 			trackseg.write(writer)
 		writer.endElementNL("trk")
+	# Bounding box of all of the segments. It is built from theirs and
+	# then kept up to date by the segments as points are added, moved,
+	# and removed. It is thrown away only when a point on its edge moves
+	# or is removed or when a segment is removed.
+	def get_bbox(self):
+		if self.bbox is None:
+			self.bbox = pykarta.geometry.BoundingBox()
+			for trackseg in self:
+				_bbox_add_bbox(self.bbox, trackseg.get_bbox())
+		return self.bbox
+
+# Enlarge bbox to include other (if it is valid)
+def _bbox_add_bbox(bbox, other):
+	if other.valid:
+		bbox.add_point(pykarta.geometry.Point(other.min_lat, other.min_lon))
+		bbox.add_point(pykarta.geometry.Point(other.max_lat, other.max_lon))
+
+# Would the bounding box shrink if this point were removed from it?
+def _on_bbox_edge(bbox, lat, lon):
+	return bbox.valid and (lat == bbox.min_lat or lat == bbox.max_lat or lon == bbox.min_lon or lon == bbox.max_lon)
+
+# Placeholder in GpxTrackSegment.times for points with no <time>
+NO_TIME = -(2**63)
+
+# Scratch space for rounding elevations to single precision
+_ele32 = array('f', [0.0])
+
+# Convert a GPX timestamp such as 2013-06-01T14:02:33Z or
+# 2013-06-01T14:02:33.250Z to milliseconds since the epoch.
+# Returns None unless _format_time() would give back exactly the
+# same text. Track points come in order, so the date is usually
+# the same as last time. The remembered date is a tuple which is
+# replaced rather than modified so that loader threads can share it.
+_last_date = (None, 0)
+def _parse_time(text):
+	global _last_date
+	if len(text) == 20:
+		if text[19] != 'Z':
+			return None
+		ms = 0
+	elif len(text) == 24:
+		if text[19] != '.' or text[23] != 'Z':
+			return None
+		try:
+			ms = int(text[20:23])
+		except ValueError:
+			return None
+		if ("%03d" % ms) != text[20:23]:
+			return None
+	else:
+		return None
+	date = text[:11]
+	cache = _last_date
+	if date != cache[0]:
+		try:
+			year, month, day = int(text[0:4]), int(text[5:7]), int(text[8:10])
+			datetime.date(year, month, day)		# is it a real date?
+		except ValueError:
+			return None
+		if ("%04d-%02d-%02dT" % (year, month, day)) != date:
+			return None
+		cache = (date, calendar.timegm((year, month, day, 0, 0, 0)))
+		_last_date = cache
+	try:
+		hour, minute, second = int(text[11:13]), int(text[14:16]), int(text[17:19])
+	except ValueError:
+		return None
+	if hour > 23 or minute > 59 or second > 59 or ("%02d:%02d:%02d" % (hour, minute, second)) != text[11:19]:
+		return None
+	return (cache[1] + hour * 3600 + minute * 60 + second) * 1000 + ms
+
+# Inverse of _parse_time(). Digits is 0 or 3. As in _parse_time(),
+# the date is remembered since it usually has not changed.
+_last_day = (None, "")
+def _format_time(ms, digits):
+	global _last_day
+	secs, ms = divmod(ms, 1000)
+	day, secs = divmod(secs, 86400)
+	cache = _last_day
+	if day != cache[0]:
+		cache = (day, "%04d-%02d-%02dT" % time.gmtime(day * 86400)[:3])
+		_last_day = cache
+	minutes, secs = divmod(secs, 60)
+	hours, minutes = divmod(minutes, 60)
+	if digits:
+		return "%s%02d:%02d:%02d.%03dZ" % (cache[1], hours, minutes, secs, ms)
+	return "%s%02d:%02d:%02dZ" % (cache[1], hours, minutes, secs)
 
 # A GPX track consists of one or more of these.
 # Unlike GpxTrack, these can't have attributes.
+#
+# Track points are not stored as individual Python objects. Instead
+# their coordinates, elevations, and times are kept in parallel arrays.
+# Elevations and times are stored as numbers but must be written out
+# exactly as they were read, so we remember the format used by the
+# first point in the segment. Values which cannot be reproduced using
+# that format, as well as the rarely-used text children such as <name>,
+# are kept in self.extras which is indexed by point number.
 class GpxTrackSegment(object):
+	chunk_size = 256		# points per chunk, see get_chunk_boxes()
+
 	def __init__(self):
 		self.datastore = None	# set by parent (GpxTrack)
-		self.iter = None		# set by parent
+		self.track = None		# set by parent
+		self.lats = array('d')
+		self.lons = array('d')
+		self.eles = array('f')	# NaN if missing
+		self.times = array('q')	# milliseconds since epoch, NO_TIME if missing
+		self.ele_format = None
+		self.time_digits = None
+		self.extras = {}
 		self.bbox = None
-		self.projected_points = None
-		self.projected_simplified_points = None
+		self.version = 0		# incremented when points are added, moved, or removed
+		self.chunk_boxes = None	# see get_chunk_boxes()
+		self.projected = None	# see get_projected_simplified()
+		self.min_zooms = None
+		self.projected_simplified = None
+		self.lazy = None		# see set_lazy()
+
 	def __iter__(self):
-		iter = self.datastore.iter_children(self.iter)
-		while iter is not None:
-			yield self.datastore.get_value(iter, 0)
-			iter = self.datastore.iter_next(iter)
-	def append(self, point):
-		self.datastore.append(self.iter, [point])
-		self.bbox = None
-		self.projected_points = None
-	def append_fix(self, fix):
-		point = GpxPoint(fix.lat, fix.lon)
-		# FIXME: record other attributes
-		self.append(point)
+		for index in range(len(self.lats)):
+			yield GpxTrackPoint(self, index)
 	def __len__(self):
-		return self.datastore.iter_n_children(self.iter)
+		if self.lazy is not None:
+			return self.lazy[3]
+		return len(self.lats)
 	def __getitem__(self, index):
-		iter = self.datastore.iter_nth_child(self.iter, index)
-		return self.datastore.get_value(iter, 0)
+		if index < 0:
+			index += len(self.lats)
+		if index < 0 or index >= len(self.lats):
+			raise IndexError
+		return GpxTrackPoint(self, index)
 	def __getattr__(self, attr):
 		if attr == "name":
 			return "Segment"
+		elif attr in ("lats", "lons", "eles", "times") and self.__dict__.get("lazy") is not None:
+			self.load_points()
+			return self.__dict__[attr]
 		else:
-			raise AttributeError
+			raise AttributeError(attr)
+
+	# Make this a lazily-loaded segment. The points have not been parsed.
+	# Instead we know that they are between byte offsets start and end in
+	# lazy_file (a GpxLazyFile), how many of them there are, and their
+	# bounding box. The arrays are removed. When something asks for one
+	# of them, __getattr__() calls load_points() to put them back.
+	def set_lazy(self, lazy_file, start, end, count, bbox):
+		del self.lats, self.lons, self.eles, self.times
+		self.lazy = (lazy_file, start, end, count)
+		self.bbox = bbox
+
+	# Parse the points of a lazily-loaded segment. Does nothing if they
+	# have already been parsed.
+	def load_points(self):
+		if self.lazy is not None:
+			lazy_file, start, end, count = self.lazy
+			segment = lazy_file.load_segment(start, end)
+			self.lats = segment.lats
+			self.lons = segment.lons
+			self.eles = segment.eles
+			self.times = segment.times
+			self.ele_format = segment.ele_format
+			self.time_digits = segment.time_digits
+			self.extras = segment.extras
+			self.lazy = None
+
+	# Add a point. The point can be any object with lat and lon
+	# attributes (such as a GpxPoint or a GpxTrackPoint).
+	def append(self, point):
+		index = self.append_values(point.lat, point.lon, getattr(point, 'ele', ""), getattr(point, 'time', ""))
+		for child_name in GpxPoint.children[2:]:
+			value = getattr(point, child_name, "")
+			if value != "" and value is not None:
+				self.extras.setdefault(index, {})[child_name] = value
+
+	# Add a point given its coordinates and the text of <ele> and <time>.
+	# Returns the index of the new point.
+	def append_values(self, lat, lon, ele="", time=""):
+		index = len(self.lats)
+		self.lats.append(lat)
+		self.lons.append(lon)
+		self.eles.append(float('nan'))
+		self.times.append(NO_TIME)
+		if ele != "":
+			self._set_ele(index, ele)
+		if time != "":
+			self._set_time(index, time)
+		self._bbox_add(lat, lon)
+		self.chunk_boxes = None
+		self.projected = None
+		self.version += 1
+		if self.datastore is not None:
+			self.datastore.child_inserted(self, index)
+		return index
+
+	def append_fix(self, fix):
+		# FIXME: record other attributes
+		self.append_values(fix.lat, fix.lon)
+
+	# Remove a point
+	def __delitem__(self, index):
+		if index < 0:
+			index += len(self.lats)
+		self._bbox_remove(self.lats[index], self.lons[index])
+		for column in (self.lats, self.lons, self.eles, self.times):
+			del column[index]
+		extras = {}
+		for i, values in self.extras.items():
+			if i > index:
+				extras[i-1] = values
+			elif i < index:
+				extras[i] = values
+		self.extras = extras
+		self.chunk_boxes = None
+		self.projected = None
+		self.version += 1
+		if self.datastore is not None:
+			self.datastore.child_deleted(self, index)
+
+	# Remove the points starting at index and return them in a new segment.
+	def split(self, index):
+		new_seg = GpxTrackSegment()
+		new_seg.lats = self.lats[index:]
+		new_seg.lons = self.lons[index:]
+		new_seg.eles = self.eles[index:]
+		new_seg.times = self.times[index:]
+		new_seg.ele_format = self.ele_format
+		new_seg.time_digits = self.time_digits
+		for i in [i for i in self.extras if i >= index]:
+			new_seg.extras[i-index] = self.extras.pop(i)
+		for column in (self.lats, self.lons, self.eles, self.times):
+			del column[index:]
+		self.bbox = None
+		self.chunk_boxes = None
+		self.projected = None
+		self.version += 1
+		if self.datastore is not None:
+			self.datastore.children_replaced(self)
+		return new_seg
+
+	# Get one of the GpxPoint attributes of a point
+	def get_point_value(self, index, name):
+		extra = self.extras.get(index)
+		if extra is not None and name in extra:
+			return extra[name]
+		if name == 'lat':
+			return self.lats[index]
+		if name == 'lon':
+			return self.lons[index]
+		if name == 'ele':
+			ele = self.eles[index]
+			return "" if ele != ele else (self.ele_format % ele)
+		if name == 'time':
+			t = self.times[index]
+			return "" if t == NO_TIME else _format_time(t, self.time_digits)
+		if name == 'link':
+			return None
+		return ""
+
+	# Set one of the GpxPoint attributes of a point
+	def set_point_value(self, index, name, value):
+		extra = self.extras.get(index)
+		if extra is not None:
+			extra.pop(name, None)
+			if len(extra) == 0:
+				del self.extras[index]
+		if name == 'lat' or name == 'lon':
+			self._bbox_remove(self.lats[index], self.lons[index])
+			if name == 'lat':
+				self.lats[index] = value
+			else:
+				self.lons[index] = value
+			self._bbox_add(self.lats[index], self.lons[index])
+			self.chunk_boxes = None
+			self.projected = None
+			self.version += 1
+		elif name == 'ele':
+			self.eles[index] = float('nan')
+			if value != "":
+				self._set_ele(index, value)
+		elif name == 'time':
+			self.times[index] = NO_TIME
+			if value != "":
+				self._set_time(index, value)
+		elif value != "" and value is not None:
+			self.extras.setdefault(index, {})[name] = value
+
+	# Store the text of an <ele> as a number if we can reproduce it exactly.
+	def _set_ele(self, index, text):
+		try:
+			ele = float(text)
+		except ValueError:
+			self.extras.setdefault(index, {})['ele'] = text
+			return
+		if self.ele_format is None:
+			dot = text.find('.')
+			self.ele_format = "%%.%df" % (len(text) - dot - 1 if dot >= 0 else 0)
+		self.eles[index] = ele
+		_ele32[0] = ele
+		if (self.ele_format % _ele32[0]) != text:
+			self.extras.setdefault(index, {})['ele'] = text
+
+	# Store the text of a <time> as a number if we can reproduce it exactly.
+	def _set_time(self, index, text):
+		t = _parse_time(text)
+		if t is not None:
+			digits = 3 if len(text) == 24 else 0
+			if self.time_digits is None:
+				self.time_digits = digits
+			self.times[index] = t
+			if digits == self.time_digits:
+				return
+		self.extras.setdefault(index, {})['time'] = text
+
 	def write(self, writer):
-		writer.startElementNL("trkseg")
-		for point in self:
-			point.write(writer, "trkpt")
-		writer.endElementNL("trkseg")
+		writer.write_trkseg(self)
+
+	# Same output as GpxPoint.write()
+	def write_point(self, writer, index, point_type="trkpt"):
+		writer.startElementNL(point_type, {'lat': repr(self.lats[index]), 'lon': repr(self.lons[index])})
+		for child_name in GpxPoint.children:
+			value = self.get_point_value(index, child_name)
+			if child_name == "link":
+				if value is not None:
+					value.write(writer)
+			elif value != "":
+				writer.characters(" ")
+				writer.simpleTextElement(child_name, value)
+		writer.endElementNL(point_type)
+
+	# The bounding box is computed from the arrays the first time it is
+	# needed and then kept up to date by _bbox_add() and _bbox_remove()
+	# which also update the bounding box of the track.
 	def get_bbox(self):
 		if self.bbox is None:
-			self.bbox = pykarta.geometry.BoundingBox()
-			for point in self:
-				self.bbox.add_point(point)
+			if len(self.lats) > 0:
+				self.bbox = pykarta.geometry.BoundingBox((min(self.lons), min(self.lats), max(self.lons), max(self.lats)))
+			else:
+				self.bbox = pykarta.geometry.BoundingBox()
 		return self.bbox
-	# Return points projected to tilespace. The answer is cached.
-	def get_projected_simplified_points(self, zoom):
+
+	# Long segments are divided into chunks of chunk_size points, each
+	# with its own bounding box, so that the map can draw just the parts
+	# of them which are in view. Chunk i covers points i*chunk_size thru
+	# (i+1)*chunk_size. Since the last point of a chunk is also the first
+	# of the next, the line between them is in both. Returns a list of
+	# boxes in the form (min_lon, min_lat, max_lon, max_lat) which is
+	# rebuilt after any change to the points.
+	def get_chunk_boxes(self):
+		if self.chunk_boxes is None:
+			lats = self.lats
+			lons = self.lons
+			self.chunk_boxes = []
+			for start in range(0, max(len(lats) - 1, 1), self.chunk_size):
+				chunk_lats = lats[start:start+self.chunk_size+1]
+				chunk_lons = lons[start:start+self.chunk_size+1]
+				if len(chunk_lats) > 0:
+					self.chunk_boxes.append((min(chunk_lons), min(chunk_lats), max(chunk_lons), max(chunk_lats)))
+		return self.chunk_boxes
+
+	# A point has been added at (or moved to) lat, lon
+	def _bbox_add(self, lat, lon):
+		if self.bbox is not None:
+			self.bbox.add_point(pykarta.geometry.Point(lat, lon))
+		if self.track is not None and self.track.bbox is not None:
+			self.track.bbox.add_point(pykarta.geometry.Point(lat, lon))
+
+	# The point at lat, lon is about to be removed (or moved). If it is on
+	# the edge of a bounding box, the box may shrink, so throw it away.
+	def _bbox_remove(self, lat, lon):
+		if self.bbox is not None and _on_bbox_edge(self.bbox, lat, lon):
+			self.bbox = None
+		if self.track is not None and self.track.bbox is not None and _on_bbox_edge(self.track.bbox, lat, lon):
+			self.track.bbox = None
+
+	# Return points projected to tilespace and simplified for display
+	# at the indicated zoom level as a pair of arrays (xs, ys). The points
+	# and the lowest zoom level at which each is needed are normally worked
+	# out in the background after loading (see gpx_data_simplify.py). If
+	# that has not been done yet, it is done now. The answer for each zoom
+	# level is cached.
+	def get_projected_simplified(self, zoom):
+		return self._simplified(zoom)[:2]
+
+	# The numbers in the segment of the points which get_projected_simplified() returns
+	def get_simplified_indices(self, zoom):
+		return self._simplified(zoom)[2]
+
+	# The same, but only the parts of the line which pass through the
+	# chunks whose boxes overlap box. Returns a list of (xs, ys), one for
+	# each run of consecutive chunks. Each run includes one more point at
+	# each end so that it joins up with the line outside of it.
+	def get_projected_simplified_runs(self, zoom, box):
+		from gpx_data_rtree import boxes_overlap
+		xs, ys, indices = self._simplified(zoom)
+		chunk_boxes = self.get_chunk_boxes()
+		runs = []
+		for chunk_i in range(len(chunk_boxes)):
+			if boxes_overlap(chunk_boxes[chunk_i], box):
+				if runs and runs[-1][1] == chunk_i - 1:
+					runs[-1][1] = chunk_i
+				else:
+					runs.append([chunk_i, chunk_i])
+		if len(runs) == 1 and runs[0] == [0, len(chunk_boxes) - 1]:
+			return [(xs, ys)]
+		result = []
+		for first_chunk, last_chunk in runs:
+			start = max(bisect.bisect_left(indices, first_chunk * self.chunk_size) - 1, 0)
+			stop = bisect.bisect_right(indices, (last_chunk + 1) * self.chunk_size) + 1
+			result.append((xs[start:stop], ys[start:stop]))
+		return result
+
+	# Return (xs, ys, indices) of the points to be drawn at a zoom level.
+	# Indices gives the number of each of the points in the segment.
+	def _simplified(self, zoom):
+		from gpx_data_simplify import simplify_segment, points_at_zoom
 		zoom = int(zoom + 0.5)
-		if self.projected_points is None:
-			self.projected_points = [project_to_tilespace(p.lat, p.lon, 0) for p in self]
-			self.projected_simplified_points = {}
-		if not zoom in self.projected_simplified_points:
-			tolerance = 1 / (256.0 * math.pow(2, zoom))
-			self.projected_simplified_points[zoom] = pykarta.geometry.simplify.line_simplify(self.projected_points, tolerance)
-			print("Simplified %d points to %d points at zoom level %d with tolerance %f" % (len(self.projected_points), len(self.projected_simplified_points[zoom]), zoom, tolerance))
-		return self.projected_simplified_points[zoom]
+		if self.projected is None:
+			self.set_simplification(*simplify_segment(self.lats, self.lons))
+		if not zoom in self.projected_simplified:
+			self.projected_simplified[zoom] = points_at_zoom(self.projected, self.min_zooms, zoom)
+			print("Simplified %d points to %d points at zoom level %d" % (len(self.projected[0]), len(self.projected_simplified[zoom][0]), zoom))
+		return self.projected_simplified[zoom]
+
+	def set_simplification(self, projected, min_zooms):
+		self.projected = projected
+		self.min_zooms = min_zooms
+		self.projected_simplified = {}
+
+# Stand-in for a GpxPoint stored in a GpxTrackSegment. It reads and writes
+# the values in the segment's arrays so it can be handed to code which
+# expects a GpxPoint (such as the tree view, the forms, the picker, and the
+# cut and copy commands). These are made as needed and should not be kept
+# since the index becomes wrong if points before this one are removed.
+class GpxTrackPoint(object):
+	children = GpxPoint.children
+	__slots__ = ['segment', 'index']
+	def __init__(self, segment, index):
+		self.segment = segment
+		self.index = index
+	def __getattr__(self, attr):
+		if attr == 'lat' or attr == 'lon' or attr in GpxPoint.children:
+			return self.segment.get_point_value(self.index, attr)
+		raise AttributeError(attr)
+	def __setattr__(self, attr, value):
+		if attr in GpxTrackPoint.__slots__:
+			object.__setattr__(self, attr, value)
+		elif attr == 'lat' or attr == 'lon' or attr in GpxPoint.children:
+			self.segment.set_point_value(self.index, attr, value)
+		else:
+			raise AttributeError(attr)
+	def __getitem__(self, index):
+		if index == 0:
+			return self.segment.lats[self.index]
+		elif index == 1:
+			return self.segment.lons[self.index]
+		else:
+			raise IndexError
+	def write(self, writer, point_type="wpt"):
+		self.segment.write_point(writer, self.index, point_type)
 
 #=============================================================================
 # This object holds the data from one or more GPX files.
@@ -639,7 +1288,7 @@ class GpxTrackSegment(object):
 class GpxParseError(Exception):
 	pass
 
-class GpxData(xml.sax.handler.ContentHandler):
+class GpxData(object):
 	def __init__(self):
 		self.metadata = None
 		self.waypoints = GpxWaypoints()
@@ -671,263 +1320,430 @@ class GpxData(xml.sax.handler.ContentHandler):
 		return (len(self.waypoints), len(self.routes), len(self.tracks))
 
 	# Return the bounding box of all of the waypoints, routes, tracks.
+	# The routes and tracks keep their own bounding boxes up to date,
+	# so this takes time in proportion to the number of objects rather
+	# than the number of points.
 	def get_bbox(self, mark=(0, 0, 0)):
 		bbox = pykarta.geometry.BoundingBox()
-		for point in list(self.waypoints)[mark[0]:]:
+		for point in itertools.islice(self.waypoints, mark[0], None):
 			bbox.add_point(point)
-		for route in list(self.routes)[mark[1]:]:
-			for point in route:
-				bbox.add_point(point)
-		for track in list(self.tracks)[mark[2]:]:
-			for trackseg in track:
-				for point in trackseg:
-					bbox.add_point(point)
+		for route in itertools.islice(self.routes, mark[1], None):
+			_bbox_add_bbox(bbox, route.get_bbox())
+		for track in itertools.islice(self.tracks, mark[2], None):
+			_bbox_add_bbox(bbox, track.get_bbox())
 		return bbox
 
 	# Write the data out using an GpxWriter() instance
 	def write(self, writer):
+		# Parse the points of any lazily-loaded track segments first
+		# since we may be about to overwrite the file they are in.
+		for track in self.tracks:
+			for trackseg in track:
+				trackseg.load_points()
+
 		if self.metadata is not None:
 			self.metadata.write(writer)
 		self.waypoints.write(writer)
 		self.routes.write(writer)
 		self.tracks.write(writer)
 
+	# Bulk update of the waypoints, routes, and tracks.
+	# See GpxToplevelList.begin_bulk().
+	@contextlib.contextmanager
+	def bulk(self):
+		with self.waypoints.bulk(), self.routes.bulk(), self.tracks.bulk():
+			yield self
+
 	# Load a GPX file
 	def load_gpx(self, fh):
-		# Used during parsing
+		loader = GpxLoader(self)
+		loader.debug = self.debug
+		with self.bulk():
+			loader.load(fh)
+		print("%d unsupported tags" % loader.unsupported_count)
+
+	# These are called by GpxLoader and GpxObjectList.add_to().
+	def add_waypoint(self, point):
+		self.waypoints.append(point)
+	def add_route(self, route, points):
+		self.routes.append(route)
+		route.extend(points)
+	def add_track(self, track):
+		self.tracks.append(track)
+
+# GpxLoader can load a GPX file into one of these rather than into a GpxData.
+# The objects are held here (without any Gtk stores) until add_to() is
+# called to add them to a GpxData.
+class GpxObjectList(object):
+	def __init__(self):
+		self.metadata = None
+		self.waypoints = []
+		self.routes = []		# (route, points)
+		self.tracks = []
+		self.bounds = None		# (min_lat, min_lon, max_lat, max_lon) from <bounds>
+		self.debug = False
+
+	def load_gpx(self, fh):
+		loader = GpxLoader(self)
+		loader.debug = self.debug
+		loader.load(fh)
+		print("%d unsupported tags" % loader.unsupported_count)
+
+	def add_waypoint(self, point):
+		self.waypoints.append(point)
+	def add_route(self, route, points):
+		self.routes.append((route, points))
+	def add_track(self, track):
+		self.tracks.append(track)
+	def set_bounds(self, min_lat, min_lon, max_lat, max_lon):
+		self.bounds = (min_lat, min_lon, max_lat, max_lon)
+
+	# Move the objects into a GpxData
+	def add_to(self, data):
+		if data.metadata is None:
+			data.metadata = self.metadata
+		with data.bulk():
+			for point in self.waypoints:
+				data.add_waypoint(point)
+			for route, points in self.routes:
+				data.add_route(route, points)
+			for track in self.tracks:
+				data.add_track(track)
+
+#=============================================================================
+# GPX file parser
+#
+# This is driven by Expat directly rather than thru xml.sax since SAX
+# adds a layer of Python calls to each event. For each open element we
+# push its name onto tag_stack[] and an object to represent it onto
+# obj_stack[], so the innermost element is at the end of each list.
+# The object is one of:
+# * the GpxData (for <gpx>)
+# * an object from above such as GpxWaypoint or GpxLink
+# * a list (for an element which holds text, the text is added to it)
+# * a GpxExtension (for an <extensions> or a gpxx: element)
+# * GpxUnsupported (for elements which we skip over)
+# * None (for elements which we ignore, such as <bounds>)
+#
+# The start handler which creates the object is chosen by looking up the
+# name of the enclosing element in self.start_handlers.
+#
+# The objects are passed to add_waypoint(), add_route(), and add_track()
+# of self.data, which is a GpxData or a GpxObjectList.
+#=============================================================================
+
+# Collects the children of a <trkpt> until GpxTrackSegment.append()
+# copies them into the segment's arrays.
+class GpxTrackPointValues(object):
+	children = GpxPoint.children
+	ele = ""
+	time = ""
+	name = ""
+	cmt = ""
+	desc = ""
+	src = ""
+	link = None
+	sym = ""
+	type = ""
+	def __init__(self, lat, lon):
+		self.lat = lat
+		self.lon = lon
+
+class GpxLoader(object):
+	def __init__(self, data):
+		self.data = data
+		self.debug = False
+		self.progress = None		# called with count of characters read so far
+		self.lazy_file = None		# if set, skip track points (see lazy_start_element())
+		self.start_handlers = {
+			'gpx': self.start_in_gpx,
+			'wpt': self.start_in_wpt,
+			'rte': self.start_in_rte,
+			'rtept': self.start_common,
+			'trk': self.start_in_trk,
+			'trkseg': self.start_in_trkseg,
+			'trkpt': self.start_common,
+			'metadata': self.start_in_metadata,
+			'author': self.start_in_author,
+			'copyright': self.start_in_text_only,
+			'link': self.start_in_text_only,
+			'extensions': self.start_in_extensions,
+			'gpxx:RouteExtension': self.start_in_display_color_extension,
+			'gpxx:TrackExtension': self.start_in_display_color_extension,
+			'gpxx:RoutePointExtension': self.start_in_route_point_extension,
+			}
+		self.gpx_start_handlers = {
+			'wpt': self.start_wpt,
+			'rte': self.start_rte,
+			'trk': self.start_trk,
+			'metadata': self.start_metadata,
+			}
+
+	def load(self, fh):
 		self.gpx_version = None
-		self.tag_stack = []		# list of enclosing tags with innermost first
+		self.tag_stack = []		# list of enclosing tags with innermost last
 		self.obj_stack = []		# list of objects cooresponding to tags
 		self.unsupported_count = 0
 
-		self.parser = xml.sax.make_parser()
-		self.parser.setContentHandler(self)
-		self.parser.parse(fh)
-		#self.changes = True		# probably not necessary
-
-		print("%d unsupported tags" % self.unsupported_count)
-
-	# Callback from XML parser
-	def startElement(self, name, attrs):
+		parser = xml.parsers.expat.ParserCreate()
+		parser.buffer_text = True
+		parser.XmlDeclHandler = self.xml_decl
+		self.parser = parser
 		if self.debug:
-			print("<%s>" % name)
-			print(" Tag stack:", self.tag_stack)
-			print(" Obj stack:", self.obj_stack)
+			parser.StartElementHandler = self.debug_start_element
+			parser.EndElementHandler = self.debug_end_element
+			parser.CharacterDataHandler = self.debug_characters
+		else:
+			parser.StartElementHandler = self.start_element
+			parser.EndElementHandler = self.end_element
+			parser.CharacterDataHandler = self.characters
+
+		# The file may be open in either text or binary mode.
+		position = 0
+		while True:
+			data = fh.read(0x40000)
+			if not data:
+				break
+			parser.Parse(data, False)
+			position += len(data)
+			if self.progress is not None:
+				self.progress(position)			# may raise exception to stop
+		parser.Parse(data, True)
+		self.parser = None
+
+	# Callback from XML parser for <?xml ...?>
+	def xml_decl(self, version, encoding, standalone):
+		if self.lazy_file is not None:
+			self.lazy_file.encoding = encoding
+			self.lazy_file.gpx_version = self.gpx_version
 
-		# Create an object to represent this tag and push it onto the start of obj_stack[].
+	# Callback from XML parser
+	def start_element(self, name, attrs):
 		if len(self.tag_stack) == 0:
-			if name == 'gpx':
-				self.gpx_version = attrs.get('version')
-				self.obj_stack.insert(0, self)
-
-		elif self.tag_stack[0] == 'gpx':
-			if name == 'wpt':
-				new_point = GpxWaypoint(float(attrs.get('lat')), float(attrs.get('lon')))
-				self.waypoints.append(new_point)
-				self.obj_stack.insert(0, new_point)
-			elif name == 'rte':
-				new_route = GpxRoute()
-				self.routes.append(new_route)
-				self.obj_stack.insert(0, new_route)
-			elif name == 'trk':
-				new_track = GpxTrack()
-				self.tracks.append(new_track)
-				self.obj_stack.insert(0, new_track)
-			elif name == "metadata" and self.gpx_version == "1.1":
-				new_metadata = GpxMetadata()
-				if self.metadata is None:			# if first one,
-					self.metadata = new_metadata
-				self.obj_stack.insert(0, new_metadata)
-			elif self.gpx_version == "1.0" and name in GpxMetadata.compat_children:
-				if name == "bounds":
-					self.obj_stack.insert(0, None)		# ignore <bounds>
-				else:
-					self.obj_stack.insert(0, "")
-			else:
-				print("Unsupported toplevel element:", name)
-				self.unsupported_count += 1
-				self.obj_stack.insert(0, GpxUnsupported())
-
-		elif self.tag_stack[0] == 'wpt':
-			if name == "groundspeak:cache":
-				new_geocache = GpxGeocache()
-				self.obj_stack.insert(0, new_geocache)
-			else:
-				self.startElement_common(name, attrs)		# will push to obj_stack[]
-
-		elif self.tag_stack[0] == 'rte':
-			if name == 'rtept':
-				new_point = GpxRoutePoint(float(attrs.get('lat')), float(attrs.get('lon')))
-				self.obj_stack[0].append(new_point)		# add point to route
-				self.obj_stack.insert(0, new_point)		# put point on top
-			else:
-				self.startElement_common(name, attrs)
-
-		elif self.tag_stack[0] == 'rtept':
-			self.startElement_common(name, attrs)
-
-		elif self.tag_stack[0] == 'trk':
-			if name == 'trkseg':
-				new_trkseg = GpxTrackSegment()
-				self.obj_stack[0].append(new_trkseg)	# add segment to track
-				self.obj_stack.insert(0, new_trkseg)	# put segment on top
-			else:
-				self.startElement_common(name, attrs)
-
-		elif self.tag_stack[0] == 'trkseg':
-			if name == 'trkpt':
-				new_point = GpxPoint(float(attrs.get('lat')), float(attrs.get('lon')))
-				self.obj_stack[0].append(new_point)		# add point to track segment
-				self.obj_stack.insert(0, new_point)		# put point on top
-			else:
-				raise GpxParseError
-
-		elif self.tag_stack[0] == 'trkpt':
-			self.startElement_common(name, attrs)
-
-		elif self.tag_stack[0] == 'metadata':
-			if name == 'author':
-				author = GpxPerson()
-				self.metadata.author = author
-				self.obj_stack.insert(0, author)
-			elif name == 'copyright':
-				copyright = GpxCopyright(attrs.get('author',''))	# required element
-				self.metadata.copyright = copyright
-				self.obj_stack.insert(0, copyright)
-			elif name == 'bounds':
-				self.obj_stack.insert(0, None)		# ignore
-			else:
-				self.startElement_common(name, attrs)
-
-		# <author>
-		#  <name>John Smith</name>
-		#  <email id="jsmith" domain="example.com"/>
-		#  <link href="http://jsmith.example.com">
-		#   <text>John Smith's website</text>
-		#   <type></type>
-		#  </link>
-		# </author>
-		elif self.tag_stack[0] == 'author':
-			if name == 'name':
-				self.obj_stack.insert(0, "")
-			elif name == 'email':
-				email = GpxEmail(attrs['id'], attrs['domain'])
-				self.obj_stack[0].email = email
-				self.obj_stack.insert(0, email)
-			elif name == 'link':
-				link = GpxLink(attrs['href'])
-				self.obj_stack[0].link = link
-				self.obj_stack.insert(0, link)
-			else:
-				raise GpxParseError
-
-		# The children of <copyright> and <link> contain only text.
-		elif self.tag_stack[0] == 'copyright' or self.tag_stack[0] == 'link':
-			if name in self.obj_stack[0].children:
-				self.obj_stack.insert(0, "")
-			else:
+			if name != 'gpx':
 				raise GpxParseError
-
-		elif self.tag_stack[0] == 'extensions':
-			if name == "gpxtp:show":
-				self.obj_stack.insert(0, "")
-			elif name.startswith('gpxx:'):
-				self.obj_stack.insert(0, GpxExtension(self.obj_stack[0]))
-			else:
-				print("Unsupported extension:", self.tag_stack, name)
-				self.unsupported_count += 1
-				self.obj_stack.insert(0, GpxUnsupported())
-
-		elif self.tag_stack[0] == 'gpxx:RouteExtension':
-			if name == "gpxx:DisplayColor":
-				self.obj_stack.insert(0, "")
-			else:
-				print("Unsupported extension:", self.tag_stack, name)
-				self.unsupported_count += 1
-				self.obj_stack.insert(0, GpxUnsupported())
-
-		elif self.tag_stack[0] == 'gpxx:RoutePointExtension':
-			if name == "gpxx:rpt":
-				point = GpxRouteShapePoint(float(attrs.get('lat')), float(attrs.get('lon')))
-				self.obj_stack[2].route_shape.append(point)	# thru two levels of extension tags
-				self.obj_stack.insert(0, None)	# dummy
-			else:
-				print("Unsupported extension:", self.tag_stack, name)
-				self.unsupported_count += 1
-				self.obj_stack.insert(0, GpxUnsupported())
-
-		elif self.tag_stack[0] == 'gpxx:TrackExtension':
-			if name == "gpxx:DisplayColor":
-				self.obj_stack.insert(0, "")
-			else:
-				print("Unsupported extension:", self.tag_stack, name)
-				self.unsupported_count += 1
-				self.obj_stack.insert(0, GpxUnsupported())
-
-		elif self.tag_stack[0].startswith('groundspeak:'):
-			self.obj_stack.insert(0, GpxUnsupported())	# FIXME: add support
-
+			self.gpx_version = attrs.get('version')
+			if self.lazy_file is not None:
+				self.lazy_file.gpx_version = self.gpx_version
+			obj = self.data
 		else:
-			print("Unsupported element:", self.tag_stack, name)
+			context = self.tag_stack[-1]
+			handler = self.start_handlers.get(context)
+			if handler is not None:
+				obj = handler(name, attrs)
+			elif context.startswith('groundspeak:'):
+				obj = GpxUnsupported()		# FIXME: add support
+			else:
+				obj = self.unsupported("Unsupported element:", name)
+		self.obj_stack.append(obj)
+		self.tag_stack.append(name)
+
+	def unsupported(self, message, name):
+		print(message, list(reversed(self.tag_stack)), name)
+		self.unsupported_count += 1
+		return GpxUnsupported()
+
+	def start_in_gpx(self, name, attrs):
+		handler = self.gpx_start_handlers.get(name)
+		if handler is not None:
+			return handler(name, attrs)
+		if self.gpx_version == "1.0" and name in GpxMetadata.compat_children:
+			if name == "bounds":
+				return self.found_bounds(attrs)
+			return []
+		print("Unsupported toplevel element:", name)
+		self.unsupported_count += 1
+		return GpxUnsupported()
+
+	def start_wpt(self, name, attrs):
+		return GpxWaypoint(float(attrs['lat']), float(attrs['lon']))		# added by end_element()
+
+	def start_rte(self, name, attrs):
+		self.route_points = []
+		return GpxRoute()			# added by end_element()
+
+	def start_trk(self, name, attrs):
+		return GpxTrack()			# added by end_element()
+
+	def start_metadata(self, name, attrs):
+		if self.gpx_version != "1.1":
+			print("Unsupported toplevel element:", name)
 			self.unsupported_count += 1
-			self.obj_stack.insert(0, GpxUnsupported())
-
-		# Now that the object is in place, push to tag onto the tag stack
-		# as the innermost (index 0) element.
-		self.tag_stack.insert(0, name)
-
-		# Make sure one and only one object was pushed to represent this tag.
-		assert len(self.obj_stack) == len(self.tag_stack)
+			return GpxUnsupported()
+		new_metadata = GpxMetadata()
+		if self.data.metadata is None:			# if first one,
+			self.data.metadata = new_metadata
+		return new_metadata
+
+	def start_in_wpt(self, name, attrs):
+		if name == "groundspeak:cache":
+			return GpxGeocache()
+		return self.start_common(name, attrs)
+
+	def start_in_rte(self, name, attrs):
+		if name == 'rtept':
+			new_point = GpxRoutePoint(float(attrs['lat']), float(attrs['lon']))
+			self.route_points.append(new_point)		# added with route
+			return new_point
+		return self.start_common(name, attrs)
+
+	def start_in_trk(self, name, attrs):
+		if name == 'trkseg':
+			new_trkseg = GpxTrackSegment()
+			self.obj_stack[-1].append(new_trkseg)		# add segment to track
+			if self.lazy_file is not None:
+				self.start_lazy_trkseg()
+			return new_trkseg
+		return self.start_common(name, attrs)
+
+	# In lazy mode we do not parse the points of a track segment. Instead
+	# we swap in handlers which do nothing but work out the bounding box
+	# of the points and count them. At the end of the segment we note
+	# where it is in the file so that GpxTrackSegment.load_points() can
+	# parse it later. The file must be read in binary mode so that the
+	# byte offsets are right.
+	def start_lazy_trkseg(self):
+		parser = self.parser
+		self.lazy_handlers = (parser.StartElementHandler, parser.EndElementHandler, parser.CharacterDataHandler)
+		self.lazy_start = parser.CurrentByteIndex
+		self.lazy_count = 0
+		self.lazy_lats = []
+		self.lazy_lons = []
+		parser.StartElementHandler = self.lazy_start_element
+		parser.EndElementHandler = self.lazy_end_element
+		parser.CharacterDataHandler = None
+
+	def lazy_start_element(self, name, attrs):
+		if name == 'trkpt':
+			self.lazy_lats.append(float(attrs['lat']))
+			self.lazy_lons.append(float(attrs['lon']))
+			self.lazy_count += 1
+
+	def lazy_end_element(self, name):
+		if name == 'trkseg':
+			parser = self.parser
+			parser.StartElementHandler, parser.EndElementHandler, parser.CharacterDataHandler = self.lazy_handlers
+			if self.lazy_count > 0:
+				bbox = pykarta.geometry.BoundingBox((min(self.lazy_lons), min(self.lazy_lats), max(self.lazy_lons), max(self.lazy_lats)))
+				self.obj_stack[-1].set_lazy(self.lazy_file, self.lazy_start, parser.CurrentByteIndex, self.lazy_count, bbox)
+			self.lazy_lats = self.lazy_lons = None
+			self.tag_stack.pop()
+			self.obj_stack.pop()
+
+	def start_in_trkseg(self, name, attrs):
+		if name == 'trkpt':
+			return GpxTrackPointValues(float(attrs['lat']), float(attrs['lon']))	# added by end_element()
+		raise GpxParseError
+
+	def start_in_metadata(self, name, attrs):
+		if name == 'author':
+			author = GpxPerson()
+			self.data.metadata.author = author
+			return author
+		if name == 'copyright':
+			copyright = GpxCopyright(attrs.get('author',''))	# required element
+			self.data.metadata.copyright = copyright
+			return copyright
+		if name == 'bounds':
+			return self.found_bounds(attrs)
+		return self.start_common(name, attrs)
+
+	# The bounding box declared in the file is not kept, but it is passed
+	# to self.data.set_bounds() if there is such a thing. It lets the
+	# GUI zoom to the new objects before they have all been loaded.
+	def found_bounds(self, attrs):
+		set_bounds = getattr(self.data, "set_bounds", None)
+		if set_bounds is not None:
+			try:
+				set_bounds(float(attrs['minlat']), float(attrs['minlon']), float(attrs['maxlat']), float(attrs['maxlon']))
+			except (KeyError, ValueError):
+				print("Invalid <bounds>")
+		return None
+
+	# <author>
+	#  <name>John Smith</name>
+	#  <email id="jsmith" domain="example.com"/>
+	#  <link href="http://jsmith.example.com">
+	#   <text>John Smith's website</text>
+	#   <type></type>
+	#  </link>
+	# </author>
+	def start_in_author(self, name, attrs):
+		if name == 'name':
+			return []
+		if name == 'email':
+			email = GpxEmail(attrs['id'], attrs['domain'])
+			self.obj_stack[-1].email = email
+			return email
+		if name == 'link':
+			link = GpxLink(attrs['href'])
+			self.obj_stack[-1].link = link
+			return link
+		raise GpxParseError
+
+	# The children of <copyright> and <link> contain only text.
+	def start_in_text_only(self, name, attrs):
+		if name in self.obj_stack[-1].children:
+			return []
+		raise GpxParseError
+
+	def start_in_extensions(self, name, attrs):
+		if name == "gpxtp:show":
+			return []
+		if name.startswith('gpxx:'):
+			return GpxExtension(self.obj_stack[-1])
+		return self.unsupported("Unsupported extension:", name)
+
+	def start_in_display_color_extension(self, name, attrs):
+		if name == "gpxx:DisplayColor":
+			return []
+		return self.unsupported("Unsupported extension:", name)
+
+	def start_in_route_point_extension(self, name, attrs):
+		if name == "gpxx:rpt":
+			point = GpxRouteShapePoint(float(attrs['lat']), float(attrs['lon']))
+			route_point = self.obj_stack[-3]				# thru two levels of extension tags
+			if len(route_point.route_shape) == 0:
+				route_point.route_shape = []
+			route_point.route_shape.append(point)
+			return None
+		return self.unsupported("Unsupported extension:", name)
 
 	# This is shared by <metadata>, <wpt>, <rte>, <rtept>, <trk>, <trkpt>.
-	def startElement_common(self, name, attrs):
-		if name in self.obj_stack[0].children:		# if element has such a child,
+	def start_common(self, name, attrs):
+		parent = self.obj_stack[-1]
+		if name in parent.children:		# if element has such a child,
 			if name == 'link':
 				link = GpxLink(attrs['href'])
-				self.obj_stack[0].link = link
-				self.obj_stack.insert(0, link)
-			else:
-				self.obj_stack.insert(0, "")
-
-		elif name == 'extensions':
-			self.obj_stack.insert(0, GpxExtension(self.obj_stack[0]))
-
-		elif self.gpx_version == "1.0" and name in GpxLink.compat_children and "link" in self.obj_stack[0].children:
-			self.obj_stack.insert(0, "")
-
-		else:
-			print("Unsupported element:", self.tag_stack, name)
-			self.unsupported_count += 1
-			self.obj_stack.insert(0, GpxUnsupported())
+				parent.link = link
+				return link
+			return []
+		if name == 'extensions':
+			return GpxExtension(parent)
+		if self.gpx_version == "1.0" and name in GpxLink.compat_children and "link" in parent.children:
+			return []
+		return self.unsupported("Unsupported element:", name)
 
 	# Callback from XML parser for end tags
-	def endElement(self, name):
-		if self.debug:
-			print("</%s>" % name)
-			print(" Tag stack:", self.tag_stack)
-			print(" Obj stack:", self.obj_stack)
-
-		# Pop the tag off the stack and make sure it is the one we were expecting.
-		if len(self.tag_stack) < 1 or self.tag_stack.pop(0) != name:
-			raise GpxParseError
-
-		# Pop the cooresponding, newly constructed object off of the stack
-		obj = self.obj_stack.pop(0)
+	def end_element(self, name):
+		self.tag_stack.pop()
+		obj = self.obj_stack.pop()
 
-		# Strings need to be inserted into their parent objects.
-		if type(obj) is str:
-			parent = self.obj_stack[0]
+		# Text needs to be inserted into the parent object.
+		if type(obj) is list:
+			parent = self.obj_stack[-1]
 
 			while type(parent) is GpxExtension:		# step thru
 				parent = parent.parent
 
+			value = "".join(obj)
 			if name == 'gpxtp:show':
-				value = (obj == 'true')
-			else:
-				value = obj
+				value = (value == 'true')
+			elif name in interned_children:
+				value = sys.intern(value)
 
 			if self.gpx_version == "1.0":
-				if self.tag_stack[0] == "gpx" and name in GpxMetadata.compat_children:
+				if self.tag_stack[-1] == "gpx" and name in GpxMetadata.compat_children:
 					if parent.metadata is None:
 						parent.metadata = GpxMetadata()
 					parent = parent.metadata
@@ -943,31 +1759,66 @@ class GpxData(xml.sax.handler.ContentHandler):
 
 			setattr(parent, name.replace(':','_'), value)
 
-		elif type(obj) is str:
-			raise AssertionError
-
-		# FIXME: figure out why this is necessary
-		if name == 'rte':
-			self.routes.touch((len(self.routes)-1,))
+		# Track segments copy the point into their arrays.
+		elif name == 'trkpt':
+			self.obj_stack[-1].append(obj)
 
-		assert len(self.obj_stack) == len(self.tag_stack)
+		# Waypoints, routes, and tracks are added once they are complete.
+		elif name == 'wpt' and type(obj) is GpxWaypoint:
+			self.data.add_waypoint(obj)
+		elif name == 'rte':
+			self.data.add_route(obj, self.route_points)
+		elif name == 'trk':
+			self.data.add_track(obj)
 
 	# Callback from XML parser
 	def characters(self, text):
-		if self.debug:
-			print("Characters:", text)
-		if len(self.obj_stack) > 0 and type(self.obj_stack[0]) is str:
-			self.obj_stack[0] += text
+		if len(self.obj_stack) > 0:
+			obj = self.obj_stack[-1]
+			if type(obj) is list:
+				obj.append(text)
+
+	def debug_start_element(self, name, attrs):
+		print("<%s>" % name)
+		print(" Tag stack:", self.tag_stack)
+		print(" Obj stack:", self.obj_stack)
+		self.start_element(name, attrs)
+
+	def debug_end_element(self, name):
+		print("</%s>" % name)
+		print(" Tag stack:", self.tag_stack)
+		print(" Obj stack:", self.obj_stack)
+		self.end_element(name)
+
+	def debug_characters(self, text):
+		print("Characters:", text)
+		self.characters(text)
 
 #=============================================================================
 # To create a GPX file from data stored in the above objects, create one
-# of these and pass it to the write() method of an object.
+# of these and pass it to the write() method of an object. Then call
+# close() to finish the <gpx> element and write out what is left in
+# the buffer. The file is not closed.
+#
+# This used to be an xml.sax.saxutils.XMLGenerator. It produces exactly
+# the same output, but the text is collected in a list and written out
+# in large pieces. Most of the text is track points, so write_trkseg()
+# formats them straight from the arrays of the GpxTrackSegment. Text
+# is escaped only if it contains something which needs escaping.
+#
+# The file may be opened in either text or binary mode. In binary mode
+# the text is encoded as UTF-8.
 #=============================================================================
-class GpxWriter(xml.sax.saxutils.XMLGenerator):
+class GpxWriter(object):
+	buffer_size = 0x40000		# write when this many characters are waiting (roughly)
 
 	def __init__(self, fh):
-		fh.write("<?xml version='1.0' encoding='UTF-8'?>\n")
-		xml.sax.saxutils.XMLGenerator.__init__(self, fh)
+		self.fh = fh
+		self.binary = isinstance(fh, (io.BufferedIOBase, io.RawIOBase))
+		self.buffer = []
+		self.buffered = 0
+		self.closed = False
+		self.write("<?xml version='1.0' encoding='UTF-8'?>\n")
 		self.startElementNL("gpx", {
 			'version': "1.1",
 			'creator': "GPX Trip Planner",
@@ -976,18 +1827,109 @@ class GpxWriter(xml.sax.saxutils.XMLGenerator):
 			'xmlns:gpxrp': "http://www.trincoll.edu/xmlschemas/gpx-route-planner/v1",
 			})
 
+	# In case the caller forgets close()
 	def __del__(self):
-		self.endElementNL("gpx")
+		if not self.closed:
+			self.close()
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			self.endElementNL("gpx")
+			self.flush()
+
+	# Add raw (already escaped) text to the buffer
+	def write(self, text):
+		self.buffer.append(text)
+		self.buffered += len(text)
+		if self.buffered >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		text = "".join(self.buffer)
+		self.buffer = []
+		self.buffered = 0
+		if self.binary:
+			text = text.encode("utf-8")
+		self.fh.write(text)
+
+	# The subset of the XMLGenerator interface which the write() methods use
+
+	def startElement(self, tag, attrs):
+		if attrs:
+			self.write("<%s%s>" % (tag, "".join([" %s=%s" % (name, xml.sax.saxutils.quoteattr(value)) for name, value in attrs.items()])))
+		else:
+			self.write("<%s>" % tag)
+
+	def endElement(self, tag):
+		self.write("</%s>" % tag)
+
+	def characters(self, text):
+		if text:
+			self.write(_escape(text))
 
 	def startElementNL(self, tag, attrs={}):
 		self.startElement(tag, attrs)
-		self.characters("\n")
+		self.write("\n")
 
 	def endElementNL(self, tag):
-		self.endElement(tag)
-		self.characters("\n")
+		self.write("</%s>\n" % tag)
 
 	def simpleTextElement(self, tag, text):
-		self.startElement(tag, {})
-		self.characters(text)
-		self.endElementNL(tag)
+		self.write("<%s>%s</%s>\n" % (tag, _escape(text), tag))
+
+	# Write a GpxPoint. Same output as calling startElementNL(), then
+	# simpleTextElement() for each child, and so on.
+	def write_point(self, point, point_type):
+		parts = ['<%s lat="%r" lon="%r">\n' % (point_type, point.lat, point.lon)]
+		for child_name, value in zip(GpxPoint.children, _point_children(point)):
+			if child_name == "link":
+				if value is not None:
+					self.write("".join(parts))
+					parts = []
+					value.write(self)
+			elif value != "":
+				parts.append(" <%s>%s</%s>\n" % (child_name, _escape(value), child_name))
+		self.write("".join(parts))
+		point.write_extensions(self)
+		self.write("</%s>\n" % point_type)
+
+	# Write a GpxTrackSegment. The points without extras are formatted
+	# here. The others are left to GpxTrackSegment.write_point().
+	def write_trkseg(self, segment):
+		segment.load_points()
+		self.write("<trkseg>\n")
+		ele_format = segment.ele_format
+		time_digits = segment.time_digits
+		extras = segment.extras
+		parts = []
+		append = parts.append
+		index = 0
+		for lat, lon, ele, t in zip(segment.lats, segment.lons, segment.eles, segment.times):
+			if index in extras:
+				self.write("".join(parts))
+				del parts[:]
+				segment.write_point(self, index)
+			else:
+				append('<trkpt lat="%r" lon="%r">\n' % (lat, lon))
+				if ele == ele:			# not NaN
+					append(" <ele>%s</ele>\n" % (ele_format % ele))
+				if t != NO_TIME:
+					append(" <time>%s</time>\n" % _format_time(t, time_digits))
+				append("</trkpt>\n")
+			index += 1
+			if len(parts) >= 4096:
+				self.write("".join(parts))
+				del parts[:]
+		self.write("".join(parts))
+		self.write("</trkseg>\n")
+
+# Get the children of a GpxPoint (or GpxTrackPoint) as a tuple
+_point_children = operator.attrgetter(*GpxPoint.children)
+
+# Same as xml.sax.saxutils.escape(), but quicker when there is
+# nothing to escape, which is nearly always.
+def _escape(text):
+	if "&" in text or "<" in text or ">" in text:
+		return xml.sax.saxutils.escape(text)
+	return text
@@ -0,0 +1,102 @@
+#=============================================================================
+# gpx_data_gzip.py
+# Write Gzip files using all of the cores
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+import io
+import os
+import struct
+import time
+import zlib
+import collections
+import concurrent.futures
+
+#=============================================================================
+# ParallelGzipFile is a write-only replacement for gzip.GzipFile. It works
+# the way pigz does. The data is cut into blocks which are deflated in a
+# pool of threads. (Zlib releases the GIL while it works.) Each block
+# but the last ends with a sync flush, so it ends on a byte boundary
+# and the compressed blocks can simply be concatenated to form the
+# deflate stream of a single Gzip member. Each block is primed with
+# the last 32K of the block before it, so compression is nearly as
+# good as it would be if the data were compressed in one piece.
+#
+# The CRC is computed in the calling thread as the data is written.
+#=============================================================================
+
+class ParallelGzipFile(io.BufferedIOBase):
+	block_size = 0x20000		# uncompressed bytes per block (same as pigz)
+	window_size = 0x8000		# size of the Deflate dictionary
+
+	def __init__(self, filename=None, fileobj=None, compresslevel=6, threads=None):
+		if fileobj is None:
+			fileobj = open(filename, "wb")
+			self.owns_fileobj = True
+		else:
+			self.owns_fileobj = False
+		self.fileobj = fileobj
+		self.compresslevel = compresslevel
+		if threads is None:
+			threads = os.cpu_count() or 1
+		self.max_pending = threads * 2
+		self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+		self.pending = collections.deque()		# futures, in file order
+		self.buffer = bytearray()
+		self.dictionary = b""
+		self.crc = 0
+		self.size = 0
+
+		# Gzip header: magic, method (deflate), no flags, modification time,
+		# extra flags, OS (unknown)
+		xfl = 2 if compresslevel == 9 else 4 if compresslevel == 1 else 0
+		self.fileobj.write(struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, int(time.time()), xfl, 255))
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		if self.closed:
+			raise ValueError("write to closed file")
+		data = memoryview(data).cast("B")
+		self.crc = zlib.crc32(data, self.crc)
+		self.size += len(data)
+		self.buffer += data
+		while len(self.buffer) >= self.block_size:
+			block = bytes(self.buffer[:self.block_size])
+			del self.buffer[:self.block_size]
+			self.submit(block, False)
+		return len(data)
+
+	# Compress a block in the pool. When too many blocks are waiting,
+	# write out the oldest so memory use stays bounded.
+	def submit(self, block, last):
+		self.pending.append(self.pool.submit(self.compress, block, self.dictionary, last))
+		self.dictionary = block[-self.window_size:]
+		while len(self.pending) > self.max_pending:
+			self.fileobj.write(self.pending.popleft().result())
+
+	# This runs in the pool
+	def compress(self, block, dictionary, last):
+		if dictionary:
+			compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+		else:
+			compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+		return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+	# The last block (which may be empty) ends the deflate stream.
+	def close(self):
+		if self.closed:
+			return
+		try:
+			self.submit(bytes(self.buffer), True)
+			self.buffer = bytearray()
+			while self.pending:
+				self.fileobj.write(self.pending.popleft().result())
+			self.fileobj.write(struct.pack("<II", self.crc, self.size & 0xFFFFFFFF))
+			self.fileobj.flush()
+		finally:
+			self.pool.shutdown()
+			if self.owns_fileobj:
+				self.fileobj.close()
+			io.BufferedIOBase.close(self)
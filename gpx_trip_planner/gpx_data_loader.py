@@ -0,0 +1,416 @@
+#=============================================================================
+# gpx_data_loader.py
+# Load GPX files in the background and in parallel
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+import os
+import time
+import struct
+import threading
+import io
+from gi.repository import GLib
+
+from gpx_data_gpx import GpxObjectList, GpxLoader
+from gpx_data_cache import file_identity, GpxCacheEncoder
+
+# Open a GPX file (possibly in Gzip format) for read.
+def open_gpx_file(filename):
+	if os.path.splitext(filename)[1] == ".gz":
+		import gzip
+		return gzip.open(filename, "r")
+	else:
+		return open(filename, "r")
+
+# Return the size of a GPX file after decompression (if it is compressed).
+# This is used to show progress. The trailer of a Gzip file contains
+# the uncompressed size modulo 2**32.
+def gpx_file_size(filename):
+	if os.path.splitext(filename)[1] == ".gz":
+		with open(filename, "rb") as fh:
+			fh.seek(-4, 2)
+			return struct.unpack("<I", fh.read(4))[0] or 1
+	return os.path.getsize(filename) or 1
+
+#=============================================================================
+# Lazy loading
+#
+# GpxLoader reads a GpxLazyFile rather than an ordinary file when it
+# is in lazy mode. It records the byte offsets of each track segment
+# in the file. Later GpxTrackSegment.load_points() calls load_segment()
+# to parse the points between those offsets.
+#
+# The offsets are in the uncompressed data, so a Gzip file is copied
+# to a temporary file as it is read. A plain file is read thru a
+# second file object which is kept open. A lock keeps the background
+# thread from appending to the temporary file while the main thread
+# is reading a segment from it.
+#=============================================================================
+
+class GpxLazyFile(object):
+	def __init__(self, filename):
+		self.filename = filename
+		self.encoding = None			# set by GpxLoader
+		self.gpx_version = None			# set by GpxLoader
+		self.lock = threading.Lock()
+		if os.path.splitext(filename)[1] == ".gz":
+			import gzip, tempfile
+			self.reader = gzip.open(filename, "rb")
+			self.fh = tempfile.TemporaryFile()
+			self.spool = True
+		else:
+			self.reader = open(filename, "rb")
+			self.fh = open(filename, "rb")
+			self.spool = False
+
+	# GpxLoader reads the file thru this
+	def read(self, size):
+		data = self.reader.read(size)
+		if self.spool:
+			with self.lock:
+				self.fh.seek(0, 2)
+				self.fh.write(data)
+		if not data:
+			self.reader.close()
+		return data
+
+	def read_range(self, start, end):
+		with self.lock:
+			self.fh.seek(start)
+			return self.fh.read(end - start)
+
+	# Parse the track segment (starting at its <trkseg> tag and ending just
+	# before its </trkseg> tag) and return it as a GpxTrackSegment.
+	def load_segment(self, start, end):
+		header = '<?xml version="1.0" encoding="%s"?>\n' % (self.encoding or "UTF-8")
+		if self.gpx_version is not None:
+			header += '<gpx version="%s"><trk>' % self.gpx_version
+		else:
+			header += '<gpx><trk>'
+		data = header.encode("ascii") + self.read_range(start, end) + b"</trkseg></trk></gpx>"
+		objects = GpxObjectList()
+		GpxLoader(objects).load(io.BytesIO(data))
+		return objects.tracks[0].segments[0]
+
+#=============================================================================
+# Parallel parsing
+#=============================================================================
+
+# This runs in a worker process. It parses a GPX file and returns the
+# objects in a GpxObjectList which is pickled and sent back to the
+# main process. If cache_directory is not None, the file is hashed too
+# so that the cache index can be updated. If there is already a cache
+# file for a file with that hash, parsing is skipped and the objects
+# are returned as None.
+def parse_gpx_file(args):
+	filename, cache_directory = args
+	identity = None
+	if cache_directory is not None:
+		identity = file_identity(filename)
+		if os.path.exists(os.path.join(cache_directory, identity[2] + ".gpxc")):
+			return (identity, None)
+	objects = GpxObjectList()
+	with open_gpx_file(filename) as fh:
+		objects.load_gpx(fh)
+	return (identity, objects)
+
+# Load the named GPX files and yield a GpxObjectList for each in the
+# same order. Files which are in the cache are read from it. The rest
+# are parsed in parallel if there are at least two of them. Only the
+# calling process touches the cache index and then only while holding
+# cache_lock (if other threads use the cache, they must share it).
+def iter_gpx_files(filenames, cache=None, processes=None, cache_lock=None):
+	if cache_lock is None:
+		cache_lock = threading.Lock()
+	cached = [None] * len(filenames)
+	if cache is not None:
+		with cache_lock:
+			cached = [cache.lookup(filename) for filename in filenames]
+
+	cache_directory = cache.directory if cache is not None else None
+	jobs = [(filenames[i], cache_directory) for i in range(len(filenames)) if cached[i] is None]
+	if processes is None:
+		processes = os.cpu_count() or 1
+	processes = min(processes, len(jobs))
+	if processes >= 2:
+		with pool_context().Pool(processes) as pool:
+			for objects in _merge_gpx_files(filenames, cache, cache_lock, cached, pool.imap(parse_gpx_file, jobs)):
+				yield objects
+	else:
+		for objects in _merge_gpx_files(filenames, cache, cache_lock, cached, map(parse_gpx_file, jobs)):
+			yield objects
+
+# The worker processes are started by a fork server (or spawned where
+# there is none) rather than forked from this process. It has other
+# threads (the GTK main loop, the web server, the background load) and
+# a forked child would inherit their locks in whatever state they were.
+# The workers import this module to find parse_gpx_file() and run the
+# program's main script as __mp_main__, so it must do nothing then.
+def pool_context():
+	import multiprocessing
+	if "forkserver" in multiprocessing.get_all_start_methods():
+		context = multiprocessing.get_context("forkserver")
+		context.set_forkserver_preload(["gpx_data_loader"])
+		return context
+	return multiprocessing.get_context("spawn")
+
+def _merge_gpx_files(filenames, cache, cache_lock, cached, parsed):
+	for i in range(len(filenames)):
+		objects = cached[i]
+		if objects is None:
+			identity, objects = next(parsed)
+			if cache is not None:
+				if objects is None:
+					with cache_lock:
+						objects = cache.fetch(identity[2])
+						if objects is not None:
+							cache.store(filenames[i], identity, None)
+					if objects is None:			# cache file went bad
+						objects = parse_gpx_file((filenames[i], None))[1]
+						with cache_lock:
+							cache.store(filenames[i], identity, objects)
+				else:
+					with cache_lock:
+						cache.store(filenames[i], identity, objects)
+		yield objects
+	if cache is not None:
+		with cache_lock:
+			cache.sync()
+
+#=============================================================================
+# Background loading
+#
+# GpxBackgroundLoad loads GPX files in a thread so that the GUI keeps
+# running. The objects are passed to the main thread in chunks (by way
+# of GLib.idle_add()) as they are parsed. For each chunk on_objects() is
+# called with a GpxObjectList. As the work progresses on_progress() is
+# called with the fraction done and the name of the current file. At the
+# end on_finished() is called with the exception which stopped the load
+# or None. After cancel() no more chunks are delivered, but on_finished()
+# is still called.
+#
+# When there is more than one file and more than one core, the files
+# are parsed in parallel by iter_gpx_files(). Each is then delivered in
+# chunks of chunk_objects objects so that the main loop can run between
+# them, but progress is reported and cancel noticed only as each file
+# arrives. Otherwise each is parsed in this thread and delivered in
+# chunks as it is parsed.
+#
+# If lazy is True, the points of the track segments are not parsed
+# (see GpxLazyFile above). Such loads do not use the cache or the
+# worker processes.
+#=============================================================================
+
+class GpxLoadCancelled(Exception):
+	pass
+
+# Takes the place of GpxData when GpxLoader is run in the background thread.
+# The objects are collected in a GpxObjectList which is passed to deliver()
+# every interval seconds.
+class GpxChunkSink(object):
+	def __init__(self, deliver, interval):
+		self.deliver = deliver
+		self.interval = interval
+		self.metadata = None
+		self.bounds = None
+		self.encoder = None				# GpxCacheEncoder, if caching
+		self.chunk = GpxObjectList()
+		self.last_delivery = time.time()
+
+	def set_bounds(self, min_lat, min_lon, max_lat, max_lon):
+		self.bounds = (min_lat, min_lon, max_lat, max_lon)
+		self.flush()					# let the GUI zoom now
+
+	def add_waypoint(self, point):
+		self.chunk.add_waypoint(point)
+		self.check()
+	def add_route(self, route, points):
+		self.chunk.add_route(route, points)
+		self.check()
+	def add_track(self, track):
+		self.chunk.add_track(track)
+		self.check()
+
+	def check(self):
+		if (time.time() - self.last_delivery) >= self.interval:
+			self.flush()
+
+	# Send the objects collected so far. Before we let go of them
+	# we pass them to the cache encoder.
+	def flush(self):
+		chunk = self.chunk
+		self.chunk = GpxObjectList()
+		if self.encoder is not None:
+			try:
+				self.encoder.add(chunk)
+			except TypeError as e:
+				print("Not caching:", str(e))
+				self.encoder = None
+		chunk.metadata = self.metadata
+		chunk.bounds = self.bounds
+		self.deliver(chunk)
+		self.last_delivery = time.time()
+
+	# Send the last chunk. The metadata is complete now, so encode it too.
+	def finish(self):
+		self.flush()
+		if self.encoder is not None:
+			try:
+				self.encoder.add_metadata(self.metadata)
+			except TypeError as e:
+				print("Not caching:", str(e))
+				self.encoder = None
+
+# Split a GpxObjectList into lists of at most size waypoints, routes, and
+# tracks (in that order, as add_to() adds them). Each has the metadata
+# and bounds.
+def split_objects(objects, size):
+	waypoints = objects.waypoints
+	routes = objects.routes
+	tracks = objects.tracks
+	if len(waypoints) + len(routes) + len(tracks) <= size:
+		yield objects
+		return
+	while waypoints or routes or tracks:
+		chunk = GpxObjectList()
+		chunk.metadata = objects.metadata
+		chunk.bounds = objects.bounds
+		room = size
+		chunk.waypoints, waypoints = waypoints[:room], waypoints[room:]
+		room -= len(chunk.waypoints)
+		chunk.routes, routes = routes[:room], routes[room:]
+		room -= len(chunk.routes)
+		chunk.tracks, tracks = tracks[:room], tracks[room:]
+		yield chunk
+
+class GpxBackgroundLoad(object):
+	chunk_interval = 0.5		# seconds between deliveries of objects
+	chunk_objects = 500			# most objects per delivery of a file parsed in parallel
+	progress_interval = 0.1		# seconds between progress reports
+
+	# Loads running at the same time share the cache. Each holds this
+	# only while it looks in the cache or changes it, not while it parses.
+	cache_lock = threading.Lock()
+
+	def __init__(self, filenames, cache, on_objects, on_progress, on_finished, processes=None, lazy=False):
+		self.filenames = filenames
+		self.cache = cache if not lazy else None
+		self.lazy = lazy
+		self.on_objects = on_objects
+		self.on_progress = on_progress
+		self.on_finished = on_finished
+		self.processes = processes if processes is not None else (os.cpu_count() or 1)
+		self.cancelled = False
+		self.last_progress = 0
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+
+	def start(self):
+		self.thread.start()
+
+	# Called from the main thread
+	def cancel(self):
+		self.cancelled = True
+
+	#-------------------------------------------------------------
+	# These run in the main thread
+	#-------------------------------------------------------------
+
+	def objects_cb(self, objects):
+		if not self.cancelled:
+			self.on_objects(objects)
+		return False
+
+	def progress_cb(self, fraction, filename):
+		if not self.cancelled:
+			self.on_progress(fraction, filename)
+		return False
+
+	def finished_cb(self, error):
+		self.on_finished(error)
+		return False
+
+	#-------------------------------------------------------------
+	# These run in the background thread
+	#-------------------------------------------------------------
+
+	def run(self):
+		error = None
+		try:
+			if len(self.filenames) > 1 and self.processes > 1 and not self.lazy:
+				self.load_parallel()
+			else:
+				for i in range(len(self.filenames)):
+					self.load_file(i, self.filenames[i])
+		except GpxLoadCancelled:
+			pass
+		except Exception as e:
+			error = e
+		GLib.idle_add(self.finished_cb, error)
+
+	def deliver(self, objects):
+		GLib.idle_add(self.objects_cb, objects)
+
+	# Report progress. This is also where we notice that the load
+	# has been cancelled.
+	def progress(self, file_index, fraction):
+		if self.cancelled:
+			raise GpxLoadCancelled
+		now = time.time()
+		if (now - self.last_progress) >= self.progress_interval:
+			self.last_progress = now
+			filename = self.filenames[min(file_index, len(self.filenames)-1)]
+			GLib.idle_add(self.progress_cb, (file_index + min(fraction, 1.0)) / len(self.filenames), os.path.basename(filename))
+
+	def load_parallel(self):
+		self.progress(0, 0.0)
+		i = 0
+		for objects in iter_gpx_files(self.filenames, self.cache, self.processes, self.cache_lock):
+			self.progress(i, 1.0)
+			for chunk in split_objects(objects, self.chunk_objects):
+				if self.cancelled:
+					raise GpxLoadCancelled
+				self.deliver(chunk)
+			i += 1
+
+	def load_file(self, file_index, filename):
+		self.progress(file_index, 0.0)
+		cache = self.cache
+
+		# Try the cache
+		identity = None
+		if cache is not None:
+			with self.cache_lock:
+				objects = cache.lookup(filename)
+			if objects is None:
+				identity = file_identity(filename)
+				with self.cache_lock:
+					objects = cache.fetch(identity[2])
+					if objects is not None:
+						cache.store(filename, identity, None)
+			if objects is not None:
+				with self.cache_lock:
+					cache.sync()
+				self.deliver(objects)
+				return
+
+		# Parse in chunks
+		sink = GpxChunkSink(self.deliver, self.chunk_interval)
+		if cache is not None:
+			sink.encoder = GpxCacheEncoder(copy_arrays=True)
+		loader = GpxLoader(sink)
+		size = gpx_file_size(filename)
+		loader.progress = lambda position: self.progress(file_index, float(position) / size)
+		if self.lazy:
+			loader.lazy_file = GpxLazyFile(filename)
+			loader.load(loader.lazy_file)
+		else:
+			with open_gpx_file(filename) as fh:
+				loader.load(fh)
+		sink.finish()
+		print("%d unsupported tags" % loader.unsupported_count)
+
+		if sink.encoder is not None:
+			with self.cache_lock:
+				cache.store(filename, identity, sink.encoder)
+				cache.sync()
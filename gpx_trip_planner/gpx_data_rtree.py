@@ -0,0 +1,202 @@
+#=============================================================================
+# gpx_data_rtree.py
+# In-memory R-tree for finding the objects which are in view
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+# Boxes are tuples (min_lon, min_lat, max_lon, max_lat), the same order
+# as the tuple which pykarta.geometry.BoundingBox() accepts.
+
+def bbox_to_box(bbox):
+	if not bbox.valid:
+		return None
+	return (bbox.min_lon, bbox.min_lat, bbox.max_lon, bbox.max_lat)
+
+def boxes_overlap(a, b):
+	return not (a[0] > b[2] or a[2] < b[0] or a[1] > b[3] or a[3] < b[1])
+
+def _union(a, b):
+	return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def _union_all(boxes):
+	boxes = iter(boxes)
+	result = next(boxes)
+	for box in boxes:
+		result = _union(result, box)
+	return result
+
+def _area(box):
+	return (box[2] - box[0]) * (box[3] - box[1])
+
+def _contains(outer, inner):
+	return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+class _Node(object):
+	__slots__ = ['box', 'entries', 'leaf']
+	def __init__(self, entries, leaf):
+		self.entries = entries		# (box, obj) if leaf, else child _Nodes
+		self.leaf = leaf
+		self.box = None
+		self.update_box()
+	def update_box(self):
+		if self.leaf:
+			self.box = _union_all([entry[0] for entry in self.entries]) if self.entries else None
+		else:
+			self.box = _union_all([child.box for child in self.entries]) if self.entries else None
+
+#=============================================================================
+# The tree is first built from all of the objects at once by
+# Sort-Tile-Recursive packing. After that objects can be inserted and
+# removed one at a time (in the manner of Guttman, but splitting nodes
+# in half along their longer side). The objects must be hashable.
+#=============================================================================
+class RTree(object):
+	max_entries = 16
+
+	# Items is a list of (box, obj)
+	def __init__(self, items=[]):
+		self.boxes = {}				# obj -> box
+		for box, obj in items:
+			self.boxes[obj] = box
+		self.root = self._pack(self._pack_leaves(list(items)))
+
+	def __len__(self):
+		return len(self.boxes)
+
+	#-------------------------------------------------------------
+	# Bulk loading
+	#-------------------------------------------------------------
+
+	# Sort by longitude into vertical slices, each slice by latitude,
+	# and cut the slices into leaves.
+	def _pack_leaves(self, items):
+		return [_Node(entries, True) for entries in self._tile(items, lambda item: item[0])]
+
+	# Do the same to the nodes of one level to make the level above
+	# until there is only one node.
+	def _pack(self, nodes):
+		if len(nodes) == 0:
+			return _Node([], True)
+		while len(nodes) > 1:
+			nodes = [_Node(entries, False) for entries in self._tile(nodes, lambda node: node.box)]
+		return nodes[0]
+
+	def _tile(self, items, get_box):
+		if len(items) == 0:
+			return []
+		size = self.max_entries
+		count_groups = (len(items) + size - 1) // size
+		slice_count = max(1, int(count_groups ** 0.5 + 0.5))
+		slice_size = size * ((count_groups + slice_count - 1) // slice_count)
+		items.sort(key=lambda item: get_box(item)[0] + get_box(item)[2])
+		groups = []
+		for i in range(0, len(items), slice_size):
+			vertical_slice = items[i:i+slice_size]
+			vertical_slice.sort(key=lambda item: get_box(item)[1] + get_box(item)[3])
+			for j in range(0, len(vertical_slice), size):
+				groups.append(vertical_slice[j:j+size])
+		return groups
+
+	#-------------------------------------------------------------
+	# Queries
+	#-------------------------------------------------------------
+
+	# Return the objects whose boxes overlap box
+	def search(self, box):
+		min_lon, min_lat, max_lon, max_lat = box
+		found = []
+		stack = [self.root]
+		while stack:
+			node = stack.pop()
+			if node.box is None:
+				continue
+			if node.leaf:
+				for entry_box, obj in node.entries:
+					if not (entry_box[0] > max_lon or entry_box[2] < min_lon or entry_box[1] > max_lat or entry_box[3] < min_lat):
+						found.append(obj)
+			else:
+				for child in node.entries:
+					child_box = child.box
+					if not (child_box[0] > max_lon or child_box[2] < min_lon or child_box[1] > max_lat or child_box[3] < min_lat):
+						stack.append(child)
+		return found
+
+	#-------------------------------------------------------------
+	# Changes
+	#-------------------------------------------------------------
+
+	def insert(self, obj, box):
+		if obj in self.boxes:
+			self.remove(obj)
+		self.boxes[obj] = box
+		sibling = self._insert(self.root, (box, obj))
+		if sibling is not None:			# root was split
+			self.root = _Node([self.root, sibling], False)
+
+	# Insert entry into the subtree under node. If the node had to be
+	# split, return the new node.
+	def _insert(self, node, entry):
+		box = entry[0]
+		if node.leaf:
+			node.entries.append(entry)
+		else:
+			best = None
+			for child in node.entries:
+				if child.box is None:
+					enlargement = area = 0.0
+				else:
+					area = _area(child.box)
+					enlargement = _area(_union(child.box, box)) - area
+				if best is None or (enlargement, area) < best[0]:
+					best = ((enlargement, area), child)
+			sibling = self._insert(best[1], entry)
+			if sibling is not None:
+				node.entries.append(sibling)
+		node.box = box if node.box is None else _union(node.box, box)
+		if len(node.entries) > self.max_entries:
+			return self._split(node)
+		return None
+
+	# Move half of the node's entries into a new node
+	def _split(self, node):
+		get_box = (lambda entry: entry[0]) if node.leaf else (lambda child: child.box)
+		box = node.box
+		axis = 0 if (box[2] - box[0]) >= (box[3] - box[1]) else 1
+		node.entries.sort(key=lambda entry: get_box(entry)[axis] + get_box(entry)[axis+2])
+		half = len(node.entries) // 2
+		sibling = _Node(node.entries[half:], node.leaf)
+		node.entries = node.entries[:half]
+		node.update_box()
+		return sibling
+
+	def remove(self, obj):
+		box = self.boxes.pop(obj, None)
+		if box is not None:
+			self._remove(self.root, box, obj)
+			if not self.root.leaf:
+				if len(self.root.entries) == 0:
+					self.root = _Node([], True)
+				elif len(self.root.entries) == 1:
+					self.root = self.root.entries[0]
+
+	# Remove the entry from the subtree under node. Returns True if it
+	# was found. Empty nodes are dropped. (There is no reinsertion of the
+	# entries of nodes which are merely underfull.)
+	def _remove(self, node, box, obj):
+		if node.box is None or not _contains(node.box, box):
+			return False
+		if node.leaf:
+			for i in range(len(node.entries)):
+				if node.entries[i][1] is obj:
+					del node.entries[i]
+					node.update_box()
+					return True
+			return False
+		for i in range(len(node.entries)):
+			child = node.entries[i]
+			if self._remove(child, box, obj):
+				if child.box is None:
+					del node.entries[i]
+				node.update_box()
+				return True
+		return False
@@ -0,0 +1,175 @@
+#=============================================================================
+# gpx_data_simplify.py
+# Simplify track segments for display at every zoom level
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+import math
+import threading
+import queue
+import itertools
+from array import array
+from gi.repository import GLib
+
+from gpx_projection import project_to_tilespace_arrays, NUMPY_THRESHOLD
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+#=============================================================================
+# The track layer used to run Douglas-Peucker simplification once for
+# each zoom level at which a segment was drawn, with a tolerance of one
+# pixel at that zoom (1/256 of a tile). Instead we run Douglas-Peucker
+# once without a tolerance and record, for each point, the lowest zoom
+# level at which it would have survived. The points for any zoom are
+# then those whose minimum zoom is not greater than it.
+#
+# A point survives simplification with tolerance t if its distance from
+# the line between its neighbors is greater than t and the same is true
+# of each point which was chosen before it. So its significance is the
+# smaller of its own distance and that of the point which split off the
+# part of the line which it is in.
+#=============================================================================
+
+# Minimum zoom of points which are never needed (exactly on the line)
+NEVER = 127
+
+# Return an array of minimum zoom levels for a line given as arrays of
+# x and y in tilespace at zoom 0. Long stretches are searched using
+# Numpy if it is available.
+def simplify_min_zooms(xs, ys):
+	count = len(xs)
+	min_zooms = array('b', [NEVER]) * count
+	if count == 0:
+		return min_zooms
+	min_zooms[0] = min_zooms[count-1] = 0
+	if numpy is not None and count >= NUMPY_THRESHOLD:
+		np_xs = numpy.asarray(xs, dtype=numpy.float64)
+		np_ys = numpy.asarray(ys, dtype=numpy.float64)
+	stack = [(0, count-1, float('inf'))]
+	while stack:
+		first, last, parent_significance = stack.pop()
+		if last - first < 2:
+			continue
+		ax = xs[first]
+		ay = ys[first]
+		dx = xs[last] - ax
+		dy = ys[last] - ay
+		length2 = dx * dx + dy * dy
+		if numpy is not None and last - first > NUMPY_THRESHOLD:
+			px = np_xs[first+1:last] - ax
+			py = np_ys[first+1:last] - ay
+			if length2 != 0.0:
+				t = numpy.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+				px -= t * dx
+				py -= t * dy
+			distances2 = px * px + py * py
+			max_index = int(numpy.argmax(distances2))
+			max_distance2 = float(distances2[max_index])
+			max_index += first + 1
+		else:
+			max_distance2 = -1.0
+			max_index = None
+			for index in range(first + 1, last):
+				px = xs[index] - ax
+				py = ys[index] - ay
+				if length2 != 0.0:
+					t = (px * dx + py * dy) / length2
+					if t > 1.0:
+						t = 1.0
+					if t > 0.0:
+						px -= t * dx
+						py -= t * dy
+				distance2 = px * px + py * py
+				if distance2 > max_distance2:
+					max_distance2 = distance2
+					max_index = index
+		significance = min(math.sqrt(max_distance2), parent_significance)
+		min_zooms[max_index] = _min_zoom(significance)
+		stack.append((first, max_index, significance))
+		stack.append((max_index, last, significance))
+	return min_zooms
+
+# The lowest zoom z at which distance exceeds the tolerance 1/(256*2**z)
+def _min_zoom(distance):
+	if distance <= 0.0:
+		return NEVER
+	zoom = int(math.floor(-8.0 - math.log(distance, 2))) + 1
+	return max(0, min(zoom, NEVER))
+
+# Project a segment's points and work out their minimum zooms.
+# Returns ((xs, ys), min_zooms).
+def simplify_segment(lats, lons):
+	xs, ys = project_to_tilespace_arrays(lats, lons)
+	return ((xs, ys), simplify_min_zooms(xs, ys))
+
+# Return the (xs, ys, indices) of the projected points which are needed
+# at zoom, where indices are their positions in the segment
+def points_at_zoom(projected, min_zooms, zoom):
+	xs, ys = projected
+	if numpy is not None and len(xs) >= NUMPY_THRESHOLD:
+		keep = numpy.frombuffer(min_zooms, dtype=numpy.int8) <= zoom
+		return (
+			array('d', numpy.frombuffer(xs, dtype=numpy.float64)[keep].tobytes()),
+			array('d', numpy.frombuffer(ys, dtype=numpy.float64)[keep].tobytes()),
+			array('q', numpy.flatnonzero(keep).astype(numpy.int64).tobytes())
+			)
+	keep = [min_zoom <= zoom for min_zoom in min_zooms]
+	return (
+		array('d', itertools.compress(xs, keep)),
+		array('d', itertools.compress(ys, keep)),
+		array('q', itertools.compress(range(len(keep)), keep))
+		)
+
+#=============================================================================
+# GpxSimplifier does the work for newly-loaded track segments in a
+# background thread so that the first time the user zooms in on a long
+# track the GUI does not stall. The results are handed to the segment in
+# the main thread. If the segment has been changed in the meantime, they
+# are thrown away. Segments which have not been simplified by the time
+# they are drawn are simplified then (see GpxTrackSegment).
+#=============================================================================
+
+class GpxSimplifier(object):
+	def __init__(self):
+		self.queue = queue.Queue()
+		self.thread = None
+
+	# Called from the main thread
+	def add(self, segments):
+		for segment in segments:
+			if segment.lazy is None and segment.projected is None:
+				self.queue.put(segment)
+		if self.thread is None and not self.queue.empty():
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+
+	# Forget the segments which are waiting (for instance, when the document is closed)
+	def clear(self):
+		try:
+			while True:
+				self.queue.get_nowait()
+		except queue.Empty:
+			pass
+
+	# If a segment can not be simplified, it is left for the drawing
+	# code to try. The thread goes on to the next one.
+	def run(self):
+		while True:
+			segment = self.queue.get()
+			try:
+				lats = segment.lats[:]
+				lons = segment.lons[:]
+				projected, min_zooms = simplify_segment(lats, lons)
+			except Exception as e:
+				print("Failed to simplify segment: %s: %s" % (e.__class__.__name__, str(e)))
+				continue
+			GLib.idle_add(self.install, segment, lats, lons, projected, min_zooms)
+
+	def install(self, segment, lats, lons, projected, min_zooms):
+		if segment.lazy is None and segment.projected is None and segment.lats == lats and segment.lons == lons:
+			segment.set_simplification(projected, min_zooms)
+		return False
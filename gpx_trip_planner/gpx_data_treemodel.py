@@ -0,0 +1,257 @@
+#=============================================================================
+# gpx_data_treemodel.py
+# Tree model which presents the tracks to a Gtk.TreeView
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+from gi.repository import Gtk
+from gi.repository import GObject
+
+# This takes the place of the Gtk.TreeStore which GpxTracks used to keep.
+# There are no rows as such. Instead the tracks are kept in self.tracks,
+# the segments of each track in track.segments, and the points in the
+# arrays of each segment. The rows which the Gtk.TreeView asks for are
+# worked out on demand from these lists. That means that nothing is
+# done for the points of a segment until the user expands it.
+#
+# A tree iter holds the indexes of the track, the segment, and the
+# point (each plus one so that zero means "none") in its three
+# user_data fields. Iters are therefore only good until the next change.
+#
+# The tracks and segments tell us when they change by calling
+# child_inserted(), child_deleted(), and children_replaced() so that
+# we can send the signals which the Gtk.TreeView needs.
+class GpxTrackTreeModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource, Gtk.TreeDragDest):
+	def __init__(self):
+		GObject.GObject.__init__(self)
+		self.tracks = []
+		self.stamp = 0x47505854
+
+	#-------------------------------------------------------------
+	# Access by index
+	#-------------------------------------------------------------
+
+	# Return the track, segment, or point at the indicated path
+	# (as a tuple). Raises IndexError if there is nothing there.
+	def get_object(self, indices):
+		obj = self.tracks[indices[0]]
+		for index in indices[1:]:
+			if index < 0:
+				raise IndexError
+			obj = obj[index]
+		return obj
+
+	# Return the path (as a tuple) of a track or track segment
+	# or None if it is not in this model.
+	def get_indices(self, obj):
+		track_i = 0
+		for track in self.tracks:
+			if track is obj:
+				return (track_i,)
+			seg_i = 0
+			for segment in track.segments:
+				if segment is obj:
+					return (track_i, seg_i)
+				seg_i += 1
+			track_i += 1
+		return None
+
+	def _n_children(self, indices):
+		if len(indices) == 0:
+			return len(self.tracks)
+		if len(indices) == 1:
+			return len(self.tracks[indices[0]].segments)
+		if len(indices) == 2:
+			return len(self.tracks[indices[0]].segments[indices[1]])
+		return 0
+
+	def _valid(self, indices):
+		if len(indices) < 1 or len(indices) > 3:
+			return False
+		for i in range(len(indices)):
+			if indices[i] < 0 or indices[i] >= self._n_children(indices[:i]):
+				return False
+		return True
+
+	def _make_iter(self, indices):
+		iter = Gtk.TreeIter()
+		iter.stamp = self.stamp
+		iter.user_data = indices[0] + 1
+		iter.user_data2 = indices[1] + 1 if len(indices) > 1 else 0
+		iter.user_data3 = indices[2] + 1 if len(indices) > 2 else 0
+		return iter
+
+	def _set_iter(self, iter, indices):
+		iter.stamp = self.stamp
+		iter.user_data = indices[0] + 1
+		iter.user_data2 = indices[1] + 1 if len(indices) > 1 else 0
+		iter.user_data3 = indices[2] + 1 if len(indices) > 2 else 0
+
+	def _iter_indices(self, iter):
+		if iter is None:
+			return ()
+		indices = [iter.user_data - 1]
+		if iter.user_data2:
+			indices.append(iter.user_data2 - 1)
+			if iter.user_data3:
+				indices.append(iter.user_data3 - 1)
+		return tuple(indices)
+
+	#-------------------------------------------------------------
+	# Gtk.TreeModel implementation
+	#-------------------------------------------------------------
+
+	def do_get_flags(self):
+		return 0
+
+	def do_get_n_columns(self):
+		return 1
+
+	def do_get_column_type(self, index):
+		return GObject.TYPE_PYOBJECT
+
+	def do_get_iter(self, path):
+		indices = tuple(path.get_indices())
+		if self._valid(indices):
+			return (True, self._make_iter(indices))
+		return (False, None)
+
+	def do_get_path(self, iter):
+		return Gtk.TreePath.new_from_indices(self._iter_indices(iter))
+
+	def do_get_value(self, iter, column):
+		return self.get_object(self._iter_indices(iter))
+
+	def do_iter_next(self, iter):
+		indices = self._iter_indices(iter)
+		indices = indices[:-1] + (indices[-1] + 1,)
+		if indices[-1] < self._n_children(indices[:-1]):
+			self._set_iter(iter, indices)
+			return True
+		return False
+
+	def do_iter_previous(self, iter):
+		indices = self._iter_indices(iter)
+		if indices[-1] > 0:
+			self._set_iter(iter, indices[:-1] + (indices[-1] - 1,))
+			return True
+		return False
+
+	def do_iter_children(self, parent):
+		return self.do_iter_nth_child(parent, 0)
+
+	def do_iter_has_child(self, iter):
+		return self._n_children(self._iter_indices(iter)) > 0
+
+	def do_iter_n_children(self, iter):
+		return self._n_children(self._iter_indices(iter))
+
+	def do_iter_nth_child(self, parent, n):
+		indices = self._iter_indices(parent)
+		if len(indices) < 3 and n >= 0 and n < self._n_children(indices):
+			return (True, self._make_iter(indices + (n,)))
+		return (False, None)
+
+	def do_iter_parent(self, child):
+		indices = self._iter_indices(child)
+		if len(indices) > 1:
+			return (True, self._make_iter(indices[:-1]))
+		return (False, None)
+
+	#-------------------------------------------------------------
+	# Changes to the tracks
+	#-------------------------------------------------------------
+
+	def insert_track(self, index, track):
+		track.datastore = self
+		for segment in track.segments:
+			segment.datastore = self
+		self.tracks.insert(index, track)
+		self._row_inserted((index,))
+
+	# Remove the track, segment, or point at the indicated path.
+	def remove_path(self, indices):
+		if len(indices) == 1:
+			self.tracks.pop(indices[0])
+			self.row_deleted(Gtk.TreePath.new_from_indices(indices))
+		else:
+			del self.get_object(indices[:-1])[indices[-1]]
+
+	def clear(self):
+		while len(self.tracks) > 0:
+			self.remove_path((len(self.tracks) - 1,))
+
+	# Send row-changed for the indicated path
+	def touch(self, indices):
+		indices = tuple(indices)
+		self.row_changed(Gtk.TreePath.new_from_indices(indices), self._make_iter(indices))
+
+	# A track or a segment has inserted a child
+	def child_inserted(self, parent, index):
+		parent_indices = self.get_indices(parent)
+		if parent_indices is not None:
+			self._row_inserted(parent_indices + (index,))
+			if self._n_children(parent_indices) == 1:
+				self.row_has_child_toggled(Gtk.TreePath.new_from_indices(parent_indices), self._make_iter(parent_indices))
+
+	# A track or a segment has removed a child
+	def child_deleted(self, parent, index):
+		parent_indices = self.get_indices(parent)
+		if parent_indices is not None:
+			self.row_deleted(Gtk.TreePath.new_from_indices(parent_indices + (index,)))
+			if self._n_children(parent_indices) == 0:
+				self.row_has_child_toggled(Gtk.TreePath.new_from_indices(parent_indices), self._make_iter(parent_indices))
+
+	# A track or segment has changed so many of its children that it
+	# is better to have the Gtk.TreeView start over with it.
+	def children_replaced(self, parent):
+		indices = self.get_indices(parent)
+		if indices is not None:
+			self.row_deleted(Gtk.TreePath.new_from_indices(indices))
+			self._row_inserted(indices)
+
+	def _row_inserted(self, indices):
+		path = Gtk.TreePath.new_from_indices(indices)
+		self.row_inserted(path, self._make_iter(indices))
+		if self._n_children(indices) > 0:
+			self.row_has_child_toggled(path, self._make_iter(indices))
+
+	#-------------------------------------------------------------
+	# Drag-and-drop reordering of tracks and track segments
+	# GpxFancyTreeView.drag_motion_cb() limits what the user can try.
+	#-------------------------------------------------------------
+
+	def do_row_draggable(self, path):
+		return len(path.get_indices()) < 3	# points stay put
+
+	def do_drag_data_get(self, path, selection_data):
+		return Gtk.tree_set_row_drag_data(selection_data, self, path)
+
+	def do_drag_data_delete(self, path):
+		self.remove_path(tuple(path.get_indices()))
+		return True
+
+	def do_row_drop_possible(self, dest_path, selection_data):
+		ok, model, source_path = Gtk.tree_get_row_drag_data(selection_data)
+		if not ok or model is not self:
+			return False
+		source = source_path.get_indices()
+		dest = dest_path.get_indices()
+		if len(source) != len(dest) or len(source) > 2:
+			return False
+		if len(dest) == 2 and dest[0] >= len(self.tracks):
+			return False
+		return True
+
+	def do_drag_data_received(self, dest_path, selection_data):
+		if not self.do_row_drop_possible(dest_path, selection_data):
+			return False
+		ok, model, source_path = Gtk.tree_get_row_drag_data(selection_data)
+		obj = self.get_object(tuple(source_path.get_indices()))
+		dest = dest_path.get_indices()
+		if len(dest) == 1:
+			self.insert_track(min(dest[0], len(self.tracks)), obj)
+		else:
+			track = self.tracks[dest[0]]
+			track.insert(min(dest[1], len(track.segments)), obj)
+		return True
@@ -8,7 +8,6 @@ import sys, os
 from gi.repository import Gtk, Gdk, GdkPixbuf
 import math
 import glob
-import re
 import gettext
 import datetime
 import codecs
@@ -33,9 +32,12 @@ import gpx_reference_layers
 import gpx_colors
 
 from gpx_data_gpx import GpxData, GpxWriter, GpxWaypoint, GpxRoute, GpxRoutePoint, GpxMetadata
+from gpx_data_loader import GpxBackgroundLoad, open_gpx_file
+from gpx_data_simplify import GpxSimplifier
 from gpx_data_pois import PoiDB
 from gpx_data_search import search_nominatim, SearchMatches
 from gpx_data_photos import GpxPhotos
+from gpx_data_catalog import TrackCatalog
 
 from gpx_layer_waypoints import WaypointLayer
 from gpx_layer_routes import RouteLayer
@@ -91,6 +93,16 @@ class GpxSimpleTreeView(object):
 			self.selection.select_path(path)
 		self.signal_enabled = True
 
+	# The data is about to undergo extensive changes. Keeping the treeview
+	# connected would mean that it would process each one.
+	def on_bulk_begin(self):
+		self.signal_enabled = False
+		self.treeview.set_model(None)
+
+	def on_bulk_end(self):
+		self.treeview.set_model(self.data.datastore)
+		self.signal_enabled = True
+
 	# Callback from Treeview widget for when the user selects a different row.
 	def selection_changed_cb(self, widget, data=None):
 		if self.signal_enabled:		# if not a result of calling select(),
@@ -653,7 +665,9 @@ class GpxEditMenu(object):
 		print("Edit->Cut")
 		import io
 		fh = io.StringIO()
-		self.get_selected_obj().write(GpxWriter(fh))
+		writer = GpxWriter(fh)
+		self.get_selected_obj().write(writer)
+		writer.close()
 		self.clipboard.set_text(fh.getvalue())
 		self.clipboard.store()		# needed?
 		self.del_selected_obj()
@@ -662,7 +676,9 @@ class GpxEditMenu(object):
 		print("Edit->Copy")
 		import io
 		fh = io.StringIO()
-		self.get_selected_obj().write(GpxWriter(fh))
+		writer = GpxWriter(fh)
+		self.get_selected_obj().write(writer)
+		writer.close()
 		self.clipboard.set_text(fh.getvalue())
 		self.clipboard.store()		# needed?
 
@@ -783,11 +799,12 @@ class GpxRouteToolsMenu(object):
 		print("Tools->Flesh out Route")
 		saved_selected = self.selected
 		route = self.route_data[self.selected[0]]		# takes route of selected point
-		self.strip(route)
 		router = GpxRouter()
 		busy = self.ui.busy("Routing...")
 		try:
-			router.flesh_out(route)
+			with self.route_data.bulk():
+				self.strip(route)
+				router.flesh_out(route)
 		except Exception as e:
 			self.ui.error_dialog_exception(_("Routing Failed"), e)
 		print("Route now has %d points" % len(route))
@@ -797,21 +814,25 @@ class GpxRouteToolsMenu(object):
 		print("Tools->Pare Route")
 		saved_selected = self.selected
 		route = self.route_data[self.selected[0]]
-		i = 1
-		while i < (len(route) - 1):
-			point = route[i]
-			next_point = route[i+1]
-			if point.type == 'guide' and next_point.type == 'maneuver':
-				next_point.type = 'guide'
-				del route[i]
-			i += 1
+		points = list(route)
+		with self.route_data.bulk():
+			i = 1
+			while i < (len(points) - 1):
+				point = points[i]
+				next_point = points[i+1]
+				if point.type == 'guide' and next_point.type == 'maneuver':
+					next_point.type = 'guide'
+					del points[i]
+				i += 1
+			route.replace(points)
 		self.route_data.select((saved_selected[0],), "tools_route")
 
 	def on_strip_route(self, widget):
 		print("Tools->Strip Route")
 		saved_selected = self.selected
 		route = self.route_data[self.selected[0]]
-		self.strip(route)
+		with self.route_data.bulk():
+			self.strip(route)
 		self.route_data.select((saved_selected[0],), "tools_route")
 
 	def on_reverse_route(self, widget):
@@ -819,30 +840,99 @@ class GpxRouteToolsMenu(object):
 		route = self.route_data[self.selected[0]]
 		saved_selected = self.selected
 
-		new_points = []
-		prev_route_shape = []
-		while len(route) > 0:			# pull out points and build reversed route
-			point = route[0]
-			del route[0]
-			this_route_shape = point.route_shape
-			print("shape:", prev_route_shape)
-			point.route_shape = list(reversed(prev_route_shape))
-			prev_route_shape = this_route_shape
-			new_points.insert(0, point)
-		for point in new_points:		# push points from reversed route in
-			route.append(point)
+		# Each point's shape leads to the next point, so after reversal
+		# it belongs to the point which came before it.
+		new_points = list(reversed(route))
+		with self.route_data.bulk():
+			prev_route_shape = []
+			for point in reversed(new_points):
+				this_route_shape = point.route_shape
+				point.route_shape = list(reversed(prev_route_shape))
+				prev_route_shape = this_route_shape
+			route.replace(new_points)
 
 		self.route_data.select((saved_selected[0],), "tools_route")
 
 	# Remove any points added by a previous run.
 	def strip(self, route):
-		i = 0
-		while i < len(route):
-			if route[i].type == 'maneuver':
-				del route[i]
+		points = [point for point in route if point.type != 'maneuver']
+		for point in points:
+			point.route_shape = []
+		route.replace(points)
+
+#=============================================================================
+# Loading of GPX files in the background
+# The objects are added to the data store as they arrive. As soon as we have
+# an idea of where they are, we zoom to them. A small window shows the
+# progress and has a button to cancel the load.
+#=============================================================================
+
+class GpxLoadMonitor(object):
+	def __init__(self, gui, gpx_files, title, when_done, mark):
+		self.gui = gui
+		self.when_done = when_done
+		self.mark = mark
+		self.zoomed_bbox = None
+
+		self.window = Gtk.Window(title=title)
+		self.window.set_transient_for(gui.main_window)
+		self.window.set_default_size(400, -1)
+		self.window.connect("delete-event", self.cancel_cb)
+		vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+		vbox.set_border_width(10)
+		self.progress_bar = Gtk.ProgressBar()
+		self.progress_bar.set_show_text(True)
+		vbox.pack_start(self.progress_bar, False, False, 0)
+		button = Gtk.Button(label=_("Cancel"))
+		button.connect("clicked", self.cancel_cb)
+		vbox.pack_start(button, False, False, 0)
+		self.window.add(vbox)
+		self.window.show_all()
+
+		self.load = GpxBackgroundLoad(gpx_files, gui.cache, self.on_objects, self.on_progress, self.on_finished, lazy=gui.lazy_load)
+		self.load.start()
+
+	def cancel(self):
+		self.load.cancel()
+
+	def cancel_cb(self, *args):
+		print("Load cancelled")
+		self.cancel()
+		return True
+
+	def on_objects(self, objects):
+		objects.add_to(self.gui.data)
+		self.gui.simplifier.add([segment for track in objects.tracks for segment in track])
+		if self.zoomed_bbox is None:
+			if objects.bounds is not None:
+				min_lat, min_lon, max_lat, max_lon = objects.bounds
+				bbox = pykarta.geometry.BoundingBox((min_lon, min_lat, max_lon, max_lat))
 			else:
-				route[i].route_shape = []
-				i += 1
+				bbox = self.gui.data.get_bbox(mark=self.mark)
+			if bbox.valid:
+				self.gui.map.zoom_to_extent(bbox)
+				self.zoomed_bbox = bbox
+
+	def on_progress(self, fraction, filename):
+		self.progress_bar.set_fraction(fraction)
+		self.progress_bar.set_text(filename)
+
+	def on_finished(self, error):
+		self.window.destroy()
+		if self.gui.background_load is self:
+			self.gui.background_load = None
+		if error is not None:
+			self.gui.ui.error_dialog_exception(_("Loading file"), error)
+		elif not self.load.cancelled:
+			if self.when_done is not None:
+				self.when_done()
+
+			# If our first guess at where the objects are missed some, zoom again.
+			bbox = self.gui.data.get_bbox(mark=self.mark)
+			if bbox.valid and (self.zoomed_bbox is None
+					or not self.zoomed_bbox.contains_point(pykarta.geometry.Point(bbox.min_lat, bbox.min_lon))
+					or not self.zoomed_bbox.contains_point(pykarta.geometry.Point(bbox.max_lat, bbox.max_lon))):
+				self.gui.map.zoom_to_extent(bbox)
 
 #=============================================================================
 # Main
@@ -850,8 +940,9 @@ class GpxRouteToolsMenu(object):
 
 class GpxGUI(object):
 
-	def __init__(self, profile_dir):
+	def __init__(self, profile_dir, cache_size=256, lazy_load=False):
 		self.profile_dir = profile_dir
+		self.lazy_load = lazy_load		# leave track points in the file until needed?
 
 		self.app_name = "GPX Trip Planner"
 		self.bookmarks_filename = os.path.join(self.profile_dir, "bookmarks.csv")
@@ -863,6 +954,8 @@ class GpxGUI(object):
 		self.loaded_tracks = set([])
 		self.latlon_units = 'deg'
 		self.save_filename = None
+		self.background_load = None
+		self.simplifier = GpxSimplifier()
 
 		#------------------------
 		# Load GUI description
@@ -907,6 +1000,14 @@ class GpxGUI(object):
 		# as the map and the sidebar takes place.
 		self.data = GpxData()
 
+		# Parsed GPX files are cached so that they can be reopened quickly.
+		# The size limit is in megabytes. Zero turns the cache off.
+		if cache_size > 0:
+			from gpx_data_cache import GpxCache
+			self.cache = GpxCache(os.path.join(self.profile_dir, "Cache"), cache_size * 1024 * 1024)
+		else:
+			self.cache = None
+
 		#---------------------------------------------------------
 		# GPS
 		#---------------------------------------------------------
@@ -1405,61 +1506,30 @@ class GpxGUI(object):
 
 			# We will look for tracks which cross the bounding box of the current map view.
 			map_bbox = self.map.get_bbox()
-	
-			# Files output by gpx-track-proprocessor have the bounding box in the file name.
-			# track_20080805_44.766400,-68.710580,44.319430,-68.177950.gpx.gz
-			filename_pattern = re.compile("track_\d\d\d\d\d\d\d\d_([0-9\.-]+),([0-9\.-]+),([0-9\.-]+),([0-9\.-]+)\.")
-	
-			# We use this regexp to make sure that the track actual crosses the map.
-			# Note that we are cheating: we can get away with not using an actual
-			# XML parser because we are reading only files which gpx-track-processor
-			# generated.
-			# <trkpt lat="42.096480999999997" lon="-72.724260999999998">
-			point_pattern = re.compile('<trkpt lat="([0-9\.-]+)" lon="([0-9\.-]+)">')
-	
+
+			# Gpx-track-preprocessor records the bounding box of each track
+			# segment it writes in a catalog. Files written before there was
+			# a catalog are scanned and added to it now (once).
 			progress_dialog = self.ui.progress_dialog()
-			filenames = glob.glob(os.path.join(self.processed_tracks_dir, "track_*.gpx.gz"))
+			catalog = TrackCatalog(self.processed_tracks_dir)
+			catalog.sync(progress=lambda count, total: progress_dialog.progress(count, total, _("Cataloging preprocessed tracks...")))
+			filenames = catalog.find(map_bbox)
+			catalog.close()
+
 			count = 0
 			for filename in filenames:
 				print(filename)
 				progress_dialog.progress(count, len(filenames), _("Importing tracks which cross the map view..."))
-	
-				# Extract the track's bounding box from its file name.
-				m = filename_pattern.match(os.path.basename(filename))
-				assert m
-				track_bbox = pykarta.geometry.BoundingBox((float(m.group(1)), float(m.group(2)), float(m.group(3)), float(m.group(4))))
-	
-				# Start by testing whether the bounding boxes overlap. If they do,
-				# we will open the file and examine the points.
-				if map_bbox.overlaps(track_bbox):
-					print(" bounding boxes overlap")
-	
-					# Now open the file and perform a quick-and-dirty check to make
-					# sure at least one point is inside the map viewport.
-					fh = self.open_gz_r(filename)
-					crosses = False
-					for line in fh:
-						m = point_pattern.search(line)
-						if m:
-							point = pykarta.geometry.Point(float(m.group(1)), float(m.group(2)))
-							if map_bbox.contains_point(point):
-								crosses = True
-								break
-	
-					if crosses:
-						print(" crosses view")
-						if filename in self.loaded_tracks:
-							print(" was already loaded")
-						else:
-							print(" loading")
-							fh.rewind()
-							self.data.load_gpx(fh)
-							self.loaded_tracks.add(filename)
-	
+				if filename in self.loaded_tracks:
+					print(" was already loaded")
+				else:
+					print(" loading")
+					self.data.load_gpx(self.open_gz_r(filename))
+					self.loaded_tracks.add(filename)
 				count += 1
 		except Exception as e:
 			self.ui.error_dialog_exception(_("Importing Preprocessed Tracks"), e)
-	
+
 	def on_file_load_photographs(self, widget):
 		print("File->Load Photographs")
 		folder = self.choose_file(title=_("Choose Folder"), action='open_folder')
@@ -1585,54 +1655,53 @@ class GpxGUI(object):
 
 	# Clear out the data leaving a blank nameless document.
 	def clear(self):
+		self.simplifier.clear()
 		self.data.clear()	
 		self.set_save_filename(None)
 		self.first_picker.reset()
 
-	# Clear the document and load the files named. Zoom and pan to the best show the objects.
+	# Clear the document and load the files named. The files are loaded in
+	# the background. Zoom and pan to the best show the objects.
 	def open_files(self, gpx_files):
-		try:
-			self.clear()
-
-			# Add each file to the data store
-			for filename in gpx_files:
-				busy = self.ui.busy(_("Loading %s...") % filename)
-				self.data.load_gpx(self.open_gz_r(filename))
-	
+		self.cancel_background_load()
+		self.clear()
+		def when_done():
 			# If we loaded from only one file, that is the file to which we expect to save.
 			if len(gpx_files) == 1:
 				self.set_save_filename(gpx_files[0])
 
 			# Loading the data will have set the changed-document indicator. Clear it.
 			self.data.clear_changes()
-
-			# Bring the loaded objects into view.
-			self.map.zoom_to_extent(self.data.get_bbox())
-		except Exception as e:
-			self.ui.error_dialog_exception(_("Loading file"), e)
+		self.background_load = GpxLoadMonitor(self, gpx_files, _("Loading"), when_done, self.data.get_mark())
 
 	# Load more data from the files named. Zoom and pan to best show the new objects.
+	# The (small) .loc and .xml files are loaded right away, the GPX files in
+	# the background.
 	def import_files(self, gpx_files):
+		self.cancel_background_load()
 		mark = self.data.get_mark()
-		for filename in gpx_files:
-			busy = self.ui.busy(_("Importing %s...") % filename)
-			if os.path.splitext(filename)[1] == ".loc":
-				import gpx_import_loc
-				gpx_import_loc.load(filename, self.data)
-			elif os.path.splitext(filename)[1] == ".xml":
-				import gpx_import_xml
-				gpx_import_xml.load(filename, self.data)
-			else:
-				self.data.load_gpx(self.open_gz_r(filename))
-		self.map.zoom_to_extent(self.data.get_bbox(mark=mark))
+		load_files = []
+		with self.data.bulk():
+			for filename in gpx_files:
+				if os.path.splitext(filename)[1] == ".loc":
+					import gpx_import_loc
+					gpx_import_loc.load(filename, self.data)
+				elif os.path.splitext(filename)[1] == ".xml":
+					import gpx_import_xml
+					gpx_import_xml.load(filename, self.data)
+				else:
+					load_files.append(filename)
+		self.background_load = GpxLoadMonitor(self, load_files, _("Importing"), None, mark)
+
+	# Stop the background load (if any) before starting a new one
+	def cancel_background_load(self):
+		if self.background_load is not None:
+			self.background_load.cancel()
+			self.background_load = None
 
 	# Open a file (possibly in Gzip format) for read.
 	def open_gz_r(self, filename):
-		if os.path.splitext(filename)[1] == ".gz":
-			import gzip
-			return gzip.open(filename, "r")
-		else:
-			return open(filename, "r")
+		return open_gpx_file(filename)
 
 	# This function does the actual work of saving the current document.
 	# * If filename is None, ask the user to choose one.
@@ -1644,14 +1713,14 @@ class GpxGUI(object):
 				title="Save As",
 				action='save',
 				filetypes=[
-					["GPS Exchange Files", ["*.gpx"]]
+					["GPS Exchange Files", ["*.gpx", "*.gpx.gz"]]
 					]
 				)
 			if not filename:
 				return False
 
 			# Add .gpx extension if it is missing.
-			if os.path.splitext(filename)[1] != ".gpx":
+			if not (filename.endswith(".gpx") or filename.endswith(".gpx.gz")):
 				filename = "%s.gpx" % filename
 
 			if os.path.exists(filename):
@@ -1659,11 +1728,33 @@ class GpxGUI(object):
 					return False
 
 		busy = self.ui.busy(_("Saving to %s...") % filename)
-		f = pyapp.save.SaveOpen(filename)
-		writer = GpxWriter(f)
-		self.data.write(writer)
-		writer = None
-		f.close()
+		if os.path.splitext(filename)[1] == ".gz":
+			# Compressed using all of the cores. Written to a temporary
+			# file which replaces the old one only once it is complete.
+			from gpx_data_gzip import ParallelGzipFile
+			temp_filename = filename + ".tmp"
+			f = ParallelGzipFile(temp_filename)
+			try:
+				writer = GpxWriter(f)
+				self.data.write(writer)
+				writer.close()
+				f.close()
+			except:
+				# Do not leave a partial file behind
+				try:
+					f.close()
+				except Exception:
+					pass
+				if os.path.exists(temp_filename):
+					os.unlink(temp_filename)
+				raise
+			os.replace(temp_filename, filename)
+		else:
+			f = pyapp.save.SaveOpen(filename)
+			writer = GpxWriter(f)
+			self.data.write(writer)
+			writer.close()
+			f.close()
 
 		self.data.clear_changes()
 		self.set_save_filename(filename)
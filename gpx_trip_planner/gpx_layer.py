@@ -6,7 +6,10 @@
 # Last modified: 18 December 2014
 #=============================================================================
 
+import math
 from pykarta.maps.layers import MapLayer
+import pykarta.geometry
+from gpx_projection import MapProjection
 
 class GpxEditableLayer(MapLayer):
 	def __init__(self):
@@ -15,6 +18,9 @@ class GpxEditableLayer(MapLayer):
 		self.layer_objs = None
 		self.visible_objs = []
 		self.selected_path = None
+		self.projection = None		# set by do_viewport()
+		self.projected_objs = {}		# see project_objs
+		self.hit_grid = None			# see get_hit_grid()
 
 	# Called whenever the selection is changed by a viewer other than this one.
 	def on_select(self, path, source, client_name):
@@ -49,19 +55,28 @@ class GpxEditableLayer(MapLayer):
 	def create_tool_delete(self):
 		raise NotImplementedError
 
+	# Set this in layers whose objects are points. do_viewport() will then
+	# project all of the visible ones at once and leave their screen
+	# positions in self.projected_objs (indexed like the layer objects)
+	# for the renderers.
+	project_objs = False
+
 	# Identify the objects which are within the viewport determine which
 	# of them should be rendered (based on other criteria), and create
-	# renders for them in self.visible_objs.
+	# renders for them in self.visible_objs. The data store keeps a
+	# spatial index, so objects far from the viewport are not examined.
 	def do_viewport(self):
 		map_bbox = self.containing_map.get_bbox()
+		self.projection = MapProjection(self.containing_map)
+		self.hit_grid = None
 		self.visible_objs = []
-		index = 0
-		for obj in self.layer_objs:
-			if obj.gpxtp_show and obj.get_bbox().overlaps(map_bbox):
-				renderer = self.create_renderer(obj, index)
-				if renderer is not None:
-					self.visible_objs.append(renderer)
-			index += 1
+		found = [(index, obj) for index, obj in self.layer_objs.find_in_bbox(map_bbox) if obj.gpxtp_show]
+		if self.project_objs:
+			self.projected_objs = dict(zip([index for index, obj in found], self.projection.project_points([obj for index, obj in found])))
+		for index, obj in found:
+			renderer = self.create_renderer(obj, index)
+			if renderer is not None:
+				self.visible_objs.append(renderer)
 		self.containing_map.feedback.debug(1, " %s: %d of %d objects visible" % (self.__class__.__name__, len(self.visible_objs), len(self.layer_objs)))
 
 	# All objects which are within the viewport will be passed to this
@@ -71,6 +86,19 @@ class GpxEditableLayer(MapLayer):
 	def create_renderer(self, obj, index):
 		return None
 
+	# Return a PixelGrid of the things on the screen which can be clicked
+	# on. It is filled in by fill_hit_grid() the first time that it is
+	# needed after do_viewport(). Tools which move the renderers' points
+	# should set self.hit_grid to None.
+	def get_hit_grid(self):
+		if self.hit_grid is None:
+			self.hit_grid = PixelGrid(self.containing_map)
+			self.fill_hit_grid(self.hit_grid)
+		return self.hit_grid
+
+	def fill_hit_grid(self, grid):
+		pass
+
 	# Draw the objects which do_viewport() determined are visible.
 	def do_draw(self, ctx):
 		for obj in self.visible_objs:
@@ -109,3 +137,121 @@ class GpxTool(object):
 def points_close(p1, p2, tolerance=10):
 	return abs(p1[0] - p2[0]) <= tolerance and abs(p1[1] - p2[1]) <= tolerance
 
+#=============================================================================
+# PixelGrid is a spatial hash of the points and lines which are on the
+# screen. It answers the question which the tools ask on every click:
+# what is under the mouse pointer? Each item is put in the square cells
+# of the grid which it touches, so a query looks only at the items in
+# the cells around the pointer rather than at everything in view.
+#
+# Points are close to the pointer if they are within a square of the
+# indicated tolerance (as in points_close()). Of several, the nearest
+# wins and of equally near ones, the one added last (which is drawn on
+# top).
+#=============================================================================
+class PixelGrid(object):
+	cell_size = 32
+
+	def __init__(self, containing_map=None):
+		self.points = {}		# (column, row) -> [(x, y, order, item)]
+		self.lines = {}			# (column, row) -> [(p1, p2, order, item)]
+		self.order = 0
+		# Only the parts of lines which are near the screen are indexed.
+		if containing_map is not None:
+			self.bounds = (-self.cell_size, -self.cell_size, containing_map.width + self.cell_size, containing_map.height + self.cell_size)
+		else:
+			self.bounds = None
+
+	def _cell(self, x, y):
+		return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+	def _cells_around(self, point, distance):
+		col_min, row_min = self._cell(point[0] - distance, point[1] - distance)
+		col_max, row_max = self._cell(point[0] + distance, point[1] + distance)
+		for col in range(col_min, col_max + 1):
+			for row in range(row_min, row_max + 1):
+				yield (col, row)
+
+	def add_point(self, point, item):
+		x, y = point
+		self.points.setdefault(self._cell(x, y), []).append((x, y, self.order, item))
+		self.order += 1
+
+	# Add each line segment of a line string. Item_function(i) gives the
+	# item for the segment which starts at points[i].
+	def add_line_string(self, points, item_function):
+		for i in range(len(points) - 1):
+			self.add_line(points[i], points[i+1], item_function(i))
+
+	# The line is sampled at intervals of half a cell and each sample
+	# is put in the cell which it falls in. So every part of the line is
+	# within a quarter cell of a sample.
+	def add_line(self, p1, p2, item):
+		line = (p1, p2, self.order, item)
+		self.order += 1
+		if self.bounds is not None:
+			clipped = _clip_line(p1, p2, self.bounds)
+			if clipped is None:
+				return
+			p1, p2 = clipped
+		step = self.cell_size / 2.0
+		count = int(math.hypot(p2[0] - p1[0], p2[1] - p1[1]) / step) + 1
+		cells = set()
+		for i in range(count + 1):
+			t = float(i) / count
+			cells.add(self._cell(p1[0] + t * (p2[0] - p1[0]), p1[1] + t * (p2[1] - p1[1])))
+		for cell in cells:
+			self.lines.setdefault(cell, []).append(line)
+
+	# Return the items of the points within tolerance of point, nearest first.
+	def find_points(self, point, tolerance=10):
+		px, py = point
+		found = []
+		for cell in self._cells_around(point, tolerance):
+			for x, y, order, item in self.points.get(cell, ()):
+				if abs(x - px) <= tolerance and abs(y - py) <= tolerance:
+					found.append(((x - px) ** 2 + (y - py) ** 2, -order, item))
+		found.sort(key=lambda entry: entry[:2])
+		return [entry[2] for entry in found]
+
+	# Return the item of the nearest point within tolerance of point or None
+	def find_point(self, point, tolerance=10):
+		found = self.find_points(point, tolerance)
+		return found[0] if found else None
+
+	# Return the item of the nearest line which passes within tolerance of point or None
+	def find_line(self, point, tolerance=10):
+		best = None
+		seen = set()
+		for cell in self._cells_around(point, tolerance + self.cell_size / 4.0):
+			for p1, p2, order, item in self.lines.get(cell, ()):
+				if not order in seen:
+					seen.add(order)
+					distance = pykarta.geometry.plane_lineseg_distance(point, p1, p2)
+					if distance < tolerance and (best is None or (distance, -order) < best[0]):
+						best = ((distance, -order), item)
+		return best[1] if best is not None else None
+
+# Clip the line from p1 to p2 to the rectangle bounds (Liang-Barsky).
+# Returns the new ends or None if the line is entirely outside.
+def _clip_line(p1, p2, bounds):
+	x_min, y_min, x_max, y_max = bounds
+	dx = p2[0] - p1[0]
+	dy = p2[1] - p1[1]
+	t0, t1 = 0.0, 1.0
+	for p, q in ((-dx, p1[0] - x_min), (dx, x_max - p1[0]), (-dy, p1[1] - y_min), (dy, y_max - p1[1])):
+		if p == 0:
+			if q < 0:
+				return None
+		else:
+			t = float(q) / p
+			if p < 0:
+				if t > t1:
+					return None
+				t0 = max(t0, t)
+			else:
+				if t < t0:
+					return None
+				t1 = min(t1, t)
+	return ((p1[0] + t0 * dx, p1[1] + t0 * dy), (p1[0] + t1 * dx, p1[1] + t1 * dy))
+
@@ -8,14 +8,19 @@
 from gi.repository import Gtk, Gdk
 
 from pykarta.maps.layers import MapLayer
+from gpx_projection import MapProjection
+from gpx_layer import PixelGrid
 import pykarta.draw
 
 class PhotoLayer(MapLayer):
+	hit_tolerance = 32		# at least half the size of the symbol
+
 	def __init__(self, photos):
 		MapLayer.__init__(self)
 		self.layer_objs = photos
 		self.tool = None
 		self.visible_objs = []
+		self.hit_grid = PixelGrid()
 		self.selected_path = None
 		self.layer_objs.add_client("map_layer", self)
 
@@ -38,14 +43,17 @@ class PhotoLayer(MapLayer):
 
 	def do_viewport(self):
 		self.visible_objs = []
+		self.hit_grid = PixelGrid(self.containing_map)
 		bbox = self.containing_map.get_bbox()
 		zoom = self.containing_map.get_zoom()
 		sym = self.containing_map.symbols.get_symbol("Camera").get_renderer(self.containing_map)
+		photos = list(self.layer_objs)
+		projected = MapProjection(self.containing_map).project_points(photos)
 		photo_index = 0
-		for photo in self.layer_objs:
-			x, y = self.containing_map.project_point(photo)
+		for photo, (x, y) in zip(photos, projected):
 			if x >= 0 and x < self.containing_map.width and y >= 0 and y < self.containing_map.height:	# if within viewport,
 				self.visible_objs.append((photo_index, photo, x, y, sym))
+				self.hit_grid.add_point((x, y), self.visible_objs[-1])
 			photo_index += 1
 
 	def do_draw(self, ctx):
@@ -62,7 +70,7 @@ class PhotoLayer(MapLayer):
 		if gdkevent.type != Gdk.EventType.BUTTON_PRESS or gdkevent.button != 1:
 			return False
 
-		for photo_index, photo, x, y, sym in self.visible_objs:
+		for photo_index, photo, x, y, sym in self.hit_grid.find_points((gdkevent.x, gdkevent.y), self.hit_tolerance):
 			if sym.hit((gdkevent.x - x), (gdkevent.y - y)):
 				print("Hit photo:", photo.name)
 				self.selected_path = (photo_index,)
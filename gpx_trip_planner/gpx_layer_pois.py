@@ -13,13 +13,17 @@ from gi.repository import Gtk, Gdk
 
 from pykarta.maps.layers import MapLayer
 import pykarta.draw
+from gpx_layer import PixelGrid
 
 class PoiLayer(MapLayer):
+	hit_tolerance = 32		# at least half the size of the largest symbol
+
 	def __init__(self, poi_db):
 		MapLayer.__init__(self)
 		self.poi_db = poi_db
 		self.tool = None
 		self.visible_objs = []
+		self.hit_grid = PixelGrid()
 		self.selected_path = None
 
 		self.poi_db.add_client("map_layer", self)
@@ -50,6 +54,7 @@ class PoiLayer(MapLayer):
 	def do_viewport(self):
 		#print("POI layer: do_viewport()")
 		self.visible_objs = []
+		self.hit_grid = PixelGrid(self.containing_map)
 		bbox = self.containing_map.get_bbox()
 		zoom = self.containing_map.get_zoom()
 		if zoom >= 10 or self.tool is not None:
@@ -57,6 +62,7 @@ class PoiLayer(MapLayer):
 				#print(poi.oid, poi.name)
 				x, y = self.containing_map.project_point(poi)
 				self.visible_objs.append((poi, x, y, self.get_symbol_renderer(poi), poi.name if zoom >= 12 else None))
+				self.hit_grid.add_point((x, y), self.visible_objs[-1])
 
 	def do_draw(self, ctx):
 		#print("POI layer: do_draw()")
@@ -75,7 +81,7 @@ class PoiLayer(MapLayer):
 		if gdkevent.type != Gdk.EventType.BUTTON_PRESS or gdkevent.button != 1:
 			return False
 
-		for poi, x, y, symbol_renderer, label in self.visible_objs:
+		for poi, x, y, symbol_renderer, label in self.hit_grid.find_points((gdkevent.x, gdkevent.y), self.hit_tolerance):
 			if symbol_renderer.hit((gdkevent.x - x), (gdkevent.y - y)):
 				print("Hit POI:", poi.name)
 				self.selected_path = (poi.oid,)
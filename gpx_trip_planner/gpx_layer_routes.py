@@ -9,7 +9,7 @@ import math
 
 import pykarta.geometry
 import pykarta.draw
-from gpx_layer import GpxEditableLayer, GpxTool, points_close
+from gpx_layer import GpxEditableLayer, GpxTool
 from gpx_data_gpx import GpxRoute, GpxRoutePoint
 import gpx_colors
 
@@ -67,10 +67,12 @@ class RouteLayer(GpxEditableLayer):
 				self.zoom = layer.containing_map.get_zoom()
 		
 				# Project the explicit points which the user placed
-				self.explicit_pts = self.layer.containing_map.project_points(self.route)
+				self.explicit_pts = self.layer.projection.project_points(self.route.points)
 		
 				# Load the point symbol renderers for the explicit points
 				self.sym_renderers = []
+				self.leg_shapes = []
+				self.leg_phantoms = []
 				for point in self.route:
 					sym = self.layer.containing_map.symbols.get_symbol(point.sym, default=None)
 					if sym:
@@ -85,34 +87,72 @@ class RouteLayer(GpxEditableLayer):
 			# Make a list of all points including the intermediate "shape points"
 			# which may be contained in each explicit point and the "phantom points"
 			# which can be dragged to add new points.
-			def update_intermediate_pts(self):
-	
+			#
+			# The leg from explicit point i to point i+1 has its projected shape
+			# points in self.leg_shapes[i] and its phantom point (or None) in
+			# self.leg_phantoms[i]. If legs is a list of leg numbers, only those
+			# legs are projected again (as when a point is dragged). Otherwise
+			# all of the shape points are projected at once.
+			def update_intermediate_pts(self, legs=None):
+				count = len(self.explicit_pts)
+				if legs is None or len(self.leg_shapes) != count:
+					shapes = [point.route_shape for point in self.route]
+					projected_shapes = self.layer.projection.project_points([shape_point for shape in shapes for shape_point in shape])
+					self.leg_shapes = []
+					start = 0
+					for shape in shapes:
+						self.leg_shapes.append(projected_shapes[start:start+len(shape)])
+						start += len(shape)
+					self.leg_phantoms = [None] * count
+					legs = range(count)
+				else:
+					legs = [i for i in legs if i >= 0 and i < count]
+					for i in legs:
+						self.leg_shapes[i] = self.layer.projection.project_points(self.route[i].route_shape)
+
+				for i in legs:
+					self.leg_phantoms[i] = self.find_phantom(i)
+
+				# Put the explicit points in front of their shapes.
 				self.shape_pts = []
-				i = 0
-				for point in self.route:
+				for i in range(count):
 					self.shape_pts.append(self.explicit_pts[i])
-					self.shape_pts.extend(self.layer.containing_map.project_points(point.route_shape))
-					i += 1
-	
-				self.phantom_points = []
-				i = 0
-				while i < (len(self.explicit_pts) - 1):
-					p1 = self.explicit_pts[i]	
-					p2 = self.explicit_pts[i+1]
-					xdistance = abs(p2[0] - p1[0])
-					ydistance = abs(p2[1] - p1[1])
-					distance = math.sqrt(xdistance * xdistance + ydistance * ydistance)
-					if distance > 30:
-						if len(self.route[i].route_shape) > 0:
-							shape = self.route[i].route_shape
-							point = shape[int(len(shape)/2)]
-							x, y = self.layer.containing_map.project_point(point)
-						else:
-							x = (p1[0] + p2[0]) / 2
-							y = (p1[1] + p2[1]) / 2
-						self.phantom_points.append([x, y, i])
-					i += 1
-	
+					self.shape_pts.extend(self.leg_shapes[i])
+
+				self.phantom_points = [phantom for phantom in self.leg_phantoms if phantom is not None]
+
+			# The phantom point of a leg goes in the middle of its shape or,
+			# if it has none, half-way between its ends. Short legs have none.
+			def find_phantom(self, i):
+				if i >= len(self.explicit_pts) - 1:
+					return None
+				p1 = self.explicit_pts[i]
+				p2 = self.explicit_pts[i+1]
+				xdistance = abs(p2[0] - p1[0])
+				ydistance = abs(p2[1] - p1[1])
+				distance = math.sqrt(xdistance * xdistance + ydistance * ydistance)
+				if distance <= 30:
+					return None
+				shape = self.leg_shapes[i]
+				if len(shape) > 0:
+					x, y = shape[int(len(shape)/2)]
+				else:
+					x = (p1[0] + p2[0]) / 2
+					y = (p1[1] + p2[1]) / 2
+				return [x, y, i]
+
+			# A point has been inserted in the route at index. Its pixel
+			# position is event_point. Keep our lists in step with the route.
+			def insert_point(self, index, event_point):
+				self.explicit_pts.insert(index, event_point)
+				self.sym_renderers.insert(index, None)
+				self.leg_shapes.insert(index, [])
+				self.leg_phantoms.insert(index, None)
+				for i in range(index + 1, len(self.leg_phantoms)):		# renumber those after it
+					if self.leg_phantoms[i] is not None:
+						self.leg_phantoms[i][2] = i
+				self.update_intermediate_pts([index - 1, index])
+
 			# Actually draw the route
 			def draw(self, ctx, selected_path):
 	
@@ -185,7 +225,8 @@ class RouteLayer(GpxEditableLayer):
 				if point_index >= 1:
 					self.route[point_index-1].route_shape = []
 
-				self.update_intermediate_pts()
+				# Only the legs on either side have changed.
+				self.update_intermediate_pts([point_index - 1, point_index])
 				self.layer.redraw()
 	
 			# Call this when the user releases the dragged point. It updates
@@ -204,6 +245,27 @@ class RouteLayer(GpxEditableLayer):
 
 		return RouteRenderer(obj, index, self)
 
+	# The items in the grid are ('point', route_drawn_i, point_i) for the
+	# explicit points, ('phantom', route_drawn_i, point_i) for the phantom
+	# points, and route_drawn_i for the lines between the explicit points,
+	# where route_drawn_i is the renderer's position in self.visible_objs.
+	def fill_hit_grid(self, grid):
+		for route_drawn_i in range(len(self.visible_objs)):
+			route_drawn = self.visible_objs[route_drawn_i]
+			for point_i in range(len(route_drawn.explicit_pts)):
+				grid.add_point(route_drawn.explicit_pts[point_i], ('point', route_drawn_i, point_i))
+			for x, y, point_i in route_drawn.phantom_points:
+				grid.add_point((x, y), ('phantom', route_drawn_i, point_i))
+			grid.add_line_string(route_drawn.explicit_pts, lambda i: route_drawn_i)
+
+	# Return the nearest hit of the indicated kind ('point' or 'phantom')
+	# under event_point or None.
+	def find_route_point(self, event_point, kind):
+		for hit in self.get_hit_grid().find_points(event_point):
+			if hit[0] == kind:
+				return hit
+		return None
+
 	# Click to select a route. Bring mouse down on a point and move to drag it.
 	def create_tool_select_adjust(self):
 		class RouteSelector(GpxTool):
@@ -214,58 +276,53 @@ class RouteLayer(GpxEditableLayer):
 
 			def on_button_press(self, gdkevent):
 				event_point = (gdkevent.x, gdkevent.y)
-				route_drawn_i = len(self.layer.visible_objs)
-				for route_drawn in reversed(self.layer.visible_objs):
-					route_drawn_i -= 1		# interating in reverse
-		
-					# Step thru the (explicit) points.
-					point_i = 0
-					for point in route_drawn.explicit_pts:
-						if points_close(point, event_point):
-							path = (route_drawn.index, point_i)
-							#print("Hit route point:", path)
-							if path == self.layer.selected_path:
-								self.dragged_obj_i = route_drawn_i
-								self.layer.containing_map.set_cursor(Gdk.FLEUR)
-							else:
-								self.layer.select(path)
-								self.layer.redraw()		# FIXME: really needed?
-							return True
-						point_i += 1
 
-					# Nope? Then see whether one of the phantom points was hit.
-					for point in route_drawn.phantom_points:
-						x, y, point_i = point
-						if points_close(point, event_point):
-							print("Hit phantom route point")
-		
-							# Create a new point at the mouse position.
-							lat, lon = self.layer.containing_map.unproject_point(*event_point)
-							point = GpxRoutePoint(lat, lon)
-							point.name = "Guide Point"
-							point.type = "guide"
-							point.src = "User Placed"
-		
-							print("New point comes after:", point_i)
-							route = self.layer.layer_objs[route_drawn.index]
-							route[point_i].route_shape = []
-							route.insert(point_i+1, point)
-							route_drawn.explicit_pts.insert(point_i+1, event_point)
-		
-							self.layer.select((route_drawn.index, point_i+1))	# select new point
-							self.layer.containing_map.set_cursor(Gdk.FLEUR)
-							self.dragged_obj_i = route_drawn_i
-							return True
-
-					# Nope? See if the whole thing was hit.
-					points = route_drawn.explicit_pts
-					i = 0
-					limit = len(points) - 1
-					while i < limit:
-						if pykarta.geometry.plane_lineseg_distance(event_point, points[i], points[i+1]) < 10:
-							self.layer.select((route_drawn.index,))
-							return True
-						i += 1
+				# Was one of the (explicit) points hit?
+				hit = self.layer.find_route_point(event_point, 'point')
+				if hit is not None:
+					kind, route_drawn_i, point_i = hit
+					route_drawn = self.layer.visible_objs[route_drawn_i]
+					path = (route_drawn.index, point_i)
+					#print("Hit route point:", path)
+					if path == self.layer.selected_path:
+						self.dragged_obj_i = route_drawn_i
+						self.layer.containing_map.set_cursor(Gdk.FLEUR)
+					else:
+						self.layer.select(path)
+						self.layer.redraw()		# FIXME: really needed?
+					return True
+
+				# Nope? Then see whether one of the phantom points was hit.
+				hit = self.layer.find_route_point(event_point, 'phantom')
+				if hit is not None:
+					kind, route_drawn_i, point_i = hit
+					route_drawn = self.layer.visible_objs[route_drawn_i]
+					print("Hit phantom route point")
+
+					# Create a new point at the mouse position.
+					lat, lon = self.layer.containing_map.unproject_point(*event_point)
+					point = GpxRoutePoint(lat, lon)
+					point.name = "Guide Point"
+					point.type = "guide"
+					point.src = "User Placed"
+
+					print("New point comes after:", point_i)
+					route = self.layer.layer_objs[route_drawn.index]
+					route[point_i].route_shape = []
+					route.insert(point_i+1, point)
+					route_drawn.insert_point(point_i+1, event_point)
+					self.layer.hit_grid = None
+
+					self.layer.select((route_drawn.index, point_i+1))	# select new point
+					self.layer.containing_map.set_cursor(Gdk.FLEUR)
+					self.dragged_obj_i = route_drawn_i
+					return True
+
+				# Nope? See if the whole thing was hit.
+				route_drawn_i = self.layer.get_hit_grid().find_line(event_point)
+				if route_drawn_i is not None:
+					self.layer.select((self.layer.visible_objs[route_drawn_i].index,))
+					return True
 
 				return False
 
@@ -273,6 +330,7 @@ class RouteLayer(GpxEditableLayer):
 				if self.dragged_obj_i is not None:
 					event_point = (gdkevent.x, gdkevent.y)
 					self.layer.visible_objs[self.dragged_obj_i].drag(self.layer.selected_path[1], event_point)
+					self.layer.hit_grid = None
 					self.dragged = True
 					return True
 				return False
@@ -344,14 +402,13 @@ class RouteLayer(GpxEditableLayer):
 			def __init__(self, layer):
 				self.layer = layer
 			def on_button_press(self, gdkevent):
-				event_point = (gdkevent.x, gdkevent.y)
-				for route_drawn in reversed(self.layer.visible_objs):
-					for point in route_drawn.explicit_pts:
-						if points_close(point, event_point):
-							print("Deleting route %d" % route_drawn.index)
-							del self.layer.layer_objs[route_drawn.index]
-							#self.layer.set_stale()
-							return True
+				hit = self.layer.find_route_point((gdkevent.x, gdkevent.y), 'point')
+				if hit is not None:
+					route_drawn = self.layer.visible_objs[hit[1]]
+					print("Deleting route %d" % route_drawn.index)
+					del self.layer.layer_objs[route_drawn.index]
+					#self.layer.set_stale()
+					return True
 				return False
 		return RouteDeleter(self)
 
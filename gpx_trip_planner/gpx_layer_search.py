@@ -9,6 +9,8 @@ import math
 from gi.repository import Gtk, Gdk
 
 from pykarta.maps.layers import MapLayer
+from gpx_projection import MapProjection
+from gpx_layer import PixelGrid
 
 class SearchLayer(MapLayer):
 	def __init__(self, data):
@@ -17,6 +19,7 @@ class SearchLayer(MapLayer):
 		self.layer_objs = data
 		self.layer_objs.add_client('map_layer', self)
 		self.visible_objs = []
+		self.hit_grid = PixelGrid()
 		self.selected_path = None
 		self.radius = None
 	
@@ -42,12 +45,16 @@ class SearchLayer(MapLayer):
 
 	def do_viewport(self):
 		self.visible_objs = []
+		self.hit_grid = PixelGrid(self.containing_map)
+		projection = MapProjection(self.containing_map)
+		matches = list(self.layer_objs)
+		projected = projection.project_points(matches)
 		match_index = 0
-		for match in self.layer_objs:
-			x, y = self.containing_map.project_point(match)
+		for match, (x, y) in zip(matches, projected):
 			if x > 0 and x < self.containing_map.width and y > 0 and y < self.containing_map.height:	# if within viewport,
-				polygonpoints = self.containing_map.project_points(match.polygonpoints)
+				polygonpoints = projection.project_points(match.polygonpoints)
 				self.visible_objs.append([match_index, match, x, y, polygonpoints])
+				self.hit_grid.add_point((x, y), self.visible_objs[-1])
 			match_index += 1
 		self.containing_map.feedback.debug(1, " %d of %d search results are in view" % (len(self.visible_objs), len(self.layer_objs)))
 
@@ -95,14 +102,14 @@ class SearchLayer(MapLayer):
 		if gdkevent.type != Gdk.EventType.BUTTON_PRESS or gdkevent.button != 1:
 			return False
 
-		for item in reversed(self.visible_objs):
+		item = self.hit_grid.find_point((gdkevent.x, gdkevent.y), self.radius)
+		if item is not None:
 			(match_index, match, x, y, polygonpoints) = item
-			if abs(gdkevent.x - x) <= self.radius and abs(gdkevent.y - y) <= self.radius:
-				print("Hit search result point")
-				self.selected_path = (match_index,)
-				self.layer_objs.select(self.selected_path, "map_layer")
-				self.redraw()
-				return True
+			print("Hit search result point")
+			self.selected_path = (match_index,)
+			self.layer_objs.select(self.selected_path, "map_layer")
+			self.redraw()
+			return True
 
 		return False
 
@@ -7,14 +7,45 @@
 
 from gi.repository import Gtk
 import math
+import collections
 import cairo
 
-from gpx_layer import GpxEditableLayer, GpxTool, points_close
+from gpx_layer import GpxEditableLayer, GpxTool
 import pykarta.geometry
 import pykarta.draw
+from gpx_projection import MapProjection, unproject_from_tilespace_arrays
+from gpx_data_rtree import bbox_to_box, boxes_overlap
 import gpx_colors
 
+#=============================================================================
+# The tracks are drawn into image tiles which are kept from one redraw
+# to the next, so panning over a map covered with tracks mostly comes
+# down to copying the tiles to the screen. The tiles are laid out on
+# a grid of tile_size screen pixels anchored at the top left corner of
+# the world at the current scale.
+#
+# Each tile is stored with a signature listing the track segments drawn
+# in it (in drawing order), their version numbers, and their colors.
+# GpxTrackSegment.version goes up whenever a point is added, moved, or
+# removed. If the signature computed by do_viewport() for a tile is not
+# the same as that of the cached copy, the tile is drawn again. So an
+# edit to a segment causes just the tiles which it passes through, before
+# and after the change, to be redrawn.
+#
+# Segments are assigned to tiles using the bounding boxes of their
+# chunks (see GpxTrackSegment.get_chunk_boxes()) and only the chunks
+# which overlap a tile are drawn in it, so a long segment which crosses
+# the map is not drawn in full for every tile.
+#
+# The selected track is drawn again on top of the tiles with a wider
+# line. Track point markers are not put in the tiles either.
+#=============================================================================
+
 class TrackLayer(GpxEditableLayer):
+	tile_size = 256
+	tile_margin = 16		# pixels by which line ends and arrows may stick out of a bbox
+	tile_cache_size = 200	# about 50MB
+
 	def __init__(self, gpx_data):
 		GpxEditableLayer.__init__(self)
 
@@ -26,6 +57,10 @@ class TrackLayer(GpxEditableLayer):
 		self.arrow_show_level = 14
 		self.point_show_level = 15
 		self.point_zoom_level = 16
+		self.lazy_load_level = 12		# parse lazily-loaded segments at this zoom
+
+		self.tiles = collections.OrderedDict()	# (scale_x, scale_y, tx, ty) -> (signature, surface), least recently used first
+		self.visible_tiles = []					# see do_viewport()
 
 	def on_select(self, path, source, client_name):
 		self.selected_path = path
@@ -38,37 +73,130 @@ class TrackLayer(GpxEditableLayer):
 					zoom = self.point_zoom_level
 				self.containing_map.set_center_and_zoom(point.lat, point.lon, zoom)
 			else:
-				bbox = pykarta.geometry.BoundingBox()
 				if len(path) == 1:		# click on an entire track
-					track_obj = self.layer_objs[path[0]]
-					for track_seg in track_obj:
-						for point in track_seg:
-							bbox.add_point(pykarta.geometry.Point(point.lat, point.lon))
+					bbox = self.layer_objs[path[0]].get_bbox()
 				else:					# click on an entire track segment
-					track_seg = self.layer_objs[path[0]][path[1]]
-					for point in track_seg:
-						bbox.add_point(pykarta.geometry.Point(point.lat, point.lon))
+					bbox = self.layer_objs[path[0]][path[1]].get_bbox()
 				self.containing_map.zoom_to_extent(bbox)
-	
+
 		GpxEditableLayer.on_select(self, path, source, client_name)
 
 	# Override do_viewport() because he have to handle two levels.
+	# The spatial index finds the tracks, then we check their segments.
+	# Each segment is assigned to the tiles which its bbox overlaps.
+	# This makes self.visible_tiles, a list of (key, signature, renderers,
+	# x, y) for the tiles which have something in them, and
+	# self.visible_objs, a list of the renderers of all of the segments.
+	# The renderers do not project their points until they are drawn.
 	def do_viewport(self):
-		map_bbox = self.containing_map.get_bbox()
 		zoom = self.containing_map.get_zoom()
-		self.visible_objs = []
-		track_i = 0
+		projection = self.projection = MapProjection(self.containing_map)
+		self.hit_grid = None
+		size = self.tile_size
+		margin = self.tile_margin
+
+		# The range of tiles which covers the viewport
+		tx_min = int(math.floor(-projection.offset_x / size))
+		tx_max = int(math.floor((self.containing_map.width - projection.offset_x) / size))
+		ty_min = int(math.floor(-projection.offset_y / size))
+		ty_max = int(math.floor((self.containing_map.height - projection.offset_y) / size))
+
+		# Their area with the margin added, in tilespace and as a bbox
+		x_min = (tx_min * size - margin) / projection.scale_x
+		x_max = ((tx_max + 1) * size + margin) / projection.scale_x
+		y_min = (ty_min * size - margin) / projection.scale_y
+		y_max = ((ty_max + 1) * size + margin) / projection.scale_y
+		lats, lons = unproject_from_tilespace_arrays((x_min, x_max), (y_min, y_max))
+		area_box = (lons[0], lats[1], lons[1], lats[0])
+		area_bbox = pykarta.geometry.BoundingBox(area_box)
+		self.viewport_box = self.screen_box(0, 0, self.containing_map.width, self.containing_map.height)
+
+		tiles = {}
+		renderers = []
 		trackseg_count = 0
-		for track in self.layer_objs:
+		for track_i, track in self.layer_objs.find_in_bbox(area_bbox):
 			if track.gpxtp_show:
 				trackseg_i = 0
 				for track_segment in track:
-					if track_segment.get_bbox().overlaps(map_bbox):
-						self.visible_objs.append(self.create_renderer((track, track_segment), (track_i, trackseg_i)))
+					bbox = track_segment.get_bbox()
+					if bbox.overlaps(area_bbox):
+						lazy = track_segment.lazy is not None and zoom < self.lazy_load_level
+						if lazy:
+							renderer = self.create_lazy_renderer((track, track_segment), (track_i, trackseg_i))
+						else:
+							renderer = self.create_renderer((track, track_segment), (track_i, trackseg_i))
+						renderers.append(renderer)
+						item = (track_segment, track_segment.version, lazy, renderer.color)
+						if lazy:
+							boxes = [bbox_to_box(bbox)]
+						else:
+							boxes = [box for box in track_segment.get_chunk_boxes() if boxes_overlap(box, area_box)]
+						corners = projection.project_arrays(
+							[box[3] for box in boxes] + [box[1] for box in boxes],
+							[box[0] for box in boxes] + [box[2] for box in boxes]
+							)
+						segment_tiles = set()
+						for (left, top), (right, bottom) in zip(corners[:len(boxes)], corners[len(boxes):]):
+							for ty in range(max(ty_min, self.tile_index(top - margin, projection.offset_y)), min(ty_max, self.tile_index(bottom + margin, projection.offset_y)) + 1):
+								for tx in range(max(tx_min, self.tile_index(left - margin, projection.offset_x)), min(tx_max, self.tile_index(right + margin, projection.offset_x)) + 1):
+									segment_tiles.add((tx, ty))
+						for tile_key in segment_tiles:
+							tile = tiles.setdefault(tile_key, ([], []))
+							tile[0].append(item)
+							tile[1].append(renderer)
 					trackseg_i += 1
 					trackseg_count += 1
-			track_i += 1
-		self.containing_map.feedback.debug(1, " %d of %d track segments in view" % (len(self.visible_objs), trackseg_count))
+
+		self.visible_objs = renderers
+		self.visible_tiles = []
+		for (tx, ty), (signature, tile_renderers) in tiles.items():
+			key = (projection.scale_x, projection.scale_y, tx, ty)
+			self.visible_tiles.append((key, tuple(signature), tile_renderers, tx * size + projection.offset_x, ty * size + projection.offset_y))
+		self.containing_map.feedback.debug(1, " %d of %d track segments in nearby tracks in view, %d tiles" % (len(self.visible_objs), trackseg_count, len(self.visible_tiles)))
+
+	# Which column (or row) of tiles is the screen coordinate in?
+	def tile_index(self, coordinate, offset):
+		return int(math.floor((coordinate - offset) / self.tile_size))
+
+	# The area of the screen from x0, y0 to x1, y1 (plus the margin) as
+	# a box (min_lon, min_lat, max_lon, max_lat)
+	def screen_box(self, x0, y0, x1, y1):
+		margin = self.tile_margin
+		(lat0, lon0), (lat1, lon1) = self.projection.unproject_points([(x0 - margin, y0 - margin), (x1 + margin, y1 + margin)])
+		return (lon0, lat1, lon1, lat0)
+
+	# Copy the tiles to the screen, drawing those which are not in the
+	# cache or have changed. Then draw what is not in the tiles.
+	def do_draw(self, ctx):
+		for key, signature, renderers, x, y in self.visible_tiles:
+			tile = self.tiles.pop(key, None)
+			if tile is None or tile[0] != signature:
+				tile = (signature, self.draw_tile(renderers, x, y))
+			self.tiles[key] = tile
+			ctx.set_source_surface(tile[1], x, y)
+			ctx.paint()
+		while len(self.tiles) > self.tile_cache_size:
+			self.tiles.popitem(last=False)
+
+		selected_path = self.selected_path
+		for renderer in self.visible_objs:
+			if selected_path and selected_path[0] == renderer.track_i:
+				renderer.draw(ctx, selected_path, self.viewport_box)
+			renderer.draw_points(ctx, selected_path)
+
+		if self.drawing_tool is not None:
+			self.drawing_tool.draw(ctx)
+
+	# Draw the indicated segments on a new tile whose top left corner is
+	# at x, y on the screen.
+	def draw_tile(self, renderers, x, y):
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.tile_size, self.tile_size)
+		ctx = cairo.Context(surface)
+		ctx.translate(-x, -y)
+		box = self.screen_box(x, y, x + self.tile_size, y + self.tile_size)
+		for renderer in renderers:
+			renderer.draw(ctx, None, box)
+		return surface
 
 	def create_renderer(self, obj, index):
 		class TrackRenderer(object):
@@ -76,63 +204,109 @@ class TrackLayer(GpxEditableLayer):
 				self.track, self.track_segment = obj
 				self.track_i, self.trackseg_i = index
 				self.layer = layer
-				containing_map = layer.containing_map
 				self.color = gpx_colors.rgb_by_name.get(self.track.gpxx_DisplayColor, (1.0, 0.0, 0.0, 1.0))
-				self.projected_points = containing_map.scale_points(
-					self.track_segment.get_projected_simplified_points(containing_map.get_zoom())
-					)
-				self.zoom = containing_map.get_zoom()
-			def draw(self, ctx, selected_path):
+				self.zoom = layer.containing_map.get_zoom()
+				self._projected_points = None
+			# Numbers of the points in the segment
+			@property
+			def point_indices(self):
+				return self.track_segment.get_simplified_indices(self.zoom)
+			# Projected when first needed since most segments are in cached tiles
+			@property
+			def projected_points(self):
+				if self._projected_points is None:
+					self._projected_points = self.layer.projection.scale_arrays(
+						*self.track_segment.get_projected_simplified(self.zoom)
+						)
+				return self._projected_points
+			# Draw the parts of the segment which are within box
+			def draw(self, ctx, selected_path, box):
 
 				if selected_path and selected_path[0] == self.track_i:
 					line_width = 4
 				else:
 					line_width = 2
-	
+
+				runs = [
+					self.layer.projection.scale_arrays(xs, ys)
+					for xs, ys in self.track_segment.get_projected_simplified_runs(self.zoom, box)
+					]
+
 				# Draw track line
-				pykarta.draw.line_string(ctx, self.projected_points)
+				for points in runs:
+					pykarta.draw.line_string(ctx, points)
 				ctx.set_line_width(line_width)
 				ctx.set_source_rgba(*self.color)
 				ctx.set_line_join(cairo.LINE_JOIN_ROUND)
 				ctx.stroke()
 				ctx.set_line_join(cairo.LINE_JOIN_MITER)
-	
+
 				# If zoomed in far enough, draw direction of travel arrows
 				if self.zoom > self.layer.arrow_show_level:
-					pykarta.draw.line_string_arrows(ctx, self.projected_points, line_width=line_width)
+					for points in runs:
+						pykarta.draw.line_string_arrows(ctx, points, line_width=line_width)
 					ctx.stroke()
-	
-				# If this layer is active and map is zoomed in far enough, draw track point markers.
-				if self.layer.drawing_tool is not None and self.zoom >= self.point_show_level:
-					point_i = 0
-					for point in points:
+
+			# If this layer is active and map is zoomed in far enough, draw track point markers.
+			def draw_points(self, ctx, selected_path):
+				if self.layer.drawing_tool is not None and self.zoom >= self.layer.point_show_level:
+					radius = self.layer.radius
+					for point, point_i in zip(self.projected_points, self.point_indices):
 						if selected_path == (self.track_i, self.trackseg_i, point_i):
-							ctx.arc(point[0], point[1], self.radius-1, 0, 2*math.pi)
+							ctx.arc(point[0], point[1], radius-1, 0, 2*math.pi)
 							ctx.set_line_width(4)
 						else:
-							ctx.arc(point[0], point[1], self.radius, 0, 2*math.pi)
+							ctx.arc(point[0], point[1], radius, 0, 2*math.pi)
 							ctx.set_line_width(1)
 						ctx.set_source_rgba(*self.color)
 						ctx.stroke_preserve()
 						ctx.set_source_rgb(1.0, 1.0, 1.0)		# white
 						ctx.fill()
-						point_i += 1
 		return TrackRenderer(obj, index, self)
 
+	# For a track segment whose points have not been loaded, draw a
+	# dashed box around the area where they are.
+	def create_lazy_renderer(self, obj, index):
+		class LazyTrackRenderer(object):
+			def __init__(self, obj, index, layer):
+				self.track, self.track_segment = obj
+				self.track_i, self.trackseg_i = index
+				self.color = gpx_colors.rgb_by_name.get(self.track.gpxx_DisplayColor, (1.0, 0.0, 0.0, 1.0))
+				bbox = self.track_segment.get_bbox()
+				self.corners = layer.projection.project_arrays(
+					(bbox.min_lat, bbox.max_lat, bbox.max_lat, bbox.min_lat, bbox.min_lat),
+					(bbox.min_lon, bbox.min_lon, bbox.max_lon, bbox.max_lon, bbox.min_lon)
+					)
+				self.projected_points = []		# for fill_hit_grid()
+				self.point_indices = []
+			def draw(self, ctx, selected_path, box):
+				pykarta.draw.line_string(ctx, self.corners)
+				ctx.set_line_width(4 if selected_path and selected_path[0] == self.track_i else 2)
+				ctx.set_source_rgba(*self.color)
+				ctx.set_dash((4, 4))
+				ctx.stroke()
+				ctx.set_dash(())
+			def draw_points(self, ctx, selected_path):
+				pass
+		return LazyTrackRenderer(obj, index, self)
+
+	# Track points can be clicked on when they are shown
+	def fill_hit_grid(self, grid):
+		if self.containing_map.get_zoom() >= self.point_show_level:
+			for renderer in self.visible_objs:
+				for point, point_i in zip(renderer.projected_points, renderer.point_indices):
+					grid.add_point(point, (renderer, point_i))
+
 	def create_tool_select_adjust(self):
 		class TrackpointSelector(GpxTool):
 			def __init__(self, layer):
 				self.layer = layer
 			def on_button_press(self, gdkevent):
-				if self.zoom >= self.layer.point_show_level:
-					event_point = (gdkevent.x, gdkevent.y)
-					for segment in self.layer.visible_objs:
-						point_i = 0
-						for point in segment.projected_points:
-							if points_close(point, event_point):
-								print("Hit track point")
-								self.layer.select((segment.track_i, segment.trackseg_i, point_i))
-								return True
-							point_i += 1
+				hit = self.layer.get_hit_grid().find_point((gdkevent.x, gdkevent.y))
+				if hit is not None:
+					print("Hit track point")
+					segment, point_i = hit
+					self.layer.select((segment.track_i, segment.trackseg_i, point_i))
+					return True
 				return False
-
+		return TrackpointSelector(self)
@@ -8,12 +8,18 @@ from gi.repository import Gtk, Gdk
 import math
 import cairo
 
-from gpx_layer import GpxEditableLayer, GpxTool, points_close
+from gpx_layer import GpxEditableLayer, GpxTool
 from gpx_data_gpx import GpxWaypoint
+from gpx_data_cluster import ClusterIndex
+from gpx_projection import MapProjection
 import pykarta.draw
 
 # This is a Pykarta map layer for rendering GPX waypoins
 class WaypointLayer(GpxEditableLayer):
+	project_objs = True
+	cluster_max_zoom = 12		# at higher zoom levels every waypoint is drawn
+	label_char_width = 7		# estimated size of the label text in pixels
+	label_height = 14
 
 	def __init__(self, gpx_data):
 		GpxEditableLayer.__init__(self)
@@ -21,6 +27,10 @@ class WaypointLayer(GpxEditableLayer):
 		self.layer_objs = gpx_data.waypoints
 		self.layer_objs.add_client("map_layer", self)
 
+		self.cluster_index = None			# see get_cluster_index()
+		self.cluster_index_version = None
+		self.cluster_members = []
+
 	# Receives notification of changes in the selection which are made
 	# by some other client of the data store.
 	def on_select(self, path, source, client_name):
@@ -32,6 +42,87 @@ class WaypointLayer(GpxEditableLayer):
 				self.containing_map.make_visible(wp.lat, wp.lon)
 		GpxEditableLayer.on_select(self, path, source, client_name)
 
+	# At low zoom levels waypoints which are close together are drawn as
+	# a single cluster. Then the labels which would overlap others are
+	# left out.
+	def do_viewport(self):
+		zoom = int(self.containing_map.get_zoom() + 0.5)
+		if zoom > self.cluster_max_zoom:
+			GpxEditableLayer.do_viewport(self)
+		else:
+			self.do_viewport_clustered(zoom)
+		self.declutter_labels()
+
+	def do_viewport_clustered(self, zoom):
+		projection = self.projection = MapProjection(self.containing_map)
+		self.hit_grid = None
+		self.visible_objs = []
+
+		# The screen in tilespace with room around it for the symbols
+		margin = ClusterIndex.cell_size
+		x_min = (-margin - projection.offset_x) / projection.scale_x
+		x_max = (self.containing_map.width + margin - projection.offset_x) / projection.scale_x
+		y_min = (-margin - projection.offset_y) / projection.scale_y
+		y_max = (self.containing_map.height + margin - projection.offset_y) / projection.scale_y
+
+		singles = []
+		for count, x, y, member in self.get_cluster_index().find(zoom, x_min, y_min, x_max, y_max):
+			point = (x * projection.scale_x + projection.offset_x, y * projection.scale_y + projection.offset_y)
+			if count == 1:
+				singles.append((self.cluster_members[member], point))
+			else:
+				self.visible_objs.append(self.create_cluster_renderer(count, point))
+
+		# The selected waypoint is drawn even if it is in a cluster.
+		if self.selected_path is not None:
+			selected = self.selected_path[0]
+			if selected < len(self.layer_objs) and not selected in [index for index, point in singles]:
+				obj = self.layer_objs[selected]
+				if obj.gpxtp_show:
+					singles.append((selected, projection.project_point(obj)))
+
+		singles.sort(key=lambda single: single[0])
+		self.projected_objs = dict(singles)
+		for index, point in singles:
+			self.visible_objs.append(self.create_renderer(self.layer_objs[index], index))
+		self.containing_map.feedback.debug(1, " %s: %d waypoints and %d clusters visible" % (self.__class__.__name__, len(singles), len(self.visible_objs) - len(singles)))
+
+	# The cluster index is rebuilt when the waypoints change. Its members
+	# are numbered in the order of the shown waypoints, so we keep a list
+	# of their numbers in layer_objs.
+	def get_cluster_index(self):
+		if self.cluster_index is None or self.cluster_index_version != self.layer_objs.version:
+			waypoints = list(self.layer_objs)
+			self.cluster_members = [index for index in range(len(waypoints)) if waypoints[index].gpxtp_show]
+			self.cluster_index = ClusterIndex([waypoints[index] for index in self.cluster_members], self.cluster_max_zoom)
+			self.cluster_index_version = self.layer_objs.version
+		return self.cluster_index
+
+	# Greedily place the labels, the selected waypoint's first, and leave
+	# out any which would overlap one already placed. The placed labels
+	# are kept in a grid of cells so that each is checked only against
+	# those nearby.
+	def declutter_labels(self):
+		cell_size = 64
+		placed = {}
+		selected = self.selected_path[0] if self.selected_path is not None else None
+		labeled = [obj for obj in self.visible_objs if obj.label]
+		labeled.sort(key=lambda obj: obj.index != selected)
+		for obj in labeled:
+			x, y = obj.projected_point
+			left = x + obj.sym.label_offset
+			rect = (left, y - self.label_height / 2.0, left + len(obj.label) * self.label_char_width, y + self.label_height / 2.0)
+			cells = [
+				(col, row)
+				for col in range(int(math.floor(rect[0] / cell_size)), int(math.floor(rect[2] / cell_size)) + 1)
+				for row in range(int(math.floor(rect[1] / cell_size)), int(math.floor(rect[3] / cell_size)) + 1)
+				]
+			if any(_rects_overlap(rect, other) for cell in cells for other in placed.get(cell, ())):
+				obj.label = None
+			else:
+				for cell in cells:
+					placed.setdefault(cell, []).append(rect)
+
 	# Wrap a waypoint up in an object which contains its projected
 	# coordinates and marker image.
 	def create_renderer(self, obj, index):
@@ -40,7 +131,7 @@ class WaypointLayer(GpxEditableLayer):
 				self.obj = obj
 				self.index = index
 				containing_map = layer.containing_map
-				self.projected_point = containing_map.project_point(obj)
+				self.projected_point = layer.projected_objs[index]
 				self.sym = containing_map.symbols.get_symbol(obj.sym, default="Dot").get_renderer(containing_map)
 				self.label = obj.name if containing_map.get_zoom() > 8 else None
 			def draw(self, ctx, selected_path):
@@ -60,6 +151,34 @@ class WaypointLayer(GpxEditableLayer):
 				obj.time = ""		# no longer where we were then
 		return WaypointRenderer(obj, index, self)
 
+	# A circle with the number of waypoints in the cluster in it
+	def create_cluster_renderer(self, count, projected_point):
+		class ClusterRenderer(object):
+			def __init__(self, count, projected_point):
+				self.index = None		# not a waypoint
+				self.count = count
+				self.projected_point = projected_point
+				self.label = None
+			def draw(self, ctx, selected_path):
+				x, y = self.projected_point
+				radius = 8 + 4 * math.log10(self.count)
+				ctx.arc(x, y, radius, 0, 2*math.pi)
+				ctx.set_source_rgba(0.2, 0.4, 0.9, 0.8)
+				ctx.fill_preserve()
+				ctx.set_source_rgb(1.0, 1.0, 1.0)
+				ctx.set_line_width(2)
+				ctx.stroke()
+				text = str(self.count)
+				ctx.set_font_size(radius)
+				x_bearing, y_bearing, width, height = ctx.text_extents(text)[:4]
+				ctx.move_to(x - width / 2 - x_bearing, y - height / 2 - y_bearing)
+				ctx.show_text(text)
+		return ClusterRenderer(count, projected_point)
+
+	def fill_hit_grid(self, grid):
+		for obj in self.visible_objs:
+			grid.add_point(obj.projected_point, obj)
+
 	# Click once to select a waypoint. Bring the mouse down again
 	# and move to drag it to a new position.
 	def create_tool_select_adjust(self):
@@ -69,15 +188,18 @@ class WaypointLayer(GpxEditableLayer):
 				self.dragged_obj = None
 				self.moved = False
 			def on_button_press(self, gdkevent):
-				event_point = (gdkevent.x, gdkevent.y)
-				for obj in reversed(self.layer.visible_objs):
-					if points_close(obj.projected_point, event_point):
-						if self.layer.selected_path is not None and self.layer.selected_path[0] == obj.index:
-							self.dragged_obj = obj
-							self.layer.containing_map.set_cursor(Gdk.FLEUR)
-						else:
-							self.layer.select((obj.index,))
-						return True
+				obj = self.layer.get_hit_grid().find_point((gdkevent.x, gdkevent.y))
+				if obj is not None and obj.index is None:		# cluster, zoom in on it
+					lat, lon = self.layer.projection.unproject_point(*obj.projected_point)
+					self.layer.containing_map.set_center_and_zoom_in(lat, lon, min(int(self.layer.containing_map.get_zoom()) + 2, self.layer.cluster_max_zoom + 1))
+					return True
+				if obj is not None:
+					if self.layer.selected_path is not None and self.layer.selected_path[0] == obj.index:
+						self.dragged_obj = obj
+						self.layer.containing_map.set_cursor(Gdk.FLEUR)
+					else:
+						self.layer.select((obj.index,))
+					return True
 				return False
 			def on_motion(self, gdkevent):
 				if self.dragged_obj is not None:
@@ -94,6 +216,7 @@ class WaypointLayer(GpxEditableLayer):
 						self.layer.select(self.layer.selected_path)		# so form will be updated
 					self.layer.containing_map.set_cursor(None)
 					self.layer.redraw()
+					self.layer.hit_grid = None
 					self.dragged_obj = None
 					self.moved = False
 					return True
@@ -123,12 +246,13 @@ class WaypointLayer(GpxEditableLayer):
 			def __init__(self, layer):
 				self.layer = layer
 			def on_button_press(self, gdkevent):
-				event_point = (gdkevent.x, gdkevent.y)
-				for obj in reversed(self.layer.visible_objs):
-					if points_close(obj.projected_point, event_point):
-						del self.layer.layer_objs[obj.index]
-						#self.layer.set_stale()
-						return True
+				obj = self.layer.get_hit_grid().find_point((gdkevent.x, gdkevent.y))
+				if obj is not None and obj.index is not None:		# not a cluster
+					del self.layer.layer_objs[obj.index]
+					#self.layer.set_stale()
+					return True
 				return False
 		return WaypointDeleter(self)
 
+def _rects_overlap(a, b):
+	return not (a[0] > b[2] or a[2] < b[0] or a[1] > b[3] or a[3] < b[1])
@@ -0,0 +1,117 @@
+#=============================================================================
+# gpx_projection.py
+# Project many points at once to and from Web Mercator
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+import math
+from array import array
+
+# Numpy is optional. Without it the same work is done in plain Python
+# loops (which are still faster than projecting one point at a time
+# through the map widget).
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Below this many points Numpy's overhead exceeds what it saves
+NUMPY_THRESHOLD = 32
+
+#=============================================================================
+# Coordinates are passed as parallel sequences (lists or array('d')) of
+# latitudes and longitudes or of x and y. Tilespace is that of zoom
+# level 0, as in pykarta.geometry.projection.project_to_tilespace(lat,
+# lon, 0): the world is the square (0, 0)--(1, 1). Results are array('d')
+# so that they take little memory and can be viewed by Numpy without
+# copying.
+#=============================================================================
+
+def _as_numpy(values):
+	if isinstance(values, array) and values.typecode == 'd':
+		return numpy.frombuffer(values, dtype=numpy.float64)
+	return numpy.asarray(values, dtype=numpy.float64)
+
+def _use_numpy(values):
+	return numpy is not None and len(values) >= NUMPY_THRESHOLD
+
+def project_to_tilespace_arrays(lats, lons):
+	if _use_numpy(lats):
+		lat_rad = numpy.radians(_as_numpy(lats))
+		xs = (_as_numpy(lons) + 180.0) / 360.0
+		ys = (1.0 - numpy.log(numpy.tan(lat_rad) + (1.0 / numpy.cos(lat_rad))) / math.pi) / 2.0
+		return (array('d', xs.tobytes()), array('d', ys.tobytes()))
+	radians = math.radians
+	log = math.log
+	tan = math.tan
+	cos = math.cos
+	pi = math.pi
+	xs = array('d', [(lon + 180.0) / 360.0 for lon in lons])
+	ys = array('d')
+	for lat in lats:
+		lat_rad = radians(lat)
+		ys.append((1.0 - log(tan(lat_rad) + (1.0 / cos(lat_rad))) / pi) / 2.0)
+	return (xs, ys)
+
+def unproject_from_tilespace_arrays(xs, ys):
+	if _use_numpy(xs):
+		lats = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1.0 - 2.0 * _as_numpy(ys)))))
+		lons = _as_numpy(xs) * 360.0 - 180.0
+		return (array('d', lats.tobytes()), array('d', lons.tobytes()))
+	degrees = math.degrees
+	atan = math.atan
+	sinh = math.sinh
+	pi = math.pi
+	lats = array('d', [degrees(atan(sinh(pi * (1.0 - 2.0 * y)))) for y in ys])
+	lons = array('d', [x * 360.0 - 180.0 for x in xs])
+	return (lats, lons)
+
+#=============================================================================
+# MapProjection takes the place of the map widget's project_point(),
+# project_points(), and scale_points() for drawing. The map turns tilespace
+# into screen pixels by scaling and shifting, so we ask it where two
+# points land and do the same arithmetic ourselves on whole arrays.
+# Make a new one whenever the map moves or zooms (in do_viewport()).
+#
+# Points going to the screen come back as a list of (x, y) tuples since
+# that is what pykarta.draw expects.
+#=============================================================================
+class MapProjection(object):
+	def __init__(self, containing_map):
+		(x0, y0), (x1, y1) = containing_map.scale_points([(0.0, 0.0), (1.0, 1.0)])
+		self.scale_x = x1 - x0
+		self.scale_y = y1 - y0
+		self.offset_x = x0
+		self.offset_y = y0
+
+	# Tilespace arrays to screen points
+	def scale_arrays(self, xs, ys):
+		if _use_numpy(xs):
+			screen_xs = _as_numpy(xs) * self.scale_x + self.offset_x
+			screen_ys = _as_numpy(ys) * self.scale_y + self.offset_y
+			return list(zip(screen_xs.tolist(), screen_ys.tolist()))
+		scale_x = self.scale_x
+		scale_y = self.scale_y
+		offset_x = self.offset_x
+		offset_y = self.offset_y
+		return [(x * scale_x + offset_x, y * scale_y + offset_y) for x, y in zip(xs, ys)]
+
+	# Latitude and longitude arrays to screen points
+	def project_arrays(self, lats, lons):
+		return self.scale_arrays(*project_to_tilespace_arrays(lats, lons))
+
+	# Objects with lat and lon attributes to screen points
+	def project_points(self, points):
+		return self.project_arrays([point.lat for point in points], [point.lon for point in points])
+
+	def project_point(self, point):
+		return self.project_arrays([point.lat], [point.lon])[0]
+
+	# Screen coordinates to a list of (lat, lon)
+	def unproject_points(self, screen_points):
+		xs = [(x - self.offset_x) / self.scale_x for x, y in screen_points]
+		ys = [(y - self.offset_y) / self.scale_y for x, y in screen_points]
+		return list(zip(*unproject_from_tilespace_arrays(xs, ys)))
+
+	def unproject_point(self, x, y):
+		return self.unproject_points([(x, y)])[0]
@@ -55,6 +55,7 @@ class GpxRouter(object):
 		# to a given maneuver (counted from the first maneuver of the first leg).
 		shape_indexes = resp['shape']['maneuverIndexes']
 
+		old_route = list(route)
 		new_route = []
 		maneuver_overall_i = 0
 		for resp_leg in resp['legs']:		# legs coorespond to our original points
@@ -73,8 +74,7 @@ class GpxRouter(object):
 				# If first maneuver in leg, use existing point. This point will
 				# either be a guide point or a stop.
 				if maneuver_i == 0:
-					route_point = route[0]
-					del route[0]
+					route_point = old_route.pop(0)
 					# If this is a guide point, snap it to the road and name the source
 					# of the new position. Also, set the name if there is none.
 					if route_point.type == 'guide':
@@ -122,15 +122,13 @@ class GpxRouter(object):
 			maneuver_overall_i += 1			# make up for skipping of last in each leg
 
 		# End point
-		new_route.append(route[0])
-		del route[0]
+		new_route.append(old_route.pop(0))
 
-		if len(route) != 0:
-			raise AssertionError("%d items left in old route" % len(route))
+		if len(old_route) != 0:
+			raise AssertionError("%d items left in old route" % len(old_route))
 
 		# Replace the route
-		for point in new_route:
-			route.append(point)
+		route.replace(new_route)
 
 		# Set metadata
 		route.cmt = "Distance: %.1f miles, Time: %s, Waypoints: %d" % (resp['distance'], resp['formattedTime'], len(route))
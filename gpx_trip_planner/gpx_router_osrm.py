@@ -26,11 +26,7 @@ class GpxRouter(object):
 		print(json.dumps(resp, indent=4, separators=(',', ': ')))
 		route_geometry = decode_line(resp['route_geometry'])
 
-		while len(route) > 0:
-			del route[0]
-
-		for point in route_geometry:
-			route.append(GpxRoutePoint(point[0], point[1]))
+		route.replace([GpxRoutePoint(point[0], point[1]) for point in route_geometry])
 
 # From http://seewah.blogspot.com/2009/11/gpolyline-decoding-in-python.html
 def decode_line(encoded):
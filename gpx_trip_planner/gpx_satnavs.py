@@ -82,7 +82,8 @@ class GpxSatnavs(object):
 		print("Loading from GPSr %d (%s)..." % (gpsr_index, self.liststore[gpsr_index][0]))
 		reader = self.liststore[gpsr_index][1]
 		try:
-			return reader.load(datastore, self.ui)
+			with datastore.bulk():
+				return reader.load(datastore, self.ui)
 		except Exception as e:
 			self.ui.error_dialog_exception(_("Reading from GPS receiver"), e)
 			return False
@@ -145,7 +146,9 @@ class GpxGpsrGpsbabel(object):
 			]
 		print("Running:", command)
 		connexion = subprocess.Popen(command, stdin=subprocess.PIPE)
-		obj.write(GpxWriter(connexion.stdin))
+		writer = GpxWriter(connexion.stdin)
+		obj.write(writer)
+		writer.close()
 		connexion.stdin.close()		# send EOF to Gpsbabel
 		retcode = connexion.wait()
 		if retcode == 0:
@@ -170,8 +173,10 @@ class GpxGpsrGarminMS(object):
 		while filename is None or os.path.exists(filename):
 			filename = os.path.join(self.gpx_path, "Trip Planner %03d.gpx" % self.seq)
 			self.seq += 1
-		writer = GpxWriter(open(filename, "w"))
-		obj.write(writer)
+		with open(filename, "w") as fh:
+			writer = GpxWriter(fh)
+			obj.write(writer)
+			writer.close()
 		return True
 
 #=============================================================================
@@ -0,0 +1,119 @@
+#! /usr/bin/python3
+#=============================================================================
+# benchmark_points.py
+# Compare the memory use and speed of the point classes in gpx_data_gpx.py
+# with the ones they replaced (copied below as Old*).
+# Copyright 2013--2025, Trinity College
+#
+# Run from the top of the source tree:
+#   python3 src/benchmark_points.py [count]
+#=============================================================================
+
+import sys
+import os
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpx_trip_planner"))
+from gpx_data_gpx import GpxPoint, GpxWaypoint, GpxRoutePoint
+
+#=============================================================================
+# The point classes as they were before
+#=============================================================================
+
+class OldGpxPoint(object):
+	children =                ['ele', 'time', 'name', 'cmt', 'desc', 'src', 'link', 'sym', 'type']
+	__slots__ = ['lat', 'lon', 'ele', 'time', 'name', 'cmt', 'desc', 'src', 'link', 'sym', 'type']
+	def __init__(self, *args):
+		for child_name in self.children:
+			setattr(self, child_name, "")
+		self.link = None
+
+		if len(args) == 2:				# GpxPoint(lat, lon)
+			self.lat, self.lon = args
+		elif len(args) == 1:			# GpxPoint(template_point)
+			source = args[0]
+			self.lat = source.lat
+			self.lon = source.lon
+			for child_name in self.children:
+				setattr(self, child_name, getattr(source, child_name))
+
+			# for GpxRoutePoint
+			if hasattr(source, "route_shape"):
+				self.route_shape = source.route_shape
+		else:
+			raise TypeError
+
+class OldGpxWaypoint(OldGpxPoint):
+	def __init__(self, *args):
+		OldGpxPoint.__init__(self, *args)
+		self.gpxtp_show = True
+		self.bbox = None
+
+class OldGpxRoutePoint(OldGpxPoint):
+	__slots__ = ['route_shape']
+	def __init__(self, *args):
+		OldGpxPoint.__init__(self, *args)
+		self.route_shape = []
+
+#=============================================================================
+# Benchmarks
+#=============================================================================
+
+# Values as they come out of the XML parser: equal, but separate, strings
+def parsed(text):
+	return "".join(list(text))
+
+# Build count points the way GpxLoader does and set the children
+# which a typical point of that sort has.
+def build(point_class, count, intern):
+	points = []
+	for i in range(count):
+		point = point_class(41.0 + i * 1e-6, -72.0 - i * 1e-6)
+		point.ele = parsed("123.4")
+		point.time = parsed("2013-01-01T00:00:00Z")
+		point.name = parsed("Point %d" % i)
+		sym = parsed("Flag, Blue")
+		type = parsed("User Placed")
+		if intern:
+			sym = sys.intern(sym)
+			type = sys.intern(type)
+		point.sym = sym
+		point.type = type
+		points.append(point)
+	return points
+
+def read_all(points):
+	for point in points:
+		for child_name in point.children:
+			getattr(point, child_name)
+
+def measure(label, point_class, count, intern):
+	tracemalloc.start()
+	points = build(point_class, count, intern)
+	memory = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	del points
+
+	# Time it again without tracemalloc slowing it down
+	start = time.perf_counter()
+	points = build(point_class, count, intern)
+	build_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	read_all(points)
+	read_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	for point in points:
+		point_class(point)
+	copy_time = time.perf_counter() - start
+
+	print("%-18s %8.1f bytes/point %8.3f s build %8.3f s read %8.3f s copy" % (label, float(memory) / count, build_time, read_time, copy_time))
+
+if __name__ == "__main__":
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	print("%d points" % count)
+	for old_class, new_class in ((OldGpxPoint, GpxPoint), (OldGpxWaypoint, GpxWaypoint), (OldGpxRoutePoint, GpxRoutePoint)):
+		measure("Old" + new_class.__name__[3:], old_class, count, False)
+		measure(new_class.__name__[3:], new_class, count, True)
@@ -0,0 +1,92 @@
+#=============================================================================
+# test_gpx_data_loader.py
+# Tests of loading GPX files in the background
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpx_trip_planner"))
+
+try:
+	from gpx_data_loader import GpxBackgroundLoad, split_objects
+	from gpx_data_gpx import GpxObjectList, GpxWaypoint, GpxRoute, GpxTrack
+	from gpx_data_cache import GpxCache
+except ImportError as e:		# PyGObject or pykarta missing
+	raise unittest.SkipTest(str(e))
+
+test_gpx = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1">
+ <metadata>
+  <bounds minlat="42.0" minlon="-72.0" maxlat="42.2" maxlon="-71.8"/>
+ </metadata>
+ <wpt lat="42.0" lon="-72.0">
+  <ele>100.0</ele>
+  <name>First</name>
+  <desc>The first point</desc>
+  <sym>Flag</sym>
+ </wpt>
+ <wpt lat="42.1" lon="-71.9">
+  <name>Second</name>
+  <sym>Dot</sym>
+ </wpt>
+ <wpt lat="42.2" lon="-71.8">
+  <time>2013-01-01T00:00:00Z</time>
+  <name>Third</name>
+ </wpt>
+</gpx>
+"""
+
+class TestBackgroundLoadCache(unittest.TestCase):
+
+	# Each waypoint must be complete when it is delivered and encoded
+	# for the cache, even if a chunk is flushed after every object.
+	def test_waypoint_names_survive_cache(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			filename = os.path.join(tmpdir, "test.gpx")
+			with open(filename, "w") as fh:
+				fh.write(test_gpx)
+			cache_dir = os.path.join(tmpdir, "Cache")
+
+			delivered = []
+			load = GpxBackgroundLoad([filename], GpxCache(cache_dir, 1024 * 1024), None, None, None, processes=1)
+			load.chunk_interval = 0
+			load.deliver = delivered.append
+			load.load_file(0, filename)
+
+			waypoints = [point for objects in delivered for point in objects.waypoints]
+			self.assertEqual([point.name for point in waypoints], ["First", "Second", "Third"])
+
+			cached = GpxCache(cache_dir, 1024 * 1024).lookup(filename)
+			self.assertIsNotNone(cached)
+			self.assertEqual([point.name for point in cached.waypoints], ["First", "Second", "Third"])
+			self.assertEqual([point.sym for point in cached.waypoints], ["Flag", "Dot", ""])
+			self.assertEqual(cached.waypoints[0].desc, "The first point")
+			self.assertEqual(cached.waypoints[2].time, "2013-01-01T00:00:00Z")
+
+class TestSplitObjects(unittest.TestCase):
+
+	# Files parsed in parallel are delivered in chunks. Together the
+	# chunks must hold every object in the order add_to() adds them.
+	def test_split_objects(self):
+		objects = GpxObjectList()
+		objects.bounds = (42.0, -72.0, 42.2, -71.8)
+		for i in range(7):
+			objects.add_waypoint(GpxWaypoint(42.0, -72.0))
+		for i in range(3):
+			objects.add_route(GpxRoute(), [])
+		for i in range(4):
+			objects.add_track(GpxTrack())
+		chunks = list(split_objects(objects, 5))
+		self.assertEqual([len(chunk.waypoints) + len(chunk.routes) + len(chunk.tracks) for chunk in chunks], [5, 5, 4])
+		self.assertEqual([point for chunk in chunks for point in chunk.waypoints], objects.waypoints)
+		self.assertEqual([route for chunk in chunks for route in chunk.routes], objects.routes)
+		self.assertEqual([track for chunk in chunks for track in chunk.tracks], objects.tracks)
+		self.assertTrue(all(chunk.bounds == objects.bounds for chunk in chunks))
+		self.assertEqual(list(split_objects(objects, 14)), [objects])
+
+if __name__ == "__main__":
+	unittest.main()
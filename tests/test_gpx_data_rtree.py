@@ -0,0 +1,69 @@
+#=============================================================================
+# test_gpx_data_rtree.py
+# Tests of the in-memory R-tree
+# Copyright 2013--2025, Trinity College
+#=============================================================================
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gpx_trip_planner"))
+
+from gpx_data_rtree import RTree, boxes_overlap
+
+def random_box(rand):
+	lon = rand.uniform(-180.0, 179.0)
+	lat = rand.uniform(-85.0, 84.0)
+	return (lon, lat, lon + rand.uniform(0.0, 1.0), lat + rand.uniform(0.0, 1.0))
+
+class Item(object):
+	pass
+
+class TestRTree(unittest.TestCase):
+
+	def check(self, tree, boxes, rand):
+		for i in range(200):
+			query = random_box(rand)
+			expected = set(obj for obj, box in boxes.items() if boxes_overlap(box, query))
+			self.assertEqual(set(tree.search(query)), expected)
+		self.assertEqual(len(tree), len(boxes))
+
+	def test_empty(self):
+		tree = RTree([])
+		self.assertEqual(len(tree), 0)
+		self.assertEqual(tree.search((-180.0, -85.0, 180.0, 85.0)), [])
+		obj = Item()
+		tree.insert(obj, (1.0, 2.0, 3.0, 4.0))
+		self.assertEqual(tree.search((0.0, 0.0, 1.5, 2.5)), [obj])
+		tree.remove(obj)
+		self.assertEqual(tree.search((-180.0, -85.0, 180.0, 85.0)), [])
+
+	def test_insert_and_remove(self):
+		rand = random.Random(1)
+		boxes = {}
+		for i in range(500):
+			boxes[Item()] = random_box(rand)
+		tree = RTree([(box, obj) for obj, box in boxes.items()])
+		self.check(tree, boxes, rand)
+
+		for i in range(300):
+			obj = Item()
+			boxes[obj] = random_box(rand)
+			tree.insert(obj, boxes[obj])
+		for obj in rand.sample(list(boxes), 400):
+			tree.remove(obj)
+			del boxes[obj]
+		for obj in rand.sample(list(boxes), 50):		# move
+			boxes[obj] = random_box(rand)
+			tree.insert(obj, boxes[obj])
+		self.check(tree, boxes, rand)
+
+		for obj in list(boxes):
+			tree.remove(obj)
+			del boxes[obj]
+		self.check(tree, boxes, rand)
+
+if __name__ == "__main__":
+	unittest.main()